@@ -0,0 +1,211 @@
+#!/usr/bin/env python3
+# encoding: utf-8
+
+import hashlib
+import json
+import os
+import shutil
+import threading
+import time
+
+from common import cache_dir, get_size, is_win, mkdir, remove_path
+from fileinfo import FileInfo
+
+# 旧ROM解码结果的缓存
+# 以 zip 内容(以及增量块 OTA 的基础镜像)的 sha1 为键, 每项为一个目录:
+#   meta.json            分区列表, 占用空间, 最后使用时间
+#   <分区>.img           解码后的镜像(Linux, 命中时只读挂载)
+#   <分区>/              解出的目录和 statfile (Windows, 命中时复制)
+#   <分区>.files.json    扫描和哈希的结果
+# 总占用超过配额时按最后使用时间淘汰, 写入缓存失败时只放弃缓存, 不影响构建
+
+CACHE_VERSION = 1
+HASH_CHUNK = 4 * 1024 * 1024
+COPY_CHUNK = 1024 * 1024
+# 超过这个时间仍未完成的临时目录视为异常退出的残留
+STALE_TMP = 24 * 3600
+
+class ArtifactCache:
+
+    def __init__(self, quota, root=None):
+        # quota 为缓存可占用的字节数
+        self.quota = quota
+        self.root = root or cache_dir("artifacts")
+        self.lock = threading.Lock()
+
+    def file_hash(self, path):
+        # 文件内容的 sha1, 按 (路径, 大小, 修改时间) 记录在 hashes.json 中, 文件未变化时不再计算
+        path = os.path.abspath(path)
+        st = os.stat(path)
+        stamp = [st.st_size, st.st_mtime_ns]
+        index_path = os.path.join(self.root, "hashes.json")
+        with self.lock:
+            index = read_json(index_path) or {}
+            if index.get(path, [None])[:2] == stamp:
+                return index[path][2]
+        sha1 = hashlib.sha1()
+        with open(path, "rb") as f:
+            for data in iter(lambda: f.read(HASH_CHUNK), b""):
+                sha1.update(data)
+        with self.lock:
+            index = read_json(index_path) or {}
+            index[path] = stamp + [sha1.hexdigest()]
+            write_json(index_path, index)
+        return sha1.hexdigest()
+
+    def key(self, zip_path, base_images=None):
+        # 镜像的格式(Linux 为镜像, Windows 为解出的目录)也是键的一部分
+        sha1 = hashlib.sha1(("%d %s %s" % (CACHE_VERSION, os.name, self.file_hash(zip_path))).encode())
+        for name in sorted(base_images or {}):
+            sha1.update((" %s=%s" % (name, self.file_hash(base_images[name]))).encode())
+        return sha1.hexdigest()
+
+    def path(self, key, *names):
+        return os.path.join(self.root, key, *names)
+
+    def lookup(self, key):
+        # 返回缓存项的 meta, 同时更新最后使用时间; 不存在时返回 None
+        with self.lock:
+            meta = read_json(self.path(key, "meta.json"))
+            if not meta or meta.get("version") != CACHE_VERSION:
+                return None
+            meta["last_used"] = time.time()
+            write_json(self.path(key, "meta.json"), meta)
+        return meta
+
+    def load_manifest(self, key, name, root, root_path):
+        # 返回 FileInfo 集合, 分区目录不同(例如 system-as-root)时返回 None
+        data = read_json(self.path(key, name + ".files.json"))
+        if not data or data["root"] != root:
+            return None
+        return {FileInfo.from_record(record, root_path) for record in data["files"]}
+
+    def begin(self, key):
+        return CacheEntry(self, key)
+
+    def entries(self):
+        # 返回 [(最后使用时间, 占用空间, 键), ...], 同时清理残留的临时目录
+        result = []
+        for name in os.listdir(self.root):
+            path = os.path.join(self.root, name)
+            if not os.path.isdir(path):
+                continue
+            if name.endswith(".tmp"):
+                if time.time() - os.path.getmtime(path) > STALE_TMP:
+                    remove_path(path)
+                continue
+            meta = read_json(os.path.join(path, "meta.json"))
+            if meta:
+                result.append((meta["last_used"], meta["size"], name))
+        return result
+
+    def evict(self, keep=None):
+        # 从最久未使用的开始删除, 直到总占用不超过配额, 返回删除的键
+        with self.lock:
+            entries = sorted(self.entries())
+            total = sum(size for last_used, size, key in entries)
+            evicted = []
+            for last_used, size, key in entries:
+                if total <= self.quota:
+                    break
+                if key == keep:
+                    continue
+                remove_path(self.path(key))
+                total -= size
+                evicted.append(key)
+            if total > self.quota and keep:
+                # 单独一项就超过配额
+                remove_path(self.path(keep))
+                evicted.append(keep)
+        return evicted
+
+class CacheEntry:
+    # 构建过程中逐步写入的缓存项, 在临时目录中写入, commit 时改名为正式的目录
+
+    def __init__(self, cache, key):
+        self.cache = cache
+        self.key = key
+        self.tmp_path = cache.path("%s.%d.tmp" % (key, os.getpid()))
+        self.partitions = []
+        self.failed = False
+        remove_path(self.tmp_path)
+        mkdir(self.tmp_path)
+
+    def _guard(self, func, *args):
+        # 写入失败(例如空间不足)时放弃整个缓存项
+        if self.failed:
+            return
+        try:
+            func(*args)
+        except OSError:
+            self.failed = True
+            remove_path(self.tmp_path)
+
+    def store_partition(self, name, base):
+        # base 为分区在解包目录中的路径(不含扩展名)
+        # Linux 在挂载前保存镜像, Windows 在解出后保存目录
+        def _store():
+            if is_win():
+                shutil.copytree(base, os.path.join(self.tmp_path, name))
+                if os.path.exists(base + "_statfile.txt"):
+                    shutil.copyfile(base + "_statfile.txt",
+                                    os.path.join(self.tmp_path, name + "_statfile.txt"))
+            else:
+                copy_sparse(base + ".img", os.path.join(self.tmp_path, name + ".img"))
+        self._guard(_store)
+        with self.cache.lock:
+            self.partitions.append(name)
+
+    def store_manifest(self, name, root, items):
+        records = sorted(item.to_record() for item in items)
+        self._guard(write_json, os.path.join(self.tmp_path, name + ".files.json"),
+                    {"root": root, "files": records})
+
+    def commit(self, available):
+        # available 为旧ROM中的全部分区, 命中时据此判断缓存的分区是否够用
+        # 返回缓存项的占用空间, 放弃缓存时返回 0
+        if self.failed:
+            return 0
+        size = get_size(self.tmp_path)
+        meta = {"version": CACHE_VERSION, "partitions": sorted(self.partitions),
+                "available": sorted(available), "size": size,
+                "created": time.time(), "last_used": time.time()}
+        try:
+            write_json(os.path.join(self.tmp_path, "meta.json"), meta)
+            with self.cache.lock:
+                remove_path(self.cache.path(self.key))
+                os.replace(self.tmp_path, self.cache.path(self.key))
+        except OSError:
+            self.discard()
+            return 0
+        if self.key in self.cache.evict(keep=self.key):
+            return 0
+        return size
+
+    def discard(self):
+        self.failed = True
+        remove_path(self.tmp_path)
+
+def copy_sparse(src, dst):
+    # 复制镜像 全零的块在目标文件中留为空洞
+    with open(src, "rb") as fin, open(dst, "wb") as fout:
+        for data in iter(lambda: fin.read(COPY_CHUNK), b""):
+            if data.count(0) == len(data):
+                fout.seek(len(data), 1)
+            else:
+                fout.write(data)
+        fout.truncate()
+
+def read_json(path):
+    try:
+        with open(path, "r", encoding="UTF-8") as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+def write_json(path, data):
+    # 先写入临时文件再改名, 其他进程不会读到写了一半的文件
+    tmp_path = "%s.%d.tmp" % (path, os.getpid())
+    with open(tmp_path, "w", encoding="UTF-8") as f:
+        json.dump(data, f)
+    os.replace(tmp_path, path)
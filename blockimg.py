@@ -0,0 +1,355 @@
+#!/usr/bin/env python3
+# encoding: utf-8
+
+import bz2
+import hashlib
+import mmap
+import os
+import shutil
+import struct
+import sys
+import tempfile
+import zlib
+
+import bsdiff4.core
+
+from collections import OrderedDict
+from rangelib import RangeSet
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+# 块镜像更新 (block_image_update)
+# 在基础镜像上执行传输列表(v3/v4)中的命令, 得到新镜像, 与设备端 recovery 相同:
+#   erase/zero/new, move/bsdiff/imgdiff, stash/free
+# 命令按设备端原地更新的方式设计, 源块和目标块在同一个分区中,
+# 因此先把基础镜像复制为输出镜像, 再在同一个 mmap 上依次执行.
+# 源数据先完整读入内存再写入目标, 源和目标重叠时不需要额外处理.
+# stash 的数据保存在内存中, 超过 stash_memory 时写入 stash_dir
+
+BLOCK_SIZE = 4096
+# new 和 zero 命令每次写入的最大字节数
+WRITE_CHUNK = 1024 * 1024
+STASH_MEMORY = 256 * 1024 * 1024
+
+# 只需要 new.dat 的完整包命令
+FULL_COMMANDS = {'erase', 'new', 'zero'}
+# compute_hash_tree 写入 dm-verity 的哈希树, 不影响分区中的文件, 直接跳过
+IGNORED_COMMANDS = {'compute_hash_tree'}
+
+class BlockImageError(Exception):
+    pass
+
+def read_transfer_list(path):
+    # 返回 (版本, 写入的总块数, stash 最多占用的块数, [命令的各个字段, ...])
+    with open(path, 'r') as f:
+        lines = f.read().splitlines()
+    version = int(lines[0])
+    total_blocks = int(lines[1])
+    stash_blocks = 0
+    start = 2
+    if version >= 2:
+        stash_blocks = int(lines[3])
+        start = 4
+    commands = [line.split() for line in lines[start:] if line.strip()]
+    return version, total_blocks, stash_blocks, commands
+
+def is_incremental(path):
+    # 传输列表中是否有需要基础镜像的命令
+    commands = read_transfer_list(path)[3]
+    return any(cmd[0] not in FULL_COMMANDS | IGNORED_COMMANDS for cmd in commands)
+
+def target_ranges(version, cmd):
+    # 命令写入的块 不写入的命令返回 None
+    if cmd[0] in ('new', 'zero'):
+        return RangeSet.parse(cmd[1])
+    if cmd[0] == 'move':
+        return RangeSet.parse(cmd[2])
+    if cmd[0] in ('bsdiff', 'imgdiff'):
+        return RangeSet.parse(cmd[5])
+    return None
+
+class StashStore:
+    # 有上限的 stash: 内存中的数据超过 memory 字节后, 新的条目写入磁盘
+
+    def __init__(self, stash_dir=None, memory=STASH_MEMORY):
+        self.stash_dir = stash_dir
+        self.memory = memory
+        self.used = 0
+        self.entries = OrderedDict()
+        self.own_dir = False
+
+    def put(self, stash_id, data):
+        if stash_id in self.entries:
+            return
+        if self.used + len(data) <= self.memory:
+            self.entries[stash_id] = data
+            self.used += len(data)
+            return
+        if self.stash_dir is None:
+            self.stash_dir = tempfile.mkdtemp('', 'OTA-maker_stash_')
+            self.own_dir = True
+        path = os.path.join(self.stash_dir, stash_id)
+        with open(path, 'wb') as f:
+            f.write(data)
+        self.entries[stash_id] = path
+
+    def get(self, stash_id):
+        entry = self.entries.get(stash_id)
+        if entry is None:
+            raise BlockImageError('stash %s not found' % stash_id)
+        if isinstance(entry, str):
+            with open(entry, 'rb') as f:
+                return f.read()
+        return entry
+
+    def free(self, stash_id):
+        entry = self.entries.pop(stash_id, None)
+        if isinstance(entry, str):
+            os.remove(entry)
+        elif entry is not None:
+            self.used -= len(entry)
+
+    def close(self):
+        for stash_id in list(self.entries):
+            self.free(stash_id)
+        if self.own_dir:
+            shutil.rmtree(self.stash_dir, ignore_errors=True)
+
+def read_blocks(image, ranges):
+    return b''.join(image[s * BLOCK_SIZE:e * BLOCK_SIZE] for s, e in ranges)
+
+def write_blocks(image, ranges, data):
+    pos = 0
+    for s, e in ranges:
+        size = (e - s) * BLOCK_SIZE
+        image[s * BLOCK_SIZE:e * BLOCK_SIZE] = data[pos:pos + size]
+        pos += size
+
+def place_blocks(buf, locs, data):
+    # 把连续的数据按块放到缓冲区中 locs 指定的位置
+    pos = 0
+    for s, e in locs:
+        size = (e - s) * BLOCK_SIZE
+        buf[s * BLOCK_SIZE:e * BLOCK_SIZE] = data[pos:pos + size]
+        pos += size
+
+def load_source(image, stash, args):
+    # 源数据的格式(v3+):
+    #   <块数> <源区间>
+    #   <块数> - <stash_id>:<区间> ...
+    #   <块数> <源区间> <源数据在缓冲区中的位置> <stash_id>:<区间> ...
+    count = int(args[0])
+    buf = bytearray(count * BLOCK_SIZE)
+    pos = 1
+    if args[pos] != '-':
+        data = read_blocks(image, RangeSet.parse(args[pos]))
+        pos += 1
+        if pos < len(args):
+            place_blocks(buf, RangeSet.parse(args[pos]), data)
+            pos += 1
+        else:
+            buf[:len(data)] = data
+    else:
+        pos += 1
+    for spec in args[pos:]:
+        stash_id, locs = spec.split(':', 1)
+        place_blocks(buf, RangeSet.parse(locs), stash.get(stash_id))
+    return bytes(buf)
+
+def sha1(data):
+    return hashlib.sha1(data).hexdigest()
+
+def _decompress(data, method, size=None):
+    # BSDF2 各数据块的压缩方式: 0 不压缩, 1 bz2, 2 brotli
+    # 数据块之后可能还有其他数据(imgdiff 中的补丁), 只取需要的长度
+    if method == 0:
+        out = data[:size]
+    elif method == 1:
+        out = bz2.BZ2Decompressor().decompress(data)
+    elif method == 2:
+        if brotli is None:
+            raise BlockImageError('brotli compressed bsdiff patch needs the brotli module')
+        out = brotli.decompress(data)
+    else:
+        raise BlockImageError('unknown bsdiff compression %d' % method)
+    if size is None:
+        return out
+    if len(out) < size:
+        raise BlockImageError('truncated bsdiff patch')
+    return out[:size]
+
+def bspatch(src, patch):
+    # 支持 BSDIFF40 和 BSDF2 两种格式, patch 之后可以有多余的数据
+    if patch[:8] == b'BSDIFF40':
+        methods = (1, 1, 1)
+    elif patch[:5] == b'BSDF2':
+        methods = tuple(patch[5:8])
+    else:
+        raise BlockImageError('unknown bsdiff patch format')
+    decode = bsdiff4.core.decode_int64
+    len_control = decode(patch[8:16])
+    len_diff = decode(patch[16:24])
+    len_dst = decode(patch[24:32])
+    pos = 32
+    bcontrol = _decompress(patch[pos:pos + len_control], methods[0])
+    control = [(decode(bcontrol[i:i + 8]), decode(bcontrol[i + 8:i + 16]), decode(bcontrol[i + 16:i + 24]))
+               for i in range(0, len(bcontrol) - 23, 24)]
+    pos += len_control
+    bdiff = _decompress(patch[pos:pos + len_diff], methods[1], sum(c[0] for c in control))
+    pos += len_diff
+    bextra = _decompress(patch[pos:], methods[2], sum(c[1] for c in control))
+    return bsdiff4.core.patch(src, len_dst, control, bdiff, bextra)
+
+IMGDIFF_MAGIC = b'IMGDIFF2'
+CHUNK_NORMAL = 0
+CHUNK_DEFLATE = 2
+CHUNK_RAW = 3
+
+def imgpatch(src, patch):
+    # IMGDIFF2: 按块处理, deflate 块先解压, 打补丁后以相同的参数重新压缩
+    if patch[:8] != IMGDIFF_MAGIC:
+        raise BlockImageError('unknown imgdiff patch format')
+    num_chunks, = struct.unpack_from('<i', patch, 8)
+    pos = 12
+    out = []
+    for i in range(num_chunks):
+        chunk_type, = struct.unpack_from('<i', patch, pos)
+        pos += 4
+        if chunk_type == CHUNK_NORMAL:
+            src_start, src_len, patch_offset = struct.unpack_from('<qqq', patch, pos)
+            pos += 24
+            out.append(bspatch(src[src_start:src_start + src_len], patch[patch_offset:]))
+        elif chunk_type == CHUNK_DEFLATE:
+            (src_start, src_len, patch_offset, src_expanded_len, target_len,
+             level, method, window_bits, mem_level, strategy) = struct.unpack_from('<qqqqqiiiii', patch, pos)
+            pos += 60
+            expanded = zlib.decompressobj(-15).decompress(src[src_start:src_start + src_len])
+            if len(expanded) != src_expanded_len:
+                raise BlockImageError('imgdiff: source chunk expands to %d bytes, expected %d'
+                                      % (len(expanded), src_expanded_len))
+            target = bspatch(expanded, patch[patch_offset:])
+            if len(target) != target_len:
+                raise BlockImageError('imgdiff: patched chunk is %d bytes, expected %d'
+                                      % (len(target), target_len))
+            deflate = zlib.compressobj(level, method, window_bits, mem_level, strategy)
+            out.append(deflate.compress(target) + deflate.flush())
+        elif chunk_type == CHUNK_RAW:
+            size, = struct.unpack_from('<i', patch, pos)
+            pos += 4
+            out.append(patch[pos:pos + size])
+            pos += size
+        else:
+            raise BlockImageError('unsupported imgdiff chunk type %d' % chunk_type)
+    return b''.join(out)
+
+def apply_block_image(transfer_list, out_image, base_image=None, new_data=None,
+                      patch_data=None, stash_dir=None, stash_memory=STASH_MEMORY, progress=None):
+    # 在 base_image 的副本 out_image 上执行 transfer_list
+    # new_data, patch_data 为 *.new.dat 和 *.patch.dat 的路径(没有时为 None)
+    # progress 为每执行一条写入命令后调用的函数, 参数为写入的字节数
+    version, total_blocks, stash_blocks, commands = read_transfer_list(transfer_list)
+    incremental = any(cmd[0] not in FULL_COMMANDS | IGNORED_COMMANDS for cmd in commands)
+    if incremental and version < 3:
+        raise BlockImageError('transfer list version %d is not supported, only full lists '
+                              'or version 3 and later' % version)
+    if incremental and base_image is None:
+        raise BlockImageError('%s needs a base image' % transfer_list)
+
+    size = RangeSet.union_all(filter(None, (target_ranges(version, cmd) for cmd in commands))).end * BLOCK_SIZE
+    if base_image is not None and os.path.abspath(base_image) != os.path.abspath(out_image):
+        shutil.copyfile(base_image, out_image)
+    elif base_image is None:
+        open(out_image, 'wb').close()
+    size = max(size, os.path.getsize(out_image))
+
+    stash = StashStore(stash_dir, stash_memory)
+    new_f = open(new_data, 'rb') if new_data else None
+    patch_f = patch_map = None
+    out_f = open(out_image, 'r+b')
+    try:
+        out_f.truncate(size)
+        if size == 0:
+            return out_image
+        image = mmap.mmap(out_f.fileno(), size)
+        if patch_data and os.path.getsize(patch_data):
+            patch_f = open(patch_data, 'rb')
+            patch_map = mmap.mmap(patch_f.fileno(), 0, access=mmap.ACCESS_READ)
+        for cmd in commands:
+            op = cmd[0]
+            written = 0
+            if op == 'erase' or op in IGNORED_COMMANDS:
+                pass
+            elif op in ('zero', 'new'):
+                # new.dat 中的数据按区间的顺序排列
+                if op == 'new' and new_f is None:
+                    raise BlockImageError('%s: new command without new data' % transfer_list)
+                zeros = bytes(WRITE_CHUNK)
+                for s, e in RangeSet.parse(cmd[1]):
+                    for offset in range(s * BLOCK_SIZE, e * BLOCK_SIZE, WRITE_CHUNK):
+                        n = min(WRITE_CHUNK, e * BLOCK_SIZE - offset)
+                        data = zeros[:n] if op == 'zero' else new_f.read(n)
+                        if len(data) != n:
+                            raise BlockImageError('%s: new data is truncated' % new_data)
+                        image[offset:offset + n] = data
+                        written += n
+            elif op == 'stash':
+                data = read_blocks(image, RangeSet.parse(cmd[2]))
+                if sha1(data) != cmd[1]:
+                    raise BlockImageError('stash %s: source blocks do not match' % cmd[1])
+                stash.put(cmd[1], data)
+            elif op == 'free':
+                stash.free(cmd[1])
+            elif op == 'move':
+                src_hash, tgt = cmd[1], RangeSet.parse(cmd[2])
+                data = load_source(image, stash, cmd[3:])
+                if sha1(data) != src_hash:
+                    if sha1(read_blocks(image, tgt)) == src_hash:
+                        # 目标已经是新数据(例如中断后重新执行)
+                        continue
+                    raise BlockImageError('move %s: source blocks do not match' % cmd[2])
+                write_blocks(image, tgt, data)
+                written = len(data)
+            elif op in ('bsdiff', 'imgdiff'):
+                patch_offset, patch_len = int(cmd[1]), int(cmd[2])
+                src_hash, tgt_hash, tgt = cmd[3], cmd[4], RangeSet.parse(cmd[5])
+                data = load_source(image, stash, cmd[6:])
+                if sha1(data) != src_hash:
+                    if sha1(read_blocks(image, tgt)) == tgt_hash:
+                        continue
+                    raise BlockImageError('%s %s: source blocks do not match' % (op, cmd[5]))
+                if patch_map is None:
+                    raise BlockImageError('%s: %s command without patch data' % (transfer_list, op))
+                patch = patch_map[patch_offset:patch_offset + patch_len]
+                data = bspatch(data, patch) if op == 'bsdiff' else imgpatch(data, patch)
+                if len(data) != tgt.size * BLOCK_SIZE or sha1(data) != tgt_hash:
+                    raise BlockImageError('%s %s: patched blocks do not match' % (op, cmd[5]))
+                write_blocks(image, tgt, data)
+                written = len(data)
+            else:
+                raise BlockImageError('unknown transfer list command: %s' % op)
+            if progress and written:
+                progress(written)
+        image.flush()
+        image.close()
+    finally:
+        stash.close()
+        if patch_map is not None:
+            patch_map.close()
+        if patch_f is not None:
+            patch_f.close()
+        if new_f is not None:
+            new_f.close()
+        out_f.close()
+    return out_image
+
+if __name__ == '__main__':
+    if len(sys.argv) < 4:
+        print('Usage: blockimg.py <transfer_list> <base_image|-> <output_image> [new_data] [patch_data]')
+        sys.exit(1)
+    apply_block_image(sys.argv[1], sys.argv[3],
+                      base_image=None if sys.argv[2] == '-' else sys.argv[2],
+                      new_data=sys.argv[4] if len(sys.argv) > 4 else None,
+                      patch_data=sys.argv[5] if len(sys.argv) > 5 else None)
@@ -2,13 +2,17 @@
 # -*- coding: utf-8 -*-
 # Modified : jpacg <jpacg@vip.163.com>
 
+import io
 import os
+import posixpath
 import sys
 import struct
 import hashlib
 from stat import *
 import shutil
+import time
 from gzip import GzipFile
+import ramdisk as ramdisk_codec
 
 
 def sha_file(sha, file):
@@ -221,6 +225,90 @@ def parse_bootimg(bootimg):
     bootimg.close()
 
 
+def read_bootimg_header(bootimg):
+    """ parse the header of C8600-compatible bootimg without writing any file.
+        bootimg: seekable file object (or mmap) positioned at the start of the image
+        return dict of page_size, padding_size and the offset and size of
+        kernel, ramdisk, second and dt_image
+    """
+
+    check_mtk_head(bootimg, io.StringIO())
+
+    (magic,
+     kernel_size, kernel_addr,
+     ramdisk_size, ramdisk_addr,
+     second_size, second_addr,
+     tags_addr, page_size, dt_size, zero,
+     name, cmdline, id4x8
+    ) = struct.unpack('<8s10I16s512s32s', bootimg.read(608))
+    assert magic.decode('latin') == 'ANDROID!', 'invald bootimg'
+    bootimg.seek(page_size - 608, 1)
+
+    # same as parse_bootimg: the first non-empty page after the header gives padding_size
+    while bootimg.read(page_size) == struct.pack('%ds' % page_size, b''):
+        pass
+    bootimg.seek(-page_size, 1)
+    size = bootimg.tell()
+    padding = lambda x: (~x + 1) & (size - 1)
+
+    header = {'page_size': page_size, 'padding_size': size}
+    offset = size
+    for part, part_size in (('kernel', kernel_size), ('ramdisk', ramdisk_size),
+                            ('second', second_size), ('dt_image', dt_size)):
+        header[part + '_offset'] = offset
+        header[part + '_size'] = part_size
+        offset += part_size + padding(part_size)
+    return header
+
+
+def read_ramdisk(bootimg):
+    """ return the (compressed) ramdisk of bootimg as bytes.
+        bootimg: seekable file object (or mmap)
+    """
+
+    header = read_bootimg_header(bootimg)
+    bootimg.seek(header['ramdisk_offset'], 0)
+    return bootimg.read(header['ramdisk_size'])
+
+
+def open_ramdisk(ramdisk):
+    """ return a file object that reads the uncompressed cpio of ramdisk,
+        decompressing on the fly.
+        ramdisk: bytes
+        the format (gzip, xz, lzma, lz4, lz4-legacy, zstd or plain cpio)
+        is detected by its magic, see ramdisk.RAMDISK_DECODERS
+    """
+
+    tmp = io.BytesIO(ramdisk)
+    check_mtk_head(tmp, io.StringIO())
+    return ramdisk_codec.open_decoded(tmp)
+
+
+def read_ramdisk_files(bootimg, names):
+    """ read regular files from the ramdisk of bootimg, without changing
+        the working directory or writing any file.
+        bootimg: path, bytes, or seekable file object (or mmap)
+        names: paths inside the ramdisk
+        return {name: bytes} of the files found, parsing stops once all are found
+    """
+
+    if isinstance(bootimg, str):
+        with open(bootimg, 'rb') as f:
+            return read_ramdisk_files(f, names)
+    if isinstance(bootimg, (bytes, bytearray, memoryview)):
+        bootimg = io.BytesIO(bootimg)
+
+    wanted = {posixpath.normpath(n.lstrip('/')) for n in names}
+    found = {}
+    for name, mode, data in iter_cpio(open_ramdisk(read_ramdisk(bootimg))):
+        name = posixpath.normpath(name.lstrip('/'))
+        if name in wanted and S_ISREG(mode):
+            found[name] = data
+            if len(found) == len(wanted):
+                break
+    return found
+
+
 def cpio_list(directory, output=None):
     """ generate gen_cpio_init-compatible list for directory,
         if output is None, write to stdout
@@ -255,45 +343,72 @@ def cpio_list(directory, output=None):
         output.close()
 
 
-def parse_cpio(cpio, directory, cpiolist):
-    """ parse cpio, write content under directory.
+CPIO_HEADER = struct.Struct('6s8s8s8s8s8s8s8s8s8s8s8s8s8s')
+CPIO_CHUNK = 1024 * 1024
+
+
+def iter_cpio(cpio):
+    """ iterate over the entries of a newc cpio archive.
         cpio: file object
-        directory: string
-        cpiolist: file object
+        yield (name, mode, data) for every entry before TRAILER!!!
+
+        the archive is read in CPIO_CHUNK blocks and the fixed 110-byte
+        headers are unpacked from the buffer, so a ramdisk with thousands
+        of entries costs a few reads instead of ~16 per entry.
 
         official document: (cpio newc structure)
         http://git.kernel.org/?p=linux/kernel/git/torvalds/linux-2.6.git;a=blob;f=usr/gen_init_cpio.c
     """
 
-    padding = lambda x: (~x + 1) & 3
-
-    def read_cpio_header(cpio):
-        assert cpio.read(6).decode('latin') == '070701', 'invalid cpio'
-        cpio.read(8) # ignore inode number
-        mode = int(cpio.read(8), 16)
-        cpio.read(8) # uid
-        cpio.read(8) # gid
-        cpio.read(8) # nlink
-        cpio.read(8) # timestamp
-        filesize = int(cpio.read(8), 16)
-        cpio.read(8) # major
-        cpio.read(8) # minor
-        cpio.read(8) # rmajor
-        cpio.read(8) # rminor
-        namesize = int(cpio.read(8), 16)
-        cpio.read(8)
-        name = cpio.read(namesize - 1).decode('utf8')
-        cpio.read(1)
-        cpio.read(padding(namesize + 110))
-        return name, mode, filesize
-
-    os.makedirs(directory)
+    buf = b''
+    pos = 0
+
+    def fill(size):
+        # make sure buf[pos:pos + size] is buffered
+        nonlocal buf, pos
+        parts = [buf[pos:]]
+        have = len(parts[0])
+        while have < size:
+            chunk = cpio.read(max(CPIO_CHUNK, size - have))
+            if not chunk:
+                break
+            parts.append(chunk)
+            have += len(chunk)
+        buf = b''.join(parts)
+        pos = 0
 
     while True:
-        name, mode, filesize = read_cpio_header(cpio)
+        if len(buf) - pos < 110:
+            fill(110)
+        (magic, ino, mode, uid, gid, nlink, mtime, filesize,
+         major, minor, rmajor, rminor, namesize, check) = CPIO_HEADER.unpack_from(buf, pos)
+        assert magic == b'070701', 'invalid cpio'
+        namesize = int(namesize, 16)
+        filesize = int(filesize, 16)
+        # header + name and the data are each padded to 4 bytes
+        name_len = (110 + namesize + 3) & ~3
+        data_len = (filesize + 3) & ~3
+        if len(buf) - pos < name_len + data_len:
+            fill(name_len + data_len)
+        name = buf[pos + 110:pos + 110 + namesize - 1].decode('utf8')
         if name == 'TRAILER!!!':
             break
+        pos += name_len
+        data = buf[pos:pos + filesize]
+        pos += data_len
+        yield name, int(mode, 16), data
 
+
+def parse_cpio(cpio, directory, cpiolist):
+    """ parse cpio, write content under directory.
+        cpio: file object
+        directory: string
+        cpiolist: file object
+    """
+
+    os.makedirs(directory)
+
+    for name, mode, data in iter_cpio(cpio):
         if name[:1] == '/':
             name = name[1:]
 
@@ -303,9 +418,7 @@ def parse_cpio(cpio, directory, cpiolist):
 
         srwx = oct(S_IMODE(mode))
         if S_ISLNK(mode):
-            location = cpio.read(filesize)
-            location = location.decode()
-            cpio.read(padding(filesize))
+            location = data.decode()
             cpiolist.write('slink\t%s\t%s\t%s\n' % (name, location, srwx))
         elif S_ISDIR(mode):
             try: os.makedirs(path)
@@ -313,13 +426,9 @@ def parse_cpio(cpio, directory, cpiolist):
             cpiolist.write('dir\t%s\t%s\n' % (name, srwx))
         elif S_ISREG(mode):
             tmp = open(path, 'wb')
-            tmp.write(cpio.read(filesize))
-            cpio.read(padding(filesize))
+            tmp.write(data)
             tmp.close()
             cpiolist.write('file\t%s\t%s\t%s\n' % (name, path, srwx))
-        else:
-            cpio.read(filesize)
-            cpio.read(padding(filesize))
 
     cpio.close()
     cpiolist.close()
@@ -447,6 +556,11 @@ class CPIOGZIP(GzipFile):
 
 __all__ = [ 'parse_bootimg',
             'write_bootimg',
+            'read_bootimg_header',
+            'read_ramdisk',
+            'open_ramdisk',
+            'read_ramdisk_files',
+            'iter_cpio',
             'parse_cpio',
             'write_cpio',
             'cpio_list',
@@ -764,20 +878,19 @@ def unpack_ramdisk(ramdisk=None, directory=None):
     pos = tmp.tell()
 
     compress_level = 0
-    magic = tmp.read(6)
-    if magic[:3] == struct.pack('3B', 0x1f, 0x8b, 0x08):
-        tmp.seek(pos, 0)
-        compress_level = 6
-        cpio = CPIOGZIP(None, 'rb', compress_level, tmp)
-    elif magic.decode('latin') == '070701':
-        tmp.seek(pos, 0)
-        cpio = tmp
-    else:
+    magic = tmp.read(8)
+    tmp.seek(pos, 0)
+    compress = ramdisk_codec.detect_format(magic)
+    if compress is None:
         tmp.close()
         raise IOError('invalid ramdisk')
+    # repack_ramdisk only writes gzip, other formats are repacked uncompressed
+    if compress == 'gzip':
+        compress_level = 6
+    cpio = ramdisk_codec.open_decoded(tmp)
 
     cpiolist.write('compress_level:%d\n' % compress_level)
-    sys.stderr.write('compress: %s\n' % (compress_level > 0))
+    sys.stderr.write('compress: %s\n' % compress)
     parse_cpio(cpio, directory, cpiolist)
 
 
@@ -837,6 +950,73 @@ def repack_ramdisk(cpiolist=None):
         os.rename('ramdisk.cpio.gz.tmp', 'ramdisk.cpio.gz')
     info.close()
 
+def bench_ramdisk(image=None, rounds='3'):
+    """ decode the ramdisk of image (boot.img or a bare ramdisk) recompressed
+        in every format that can be written here, and print the speed of
+        decoding + cpio parsing for each decoder.
+    """
+
+    import gzip
+    import lzma
+    codec = ramdisk_codec
+
+    if image is None:
+        image = 'boot.img'
+    data = open(image, 'rb').read()
+    tmp = io.BytesIO(data)
+    check_mtk_head(tmp, io.StringIO())
+    if tmp.read(8) == b'ANDROID!':
+        data = read_ramdisk(io.BytesIO(data))
+    cpio = open_ramdisk(data).read()
+
+    samples = [('input', data, None)]
+    samples.append(('gzip', gzip.compress(cpio, 6), None))
+    samples.append(('xz', lzma.compress(cpio, lzma.FORMAT_XZ, check=lzma.CHECK_CRC32), None))
+    samples.append(('lzma', lzma.compress(cpio, lzma.FORMAT_ALONE), None))
+    if codec.lz4_block:
+        legacy = [codec.LZ4_LEGACY_MAGIC]
+        for i in range(0, len(cpio), codec.LZ4_LEGACY_BLOCK):
+            block = codec.lz4_block.compress(cpio[i:i + codec.LZ4_LEGACY_BLOCK],
+                                             mode='high_compression', store_size=False)
+            legacy += [struct.pack('<I', len(block)), block]
+        legacy = b''.join(legacy)
+        samples.append(('lz4-legacy', legacy, None))
+        samples.append(('lz4-legacy', legacy, lambda: codec.Lz4LegacyDecoder(
+                        codec.lz4_block_decompress_py)))
+        samples.append(('lz4', codec.lz4_frame.compress(cpio), None))
+    else:
+        sys.stderr.write('lz4 module not installed, skipping lz4\n')
+    if codec.zstandard:
+        samples.append(('zstd', codec.zstandard.ZstdCompressor(level=19).compress(cpio), None))
+    else:
+        sys.stderr.write('zstandard module not installed, skipping zstd\n')
+
+    sys.stdout.write('cpio: %d bytes\n' % len(cpio))
+    sys.stdout.write('%-12s %-8s %10s %7s %10s %10s\n'
+                     % ('format', 'decoder', 'size', 'ratio', 'time', 'speed'))
+    for name, blob, factory in samples:
+        fmt = codec.detect_format(blob[:8])
+        if factory is None:
+            impl = 'native'
+            if fmt == 'lz4-legacy' and not codec.lz4_block:
+                impl = 'python'
+            factory = codec.RAMDISK_DECODERS[fmt][1]
+        else:
+            impl = 'python'
+        best = None
+        for i in range(int(rounds)):
+            start = time.perf_counter()
+            count = sum(1 for entry in iter_cpio(
+                codec.RamdiskReader(io.BytesIO(blob), factory())))
+            elapsed = time.perf_counter() - start
+            best = elapsed if best is None else min(best, elapsed)
+        sys.stdout.write('%-12s %-8s %10d %6.1f%% %8.1fms %6.1fMB/s\n'
+                         % (name if name != 'input' else 'input:' + fmt, impl, len(blob),
+                            len(blob) * 100.0 / len(cpio), best * 1000,
+                            len(cpio) / best / 1024 / 1024))
+    sys.stdout.write('entries: %d\n' % count)
+
+
 def showVersion():
     sys.stderr.write('bootimg:\n')
     sys.stderr.write('\tUpdate Date:20160601\n')
@@ -855,7 +1035,8 @@ if __name__ == '__main__':
                  '--unpack-bootimg': unpack_bootimg,
                  '--unpack-ramdisk': unpack_ramdisk,
                  '--repack-ramdisk': repack_ramdisk,
-                 '--repack-bootimg': repack_bootimg
+                 '--repack-bootimg': repack_bootimg,
+                 '--bench-ramdisk': bench_ramdisk
                 }
 
     def usage():
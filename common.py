@@ -1,25 +1,34 @@
 #!/usr/bin/env python3
 # encoding: utf-8
 
+import hashlib
+import json
 import os
 import re
 import shutil
 import sys
 import tempfile
+import threading
+import time
 import zipfile
 
-from bootimg import unpack_bootimg
 from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 from sdat2img import main as _sdat2img
+from sefcontext import is_binary as is_file_contexts_bin, parse_bin as parse_file_contexts_bin
 
 class PathNotFoundError(OSError):
     pass
 
+class NoSpaceError(OSError):
+    pass
+
 def is_win():
     return os.name == "nt"
 
 def get_bin(program_name):
-    return os.path.join(os.getcwd(), "bin", program_name)
+    # 相对于本文件所在目录 而不是当前工作目录
+    return os.path.join(os.path.dirname(os.path.abspath(__file__)), "bin", program_name)
 
 def check_file(*file_path):
     for fp in file_path:
@@ -38,6 +47,14 @@ def mkdir(path):
             return
     os.makedirs(path)
 
+def cache_dir(*names):
+    # 构建之间共用的缓存目录 默认为 ~/.cache/OTA-maker, 可用环境变量 OTA_MAKER_CACHE 指定
+    root = os.environ.get("OTA_MAKER_CACHE") or \
+        os.path.join(os.path.expanduser("~"), ".cache", "OTA-maker")
+    path = os.path.join(root, *names)
+    mkdir(path)
+    return path
+
 def remove_path(path):
     # 移除文件/目录(如果存在的话)
     if os.path.isdir(path):
@@ -45,6 +62,27 @@ def remove_path(path):
     elif os.path.exists(path):
         os.remove(path)
 
+def get_size(path):
+    # 计算文件/目录实际占用的磁盘空间(稀疏文件只计算已分配的部分)
+    def _size(st):
+        if hasattr(st, "st_blocks"):
+            return st.st_blocks * 512
+        return st.st_size
+    if not os.path.isdir(path):
+        return _size(os.lstat(path)) if os.path.lexists(path) else 0
+    total = 0
+    for root, dirs, files in os.walk(path):
+        for f in files:
+            total += _size(os.lstat(os.path.join(root, f)))
+    return total
+
+def human_size(size):
+    for unit in ("B", "KB", "MB", "GB"):
+        if size < 1024:
+            return "%.1f %s" % (size, unit)
+        size /= 1024
+    return "%.1f TB" % size
+
 def file2file(src, dst, move=False):
     # 复制文件到文件
     # move为True时移动文件而不是复制文件
@@ -65,10 +103,68 @@ def extract_zip(file_path):
     # 解压zip文件
     check_file(file_path)
     extract_path = tempfile.mkdtemp("", "OTA-maker_")
-    with zipfile.ZipFile(file_path, "r") as zip:
-        zip.extractall(extract_path)
+    extract_members(file_path, extract_path)
     return extract_path
 
+def member_path(dest, filename):
+    # 与 ZipFile.extractall 相同: 去掉盘符, 开头的 / 以及 . 和 .. , 防止写到 dest 之外
+    parts = [p for p in os.path.splitdrive(filename)[1].replace("\\", "/").split("/")
+             if p not in ("", ".", "..")]
+    return os.path.join(dest, *parts)
+
+def extract_members(file_path, dest, infos=None, workers=None, stage=None):
+    # 多线程解压 zip 中的条目(infos 为 ZipInfo 列表, 默认全部)到 dest
+    # 每个线程各自打开一个 zip 句柄, 条目从大到小分配, 输出文件预先分配空间
+    # 与 ZipFile.extractall 相同, 目录条目只创建目录, 不恢复权限和修改时间
+    # stage 为 progress.Stage 对象(可选) 每解压一个条目更新一次
+    # 返回 (文件数, 解压后的字节数, 耗时)
+    start = time.perf_counter()
+    if infos is None:
+        with zipfile.ZipFile(file_path, "r") as zip:
+            infos = zip.infolist()
+    files = []
+    for info in infos:
+        if info.is_dir():
+            mkdir(member_path(dest, info.filename))
+            if stage:
+                stage.advance(1, 0)
+        else:
+            files.append(info)
+    files.sort(key=lambda i: i.file_size, reverse=True)
+    local = threading.local()
+    handles = []
+    lock = threading.Lock()
+
+    def _extract(info):
+        if not hasattr(local, "zip"):
+            local.zip = zipfile.ZipFile(file_path, "r")
+            with lock:
+                handles.append(local.zip)
+        dst = member_path(dest, info.filename)
+        os.makedirs(os.path.dirname(dst), exist_ok=True)
+        with local.zip.open(info) as src, open(dst, "wb") as f:
+            if info.file_size:
+                try:
+                    os.posix_fallocate(f.fileno(), 0, info.file_size)
+                except (AttributeError, OSError):
+                    f.truncate(info.file_size)
+            shutil.copyfileobj(src, f, 1024 * 1024)
+        if stage:
+            stage.advance(1, info.file_size)
+
+    try:
+        with ThreadPoolExecutor(max(1, min(workers or os.cpu_count() or 1, len(files)))) as executor:
+            list(executor.map(_extract, files))
+    finally:
+        for zip in handles:
+            zip.close()
+    return len(files), sum(i.file_size for i in files), time.perf_counter() - start
+
+def throughput(files, size, seconds):
+    # extract_members 返回值的文字说明
+    return "%d files, %s in %.1fs (%s/s)" % (files, human_size(size), seconds,
+                                              human_size(size / seconds if seconds else 0))
+
 def extract_brotli(file_path):
     # 解压 *.br 压缩文件
     check_file(file_path)
@@ -84,16 +180,18 @@ def extract_brotli(file_path):
         raise Exception("%s: Failed to extract this file!" % file_path)
     return extract_path
 
-def extract_sdat(file_path):
+def extract_sdat(file_path, progress=None):
     # 解包 *.new.dat 文件
+    # progress 为每写入一段数据后调用的函数, 参数为写入的字节数
     check_file(file_path)
     OUTPUT_IMAGE_FILE = file_path[:-8] + ".img"
     TRANSFER_LIST_FILE = file_path[:-8] + ".transfer.list"
     _sdat2img(TRANSFER_LIST_FILE, file_path, OUTPUT_IMAGE_FILE,
-              silent_mode=True)
+              silent_mode=True, progress=progress)
     return OUTPUT_IMAGE_FILE
 
-def extract_img(file_path):
+def extract_img(file_path, readonly=False):
+    # readonly 为 True 时只读挂载(Windows下没有区别)
     check_file(file_path)
     out_path=file_path[:-4]
     mkdir(out_path)
@@ -106,46 +204,56 @@ def extract_img(file_path):
             raise Exception("Failed to extract %s with imgextractor.exe!" %file_path)
     else:
         # 挂载 *.img 
-        print("Mounting ext4 image...")
         exit_code = os.system(" ".join((
-            "sudo", "mount", file_path, out_path, "-o", "loop,rw", "-t", "ext4"
+            "sudo", "mount", file_path, out_path, "-o", "loop,ro" if readonly else "loop,rw", "-t", "ext4"
         )))
         if exit_code != 0:
             raise Exception("Failed to mount %s" %file_path)
     return out_path
 
-def extract_bootimg(file_path):
-    # 解包boot.img文件
-    check_file(file_path)
-    bimg_path = os.path.split(file_path)[0] + '/bootimg_extract'
-    mkdir(bimg_path)
-    out_dir = bimg_path + '/ramdisk'
-    workdir_bak = os.getcwd()
-    os.chdir(bimg_path)
-    unpack_bootimg(file_path, directory = out_dir)
-    os.chdir(workdir_bak)
-    return out_dir
-
-def make_zip(path, zip_path):
+def umount_img(path):
+    # 卸载由 extract_img 挂载的镜像
+    # 仅用于Linux环境
+    os.system(" ".join(("sudo", "umount", path)))
+
+def make_zip(path, zip_path, passthrough=(), progress=None):
     # 打包zip文件
     # 打包目录下的所有文件和目录 而并非打包目录本身
+    # passthrough 为 (RomZip, 条目名[, 输出中的条目名]) 列表, 这些条目直接从源zip复制
+    # progress 为 Progress 对象(可选) 用于报告打包进度
     if not os.path.isdir(path):
         raise PathNotFoundError("%s: No such directory" %path)
     if os.path.exists(zip_path):
         remove_path(zip_path)
+    file_list = []
+    for root, dirs, files in os.walk(path, topdown=True):
+        for f in files:
+            f_fullpath = os.path.join(root, f)
+            file_list.append((f_fullpath, os.path.getsize(f_fullpath)))
+    stage = None
+    if progress:
+        stage = progress.stage("zip", len(file_list) + len(passthrough),
+                               sum(size for f, size in file_list) +
+                               sum(entry[0].getinfo(entry[1]).file_size for entry in passthrough))
     with zipfile.ZipFile(zip_path, "w") as zip:
-        for root, dirs, files in os.walk(path, topdown=True):
-            for f in files:
-                f_fullpath = os.path.join(root, f)
-                # diff文件不再压缩(因为已经被gz压缩过了)
-                if f.endswith(".p"):
-                    zip.write(f_fullpath,
-                              arcname=f_fullpath.replace(path, "", 1),
-                              compress_type=zipfile.ZIP_STORED)
-                else:
-                    zip.write(f_fullpath,
-                              arcname=f_fullpath.replace(path, "", 1),
-                              compress_type=zipfile.ZIP_DEFLATED)
+        for f_fullpath, size in file_list:
+            # diff文件不再压缩(因为已经被gz压缩过了)
+            if f_fullpath.endswith(".p"):
+                zip.write(f_fullpath,
+                          arcname=f_fullpath.replace(path, "", 1),
+                          compress_type=zipfile.ZIP_STORED)
+            else:
+                zip.write(f_fullpath,
+                          arcname=f_fullpath.replace(path, "", 1),
+                          compress_type=zipfile.ZIP_DEFLATED)
+            if stage:
+                stage.advance(1, size)
+        for rom, name, *arcname in passthrough:
+            rom.copy_to(zip, name, *arcname)
+            if stage:
+                stage.advance(1, rom.getinfo(name).file_size)
+    if stage:
+        stage.finish()
     return zip_path
 
 def read_statfile(path, def_sys_root = '/system'):
@@ -169,36 +277,67 @@ def read_statfile(path, def_sys_root = '/system'):
             # 最终返回的字典 以文件相对路径为key 其他信息的列表为value
     return save_dic
 
+# 已编译的 file_contexts (内容的sha1, t_root) -> 属性键值字典, 常驻进程中多次构建共用
+_file_contexts_compiled = {}
+
 def get_file_contexts(file_path, t_root=''):
-    # 解析file_contexts文件 生成属性键值字典
+    # 解析file_contexts或file_contexts.bin文件 生成属性键值字典
     check_file(file_path)
-    # 如果是*.bin文件则先进行转换
-    if os.path.basename(file_path).endswith(".bin"):
-        fpath = file_path[:-4]
-        if is_win():
-            os.system(" ".join((
-                get_bin("sefcontext_decompile.exe"), "-o", fpath, file_path
-            )))
-        else:
-            os.system(" ".join((
-                get_bin("sefcontext_decompile"), "-o", fpath, file_path
-            )))
+    with open(file_path, "rb") as f:
+        return load_file_contexts(f.read(), t_root)
+
+def load_file_contexts(data, t_root=''):
+    # data 为 file_contexts 或 file_contexts.bin 的内容
+    # 解析出的规则按内容的 sha1 缓存在磁盘上, 编译后的正则缓存在进程中
+    key = hashlib.sha1(data).hexdigest()
+    if (key, t_root) not in _file_contexts_compiled:
+        _file_contexts_compiled[(key, t_root)] = compile_file_contexts(
+            read_file_contexts_rules(data, key), t_root)
+    # 调用者可能会修改返回的字典
+    return OrderedDict(_file_contexts_compiled[(key, t_root)])
+
+def read_file_contexts_rules(data, key):
+    # 返回 [(正则, 属性), ...]
+    cache_path = os.path.join(cache_dir("file_contexts"), key + ".json")
+    try:
+        with open(cache_path, "r", encoding="UTF-8") as f:
+            return [tuple(rule) for rule in json.load(f)]
+    except (OSError, ValueError):
+        pass
+    if is_file_contexts_bin(data):
+        rules = parse_file_contexts_bin(data)
     else:
-        fpath = file_path
+        rules = parse_file_contexts(data.decode("UTF-8", errors="ignore"))
+    try:
+        with open(cache_path + ".tmp", "w", encoding="UTF-8") as f:
+            json.dump(rules, f)
+        os.replace(cache_path + ".tmp", cache_path)
+    except OSError:
+        pass
+    return rules
+
+def parse_file_contexts(text):
+    # 解析file_contexts的文本内容 返回 [(正则, 属性), ...]
+    rules = []
+    for line in text.splitlines():
+        linesp = line.strip()
+        if not linesp or linesp.startswith("#"): continue
+        k, v = linesp.split(maxsplit=1)
+        if v.startswith("--"):
+            v = v.split(maxsplit=1)[-1].strip()
+        rules.append((k, v))
+    return rules
+
+def compile_file_contexts(rules, t_root=''):
+    # 生成属性键值字典
+    # 有 t_root 时每条规则只编译一次: 前缀是可选的, 同时匹配带和不带 t_root 的路径
     sel_dic = OrderedDict()
-    with open(fpath, "r", encoding="UTF-8", errors="ignore") as f:
-        for line in f.readlines():
-            linesp = line.strip()
-            if not linesp or linesp.startswith("#"): continue
-            k, v = linesp.split(maxsplit=1)
-            if k.endswith("(/.*)?"): 
-                tmp_k = k[:-6]
-            else: 
-                tmp_k = k
-            if v.startswith("--"):
-                v = v.split(maxsplit=1)[-1].strip()
-            sel_dic[re.compile(tmp_k)] = v
-            if t_root: sel_dic[re.compile(t_root + tmp_k)] = v
+    for k, v in rules:
+        if k.endswith("(/.*)?"):
+            k = k[:-6]
+        if t_root:
+            k = "(?:%s)?(?:%s)" % (re.escape(t_root), k)
+        sel_dic[re.compile(k)] = v
     return sel_dic
 
 
@@ -212,9 +351,10 @@ def get_selabel_linux(path):
     else:
         return info[0]
 
-def get_selabel_windows(dic, key_set, path):
+def get_selabel_windows(dic, key_set, path, log=print):
     # 通过检索get_file_contexts函数返回的dic
     # 获取path的SE上下文属性 返回最符合的结果
+    # log 接收找不到属性时的警告
     k = ""
     old_length = 0
     for reg in key_set:
@@ -225,7 +365,7 @@ def get_selabel_windows(dic, key_set, path):
                 k = dic[reg]
                 old_length = mat_length
     if not k:
-        print("WARNING: Couldn't find %s's selabel" %path)
+        log("WARNING: Couldn't find %s's selabel" %path)
     return k
 
 def get_build_prop(file_path):
@@ -0,0 +1,49 @@
+#!/usr/bin/env python3
+# encoding: utf-8
+
+import os
+import re
+import zlib
+
+import bsdiff4
+from segdiff import diff_segment
+
+# 估算模式
+# 只解包和比较文件列表, 在一部分补丁候选上实际运行 bsdiff, 按字节数推算全部补丁的大小和耗时,
+# 新文件的压缩率同样按抽样推算, 不生成 OTA 包
+
+# 默认抽样的补丁数和新文件数
+DEFAULT_SAMPLES = 20
+
+def pick_samples(items, count):
+    # 按大小排序后等间隔抽样, 大小不同的文件都有代表
+    items = sorted(items, key=lambda i: (len(i), i.rela_path))
+    if len(items) <= count:
+        return items
+    return [items[(2 * k + 1) * len(items) // (2 * count)] for k in range(count)]
+
+def sample_patch(old_path, new_path, patch_path, window=None):
+    # 在进程池中执行: 生成一个补丁, 返回 (参与 diff 的新数据字节数, 补丁字节数)
+    # window 为分段 diff 的一段 (old_offset, old_length, new_offset, new_length), 大文件只取一段
+    if window:
+        diff_segment(old_path, new_path, patch_path, *window)
+        new_bytes = window[3]
+    else:
+        bsdiff4.file_diff(old_path, new_path, patch_path)
+        new_bytes = os.path.getsize(new_path)
+    size = os.path.getsize(patch_path)
+    os.remove(patch_path)
+    return new_bytes, size
+
+def deflated_size(path):
+    # 在进程池中执行: 返回 (文件大小, 以 zip 默认级别压缩后的大小)
+    with open(path, 'rb') as f:
+        data = f.read()
+    return len(data), len(zlib.compress(data))
+
+def script_members(script):
+    # 原版 updater-script 中解包的条目名, 这些条目原样复制到 OTA 包中
+    return re.findall(r'package_extract_(?:file|dir)\s*\(\s*"([^"]+)"', script)
+
+def ratio(part, whole):
+    return part / whole if whole else 0
@@ -9,6 +9,7 @@ class FileInfo:
 
     def __init__(self, path, root_path):
         self.uid = self.gid = self.perm = self.slink= self.sha1 = self.old_sha1 = self.selabel = ""
+        self.size = None
         # 文件绝对路径
         self.path = path
         # 文件相对于"/"的路径
@@ -33,7 +34,24 @@ class FileInfo:
         return hash(self.rela_path)
 
     def __len__(self):
-        return os.stat(self.path).st_size
+        # 大小在第一次取得后缓存, 源文件被提前释放后仍然可用
+        if self.size is None:
+            self.size = os.stat(self.path).st_size
+        return self.size
+
+    def to_record(self):
+        # 缓存扫描和哈希结果用的记录
+        return [self.rela_path, self.uid, self.gid, self.perm, self.slink, self.sha1, self.size]
+
+    @classmethod
+    def from_record(cls, record, root_path):
+        # 由 to_record 的结果恢复 不访问文件
+        info = cls.__new__(cls)
+        info.rela_path, info.uid, info.gid, info.perm, info.slink, info.sha1, info.size = record
+        info.path = root_path + info.rela_path
+        info.filename = os.path.split(info.path)[1]
+        info.old_sha1 = info.selabel = ""
+        return info
 
     def set_info(self, info_list):
         self.uid, self.gid, self.perm, self.slink = info_list
@@ -44,7 +62,9 @@ class FileInfo:
             if not os.access(self.path, os.R_OK):
                 os.system("sudo chmod +r %s" % self.path)
             with open(self.path, "rb") as f:
-                self.sha1 = hashlib.sha1(f.read()).hexdigest()
+                data = f.read()
+            self.sha1 = hashlib.sha1(data).hexdigest()
+            self.size = len(data)
         else:
             self.sha1 = 'isdirorsym'
         return self.sha1
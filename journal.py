@@ -0,0 +1,122 @@
+#!/usr/bin/env python3
+# encoding: utf-8
+
+import json
+import os
+import threading
+
+from artifacts import read_json, write_json
+from common import is_win, mkdir, remove_path, umount_img
+
+# 可恢复构建的工作目录
+#   build.json   本次构建的输入(文件大小, 修改时间, 影响中间结果的参数)
+#   journal      已完成的工作单元, 每行一个 JSON: [类型, 键, 值]
+#   manifests/   各分区扫描和哈希的结果
+#   old/ new/ ota/ 解包目录和 OTA 打包目录
+# 每完成一个单元追加一行, 异常退出时最后一行可能不完整, 读取时忽略
+# 输入与 build.json 不一致时清空工作目录重新开始
+
+class JournalError(ValueError):
+    pass
+
+class Journal:
+
+    def __init__(self, workdir, inputs):
+        # inputs 为可序列化为 JSON 的输入描述, 见 build_inputs
+        self.workdir = os.path.abspath(workdir)
+        self.lock = threading.Lock()
+        self.units = {}
+        mkdir(self.workdir)
+        build = read_json(self.path('build.json'))
+        if build is None and os.listdir(self.workdir):
+            # 不是工作目录, 不能清空
+            raise JournalError('%s: not empty and not an OTA-maker work directory' % workdir)
+        umount_stale(self.workdir)
+        self.resumed = build == inputs
+        # 工作目录属于另一次构建, 已清空
+        self.discarded = build is not None and not self.resumed
+        if not self.resumed:
+            self.clear()
+            write_json(self.path('build.json'), inputs)
+        else:
+            self.load()
+        mkdir(self.path('manifests'))
+        self.file = open(self.path('journal'), 'a', encoding='UTF-8', newline='\n')
+
+    def path(self, *names):
+        return os.path.join(self.workdir, *names)
+
+    def load(self):
+        try:
+            with open(self.path('journal'), 'r', encoding='UTF-8') as f:
+                lines = f.readlines()
+        except OSError:
+            return
+        for line in lines:
+            try:
+                kind, key, value = json.loads(line)
+            except ValueError:
+                break
+            self.units[(kind, key)] = value
+
+    def get(self, kind, key, default=None):
+        # 返回已完成的单元记录的值, 未完成时返回 default
+        return self.units.get((kind, key), default)
+
+    def done(self, kind, key):
+        return (kind, key) in self.units
+
+    def count(self, kind):
+        return sum(1 for k in self.units if k[0] == kind)
+
+    def record(self, kind, key, value=True):
+        # 写入磁盘后才算完成, 进程被杀死或断电时不会丢失已记录的单元
+        line = json.dumps([kind, key, value]) + '\n'
+        with self.lock:
+            self.units[(kind, key)] = value
+            self.file.write(line)
+            self.file.flush()
+            os.fsync(self.file.fileno())
+
+    def store_manifest(self, name, root, items):
+        write_json(self.path('manifests', name + '.json'),
+                   {'root': root, 'files': sorted(item.to_record() for item in items)})
+
+    def load_manifest(self, name):
+        return read_json(self.path('manifests', name + '.json'))
+
+    def close(self):
+        if self.file:
+            self.file.close()
+            self.file = None
+
+    def clear(self):
+        # 删除工作目录中的全部内容, 保留目录本身
+        with self.lock:
+            self.units = {}
+            if getattr(self, 'file', None):
+                self.file.close()
+                self.file = None
+            for name in os.listdir(self.workdir):
+                remove_path(os.path.join(self.workdir, name))
+
+def umount_stale(workdir):
+    # 进程被杀死时分区目录仍然挂载着, 恢复或清空之前先卸载
+    # 挂载点只在 old/ new/ 下一层
+    if is_win():
+        return
+    for side in os.listdir(workdir):
+        side = os.path.join(workdir, side)
+        if not os.path.isdir(side) or os.path.islink(side):
+            continue
+        for name in os.listdir(side):
+            if os.path.ismount(os.path.join(side, name)):
+                umount_img(os.path.join(side, name))
+
+def build_inputs(version, files, **params):
+    # files 为 名称 -> 文件路径, 以绝对路径, 大小和修改时间识别
+    inputs = {'version': version, 'params': params, 'files': {}}
+    for name, path in sorted(files.items()):
+        st = os.stat(path)
+        inputs['files'][name] = [os.path.abspath(path), st.st_size, st.st_mtime_ns]
+    return inputs
@@ -1,15 +1,33 @@
 #!/usr/bin/env python3
 # encoding: utf-8
 
+import argparse
+import bisect
 import os
+import re
 import sys
 import bsdiff4
 import hashlib
 import tempfile
+import time
+from artifacts import ArtifactCache
+from blockimg import BLOCK_SIZE, BlockImageError, apply_block_image, is_incremental, read_transfer_list
+from bootimg import read_ramdisk_files
 from common import *
+from concurrent.futures import ThreadPoolExecutor
+from estimate import DEFAULT_SAMPLES, deflated_size, pick_samples, ratio, sample_patch, script_members
 from multiprocessing import Pool
 from fileinfo import FileInfo
-from updater import Updater
+from journal import Journal, JournalError, build_inputs
+from partition import (PARTITION_ORDER, PartitionStats, discover_partitions, format_stats,
+                       partition_of, sort_partitions, timed_call)
+from payload import extract_partitions
+from progress import Progress, json_sink, tty_sink
+from romzip import RomZip
+from scratch import Scratch
+from segdiff import diff_segment, split_segments
+from simg2img import expanded_size, is_sparse_file, unsparse_file
+from updater import Updater, batched
 
 __version__ = "1.0.10"
 
@@ -17,373 +35,1126 @@ __version__ = "1.0.10"
 do_not_patch_set = {"build.prop", "recovery-from-boot.p", "install-recovery.sh",
                     "backuptool.functions", "backuptool.sh"}
 
-def main(OLD_ZIP, NEW_ZIP, OUT_PATH):
+# 分段 diff: 大于 SEGMENT_SIZE * SEGMENT_THRESHOLD 的文件按 SEGMENT_SIZE 分段并行生成补丁
+# 每段对应的旧文件窗口前后各扩展 SEGMENT_MARGIN
+SEGMENT_SIZE = 16 * 1024 * 1024
+SEGMENT_THRESHOLD = 4
+SEGMENT_MARGIN = 1024 * 1024
+
+# 设备端安装补丁的方式
+# extract: 先把 patch/ 整个解压到 /tmp 再逐个打补丁
+# stream: 按补丁大小逐个解压, 打补丁后立即删除, /tmp 峰值占用只取决于最大的补丁
+PATCH_STRATEGIES = ('extract', 'stream')
+
+# install/patches 的各列以空格分隔, 路径中有空白, 引号或反斜杠的文件不打补丁, 整个打包
+UNSAFE_MANIFEST_PATH = re.compile(r'[\s\'"\\]')
+
+# 卡刷包中原版的安装脚本
+SOURCE_SCRIPT = 'META-INF/com/google/android/updater-script'
+
+def main(OLD_ZIP, NEW_ZIP, OUT_PATH, tmpdir=None, fast_tmpdir=None,
+         log=print, pool=None, progress=None, segment_size=SEGMENT_SIZE,
+         patch_strategy='extract', instrument=False, patch_jobs=1, old_base_images=None,
+         new_base_images=None, artifact_cache=None, workdir=None, estimate=0):
+    # 也可作为库函数调用:
+    # log 接收进度信息(默认输出到标准输出),
+    # pool 为调用者持有的进程池, 为 None 时本次构建单独创建
+    # progress 为 Progress 对象, 报告各阶段的条目数, 字节数和剩余时间
+    # segment_size 为分段 diff 的段大小, 为 0 时不分段
+    # patch_strategy 为设备端安装补丁的方式, 见 PATCH_STRATEGIES
+    # instrument 为 True 时生成的脚本记录各阶段的耗时和写入量
+    # patch_jobs 为设备端同时打补丁的任务数, 内存不足时设备端退回逐个执行
+    # old_base_images, new_base_images 为 分区名 -> 基础镜像路径, 分别用于旧ROM和新ROM,
+    # ROM 为增量的块 OTA 时由基础镜像得到分区镜像
+    # artifact_cache 为 ArtifactCache 对象(可选), 缓存旧ROM解码后的镜像和哈希结果
+    # workdir 为工作目录(可选), 记录已完成的步骤, 中断后以相同的参数再次运行时从中断处继续
+    # estimate 大于 0 时只比较文件列表, 按抽样的补丁数估算结果并返回(dict), 不生成 OTA 包
+    # 构建失败时同样清理临时文件, 避免常驻进程中积累 工作目录中的文件只卸载, 不删除
+    scratch = Scratch(tmpdir, fast_tmpdir, workdir)
+    try:
+        return make_ota(OLD_ZIP, NEW_ZIP, OUT_PATH, scratch, log, pool,
+                        progress or Progress(), segment_size, patch_strategy,
+                        instrument, patch_jobs, old_base_images or {}, new_base_images or {},
+                        artifact_cache, estimate)
+    finally:
+        scratch.cleanup()
+
+def make_ota(OLD_ZIP, NEW_ZIP, OUT_PATH, scratch, log, pool, progress, segment_size,
+             patch_strategy, instrument, patch_jobs, old_base_images, new_base_images, artifact_cache,
+             estimate):
+    start_time = time.perf_counter()
     check_file(OLD_ZIP, NEW_ZIP)
-    print('Unpacking %s ...' %OLD_ZIP)
-    OLD_ZIP_PATH = extract_zip(OLD_ZIP)
-    print('Unpacking %s ...' %NEW_ZIP)
-    NEW_ZIP_PATH = extract_zip(NEW_ZIP)
-
-    HAS_IMG = True
-    IS_TREBLE = False
-
-    if not os.path.exists(NEW_ZIP_PATH + '/system/app'):
-        print('Extracting *.br and *.new.dat ...')
-        unpack_to_img(OLD_ZIP_PATH)
-        unpack_to_img(NEW_ZIP_PATH)
-        print('Extracting system partition EXT4 Image...')
-        extract_img(NEW_ZIP_PATH + '/system.img')
-        if not os.path.exists(OLD_ZIP_PATH + '/system/app'):
-            extract_img(OLD_ZIP_PATH + '/system.img')
-    else:
-        HAS_IMG = False
-
-    if os.path.exists(NEW_ZIP_PATH + '/vendor.img'):
-        print('Found Project-Treble supported device')
-        IS_TREBLE = True
-        print('Extracting vendor partition EXT4 Image...')
-        extract_img(NEW_ZIP_PATH + '/vendor.img')
-        if os.path.exists(OLD_ZIP_PATH + '/vendor.img'):
-            extract_img(OLD_ZIP_PATH + '/vendor.img')
-
-    # 检查 system-as-root 设备
-    if os.path.exists(NEW_ZIP_PATH + '/system/default.prop'):
-        IS_SYS_AS_ROOT = True
-        print('Found system-as-root device')
-        if not is_win():
-            print('Found system-as-root device, remounting system partition')
-            mkdir(OLD_ZIP_PATH + '/system_root')
-            mkdir(NEW_ZIP_PATH + '/system_root')
-            os.system(" ".join(('sudo', 'umount', OLD_ZIP_PATH + '/system')))
-            os.system(" ".join(('sudo', 'umount', NEW_ZIP_PATH + '/system')))
-            os.system(" ".join(('sudo', 'mount',
-                    OLD_ZIP_PATH + '/system.img',
-                    OLD_ZIP_PATH + '/system_root',
-                    '-o', 'rw,loop')))
-            os.system(" ".join(('sudo', 'mount',
-                    NEW_ZIP_PATH + '/system.img',
-                    NEW_ZIP_PATH + '/system_root',
-                    '-o', 'rw,loop')))
+    journal = None
+    if scratch.workdir:
+        # 输入的文件或影响中间结果的参数变化时工作目录作废
+        inputs = dict(('old-base-image ' + p, path) for p, path in old_base_images.items())
+        inputs.update(('new-base-image ' + p, path) for p, path in new_base_images.items())
+        inputs.update({'old': OLD_ZIP, 'new': NEW_ZIP})
+        journal = Journal(scratch.workdir, build_inputs(__version__, inputs, segment_size=segment_size))
+        if journal.resumed:
+            log('Resuming the build in %s' % scratch.workdir)
+        elif journal.discarded:
+            log('Inputs changed, discarding the previous build in %s' % scratch.workdir)
+    # 异常退出时同样关闭 zip 并结束本次创建的进程池, 作为库调用时不残留工作进程
+    old_rom = RomZip(OLD_ZIP, scratch.mkdtemp(name='old'))
+    new_rom = tp_executor = None
+    try:
+        new_rom = RomZip(NEW_ZIP, scratch.mkdtemp(name='new'))
+        OLD_ZIP_PATH = old_rom.extract_path
+        NEW_ZIP_PATH = new_rom.extract_path
+        # 旧ROM命中缓存时不再解包和解码, 直接使用缓存的镜像和哈希结果
+        old_key = old_cached = old_entry = None
+        if artifact_cache:
+            old_key = artifact_cache.key(OLD_ZIP, old_base_images)
+            old_cached = artifact_cache.lookup(old_key)
+        # 空间不足时在解压前就失败 中断前已解压的不再计算
+        unpacked = lambda stage_name: journal is not None and journal.done('unpack', stage_name)
+        scratch.check_space((0 if old_cached or unpacked('extract old') else old_rom.projected_size()) +
+                            (0 if unpacked('extract new') else new_rom.projected_size()))
+        # payload.bin 的解码和补丁生成共用进程池
+        tp_executor = pool or Pool()
+        log('Unpacking %s ...' %NEW_ZIP)
+        HAS_IMG = unpack_rom(new_rom, progress, 'extract new', tp_executor, log, journal)
+
+        # 镜像形式的ROM按传输列表和解出的镜像找出所有分区, 目录形式的ROM只有 system
+        if HAS_IMG:
+            partitions = discover_partitions(os.listdir(NEW_ZIP_PATH))
+            if 'system' not in partitions:
+                raise PathNotFoundError('%s: system partition not found' % NEW_ZIP)
         else:
-            os.rename(OLD_ZIP_PATH + '/system', OLD_ZIP_PATH + '/system_root')
-            os.rename(OLD_ZIP_PATH + '/system_statfile.txt', OLD_ZIP_PATH + '/system_root_statfile.txt')
-            os.rename(NEW_ZIP_PATH + '/system', NEW_ZIP_PATH + '/system_root')
-            os.rename(NEW_ZIP_PATH + '/system_statfile.txt', NEW_ZIP_PATH + '/system_root_statfile.txt')
-        SYSTEM_ROOT = "/system_root"
-    else:
-        IS_SYS_AS_ROOT = False
-        SYSTEM_ROOT = '/system'
+            partitions = ['system']
+        stats = OrderedDict((p, PartitionStats(p)) for p in partitions)
+        log('Partitions: %s' % ', '.join(partitions))
 
-    # 读取 ROM 中的 build.prop
-    print("Getting ROM information...")
-    if not IS_SYS_AS_ROOT:
-        build_prop_dict = get_build_prop(NEW_ZIP_PATH + SYSTEM_ROOT + '/build.prop')
-    else:
-        build_prop_dict = get_build_prop(NEW_ZIP_PATH + SYSTEM_ROOT + '/system/build.prop')
-    info_sdk_version = build_prop_dict.get("ro.build.version.sdk")
-    info_build_version_release = build_prop_dict.get('ro.build.version.release')
-    info_build_fingerprint = build_prop_dict.get('ro.build.fingerprint')
-    info_product_device = build_prop_dict.get('ro.product.device')
-    info_build_product = build_prop_dict.get('ro.build.product')
-    if info_product_device == "None":
-        info_product_device = build_prop_dict.get('ro.product.system.device')
-    if info_build_product == "None":
-        info_build_product = build_prop_dict.get('ro.system.build.product')
-    
-    print('------ ROM Info -------')
-    print('Device: %s' %info_product_device)
-    print('Product: %s' %info_build_product)
-    print('Android Version: %s' %info_build_version_release)
-    print('API level: %s' %info_sdk_version)
-    print('Fingerprint: %s' %info_build_fingerprint)
-    print('')
-
-    # 取得文件列表并存储为集合
-    print('Comparing system partition...')
-    # 如果是Windows, 取 statfile.txt 作为字典，在get_fileinfo_set中传入
-    if HAS_IMG and is_win():
-        system_dict = read_statfile(NEW_ZIP_PATH + SYSTEM_ROOT, def_sys_root=SYSTEM_ROOT)
-    else:
-        system_dict = {}
-    old_system_set = get_fileinfo_set(OLD_ZIP_PATH, OLD_ZIP_PATH + SYSTEM_ROOT, system_dict)
-    new_system_set = get_fileinfo_set(NEW_ZIP_PATH, NEW_ZIP_PATH + SYSTEM_ROOT, system_dict)
-    # 去除相同的文件
-    diff_set = old_system_set.symmetric_difference(new_system_set)
-    if IS_TREBLE:
-        print('Comparing vendor partition...')
-        if HAS_IMG and is_win():
-            vendor_dict = read_statfile(NEW_ZIP_PATH + '/vendor', def_sys_root='/vendor')
+        # 缓存中只有当时用到的分区, 旧ROM中还有本次需要的其他分区时重新解包
+        if old_cached and not (HAS_IMG and set(partitions) & set(old_cached['available'])
+                               <= set(old_cached['partitions'])):
+            old_cached = None
+            if not unpacked('extract old'):
+                scratch.check_space(old_rom.projected_size())
+        if old_cached:
+            log('Using cached artifacts of %s' %OLD_ZIP)
+            OLD_HAS_IMG = True
         else:
-            vendor_dict = {}
-        old_vendor_set = get_fileinfo_set(OLD_ZIP_PATH, OLD_ZIP_PATH + '/vendor', vendor_dict)
-        new_vendor_set = get_fileinfo_set(NEW_ZIP_PATH, NEW_ZIP_PATH + '/vendor', vendor_dict)
-        diff_set = diff_set | old_vendor_set.symmetric_difference(new_vendor_set)
-
-    OTA_ZIP_PATH = tempfile.mkdtemp("", "OTA-maker_")
-
-    print('Reading the difference file list...')
-    print('Copying files and generating patches...')
-    patch_set = set(); rem_set = set(); sym_set = set(); new_set = set()
-    old_sha1_dict = {}
-    tp_executor = Pool()
-    for tmp_item in diff_set:
-        if OLD_ZIP_PATH in tmp_item.path:
-            if not os.path.exists(NEW_ZIP_PATH + tmp_item.rela_path):
-                rem_set.add(tmp_item)
+            log('Unpacking %s ...' %OLD_ZIP)
+            OLD_HAS_IMG = unpack_rom(old_rom, progress, 'extract old', tp_executor, log, journal)
+            if artifact_cache and OLD_HAS_IMG:
+                old_entry = artifact_cache.begin(old_key)
+                old_available = discover_partitions(os.listdir(OLD_ZIP_PATH))
+                # 构建失败时随临时文件一起删除未完成的缓存项
+                scratch.retain(old_entry.tmp_path)
+        scratch.account('extract', OLD_ZIP_PATH, NEW_ZIP_PATH)
+
+        if HAS_IMG:
+            # 各分区的 解码 -> 镜像 互不依赖, 新旧ROM的所有分区同时进行
+            log('Extracting *.br, *.new.dat and EXT4 images...')
+            with ThreadPoolExecutor(len(partitions) * 2) as executor:
+                jobs = [executor.submit(prepare_partition, NEW_ZIP_PATH, p, scratch, progress, stats[p],
+                                        new_base_images.get(p), None, journal)
+                        for p in partitions]
+                if old_cached:
+                    jobs += [executor.submit(mount_cached_partition, OLD_ZIP_PATH, p,
+                                             artifact_cache.path(old_key, p))
+                             for p in partitions if p in old_cached['partitions']]
+                elif OLD_HAS_IMG:
+                    jobs += [executor.submit(prepare_partition, OLD_ZIP_PATH, p, scratch, progress, stats[p],
+                                             old_base_images.get(p), old_entry, journal)
+                             for p in partitions]
+                for job in jobs:
+                    job.result()
+            scratch.account('decode', OLD_ZIP_PATH, NEW_ZIP_PATH)
+
+        # 检查 system-as-root 设备
+        # Windows 下中断后恢复时 system 已改名为 system_root
+        if os.path.exists(NEW_ZIP_PATH + '/system/default.prop') or \
+           (is_win() and os.path.exists(NEW_ZIP_PATH + '/system_root/default.prop')):
+            IS_SYS_AS_ROOT = True
+            log('Found system-as-root device')
+            if not is_win():
+                log('Found system-as-root device, remounting system partition')
+                mkdir(OLD_ZIP_PATH + '/system_root')
+                mkdir(NEW_ZIP_PATH + '/system_root')
+                os.system(" ".join(('sudo', 'umount', OLD_ZIP_PATH + '/system')))
+                os.system(" ".join(('sudo', 'umount', NEW_ZIP_PATH + '/system')))
+                # 缓存中的镜像只读挂载
+                os.system(" ".join(('sudo', 'mount',
+                        OLD_ZIP_PATH + '/system.img',
+                        OLD_ZIP_PATH + '/system_root',
+                        '-o', 'ro,loop' if old_cached else 'rw,loop')))
+                os.system(" ".join(('sudo', 'mount',
+                        NEW_ZIP_PATH + '/system.img',
+                        NEW_ZIP_PATH + '/system_root',
+                        '-o', 'rw,loop')))
             else:
-                old_sha1_dict[tmp_item.rela_path] = tmp_item.sha1
+                for zip_path in (OLD_ZIP_PATH, NEW_ZIP_PATH):
+                    if os.path.exists(zip_path + '/system'):
+                        os.rename(zip_path + '/system', zip_path + '/system_root')
+                        os.rename(zip_path + '/system_statfile.txt', zip_path + '/system_root_statfile.txt')
+            SYSTEM_ROOT = "/system_root"
         else:
-            if tmp_item.slink:
-                sym_set.add(tmp_item)
-                rem_set.add(tmp_item)
-            elif not os.path.exists(OLD_ZIP_PATH + tmp_item.rela_path) or tmp_item.filename in do_not_patch_set:
-                new_file_path = OTA_ZIP_PATH + tmp_item.rela_path
-                if not os.path.isdir(NEW_ZIP_PATH + tmp_item.rela_path):
-                    mkdir(os.path.split(new_file_path)[0])
-                    file2file(NEW_ZIP_PATH + tmp_item.rela_path, new_file_path)
-                new_set.add(tmp_item)
-            else:
-                patch_set.add(tmp_item)
-                ota_patch_path = OTA_ZIP_PATH + '/patch' + tmp_item.rela_path + '.p'
-                mkdir(os.path.split(ota_patch_path)[0])
-                tp_executor.apply_async(bsdiff4.file_diff, 
-                                    (OLD_ZIP_PATH + tmp_item.rela_path,
-                                     NEW_ZIP_PATH + tmp_item.rela_path,
-                                     ota_patch_path))
-    tp_executor.close()
-    tp_executor.join()
-
-    print('Reading SELinux context...')
-    if not is_win() and HAS_IMG:
-        for tmp_item in new_set:
-            tmp_item.selabel = get_selabel_linux(tmp_item.path)
-    else:
-        if IS_SYS_AS_ROOT: 
-            tmp_root = SYSTEM_ROOT
+            IS_SYS_AS_ROOT = False
+            SYSTEM_ROOT = '/system'
+
+        # 分区名 -> 分区目录在ROM中的路径(也是设备上的挂载点)
+        roots = OrderedDict((p, SYSTEM_ROOT if p == 'system' else '/' + p) for p in partitions)
+
+        # 登记各分区目录的生命周期 旧目录在补丁生成后释放, 新目录在读取SELinux属性后释放
+        old_trees = [OLD_ZIP_PATH + root for root in roots.values()]
+        new_trees = [NEW_ZIP_PATH + root for root in roots.values()]
+        # 镜像按分区名命名, system 分区的目录可能是 /system_root
+        for zip_path in (OLD_ZIP_PATH, NEW_ZIP_PATH):
+            for p, root in roots.items():
+                retain_tree(scratch, zip_path + root, zip_path + '/' + p + '.img')
+
+        # 读取 ROM 中的 build.prop
+        log("Getting ROM information...")
+        if not IS_SYS_AS_ROOT:
+            build_prop_dict = get_build_prop(NEW_ZIP_PATH + SYSTEM_ROOT + '/build.prop')
         else:
-            tmp_root = ''
-        if os.path.exists(NEW_ZIP_PATH + SYSTEM_ROOT + '/etc/selinux/plat_file_contexts'):
-            tmp_file_context = get_file_contexts(NEW_ZIP_PATH + SYSTEM_ROOT + '/etc/selinux/plat_file_contexts', tmp_root)
-        elif os.path.exists(NEW_ZIP_PATH + SYSTEM_ROOT + '/system/etc/selinux/plat_file_contexts'):
-            tmp_file_context = get_file_contexts(NEW_ZIP_PATH + SYSTEM_ROOT + '/system/etc/selinux/plat_file_contexts', tmp_root)
+            build_prop_dict = get_build_prop(NEW_ZIP_PATH + SYSTEM_ROOT + '/system/build.prop')
+        info_sdk_version = build_prop_dict.get("ro.build.version.sdk")
+        IS_64BIT = '64' in build_prop_dict.get('ro.product.cpu.abi')
+        APPLYPATCH_BIN = get_bin('applypatch_64' if IS_64BIT else 'applypatch')
+        info_build_version_release = build_prop_dict.get('ro.build.version.release')
+        info_build_fingerprint = build_prop_dict.get('ro.build.fingerprint')
+        info_product_device = build_prop_dict.get('ro.product.device')
+        info_build_product = build_prop_dict.get('ro.build.product')
+        if info_product_device == "None":
+            info_product_device = build_prop_dict.get('ro.product.system.device')
+        if info_build_product == "None":
+            info_build_product = build_prop_dict.get('ro.system.build.product')
+        
+        log('------ ROM Info -------')
+        log('Device: %s' %info_product_device)
+        log('Product: %s' %info_build_product)
+        log('Android Version: %s' %info_build_version_release)
+        log('API level: %s' %info_sdk_version)
+        log('Fingerprint: %s' %info_build_fingerprint)
+        log('')
+
+        # 取得文件列表并存储为集合
+        # 各分区新旧两侧的扫描和哈希同时进行
+        log('Comparing partitions...')
+
+        def hashed(side, p, root, func, *args):
+            # 中断后恢复时, 已完成的分区从工作目录读取扫描和哈希的结果
+            zip_path = OLD_ZIP_PATH if side == 'old' else NEW_ZIP_PATH
+            if journal and journal.done('hash', side + '/' + p):
+                data = journal.load_manifest(side + '.' + p)
+                return {FileInfo.from_record(record, zip_path) for record in data['files']}
+            result = func(*args)
+            if journal:
+                journal.store_manifest(side + '.' + p, root, result)
+                journal.record('hash', side + '/' + p)
+            return result
+
+        with ThreadPoolExecutor(len(partitions) * 2) as executor:
+            jobs = []
+            for p, root in roots.items():
+                # 如果是Windows, 取 statfile.txt 作为字典，在get_fileinfo_set中传入
+                if HAS_IMG and is_win():
+                    statfile = read_statfile(NEW_ZIP_PATH + root, def_sys_root=root)
+                else:
+                    statfile = {}
+                if old_cached and p in old_cached['partitions']:
+                    old_job = executor.submit(hashed, 'old', p, root,
+                                              cached_fileinfo_set, artifact_cache, old_key, p, root,
+                                              OLD_ZIP_PATH, statfile, progress, 'hash old %s' % p, stats[p])
+                else:
+                    old_job = executor.submit(hashed, 'old', p, root,
+                                              get_fileinfo_set, OLD_ZIP_PATH, OLD_ZIP_PATH + root, statfile,
+                                              progress, 'hash old %s' % p, stats[p])
+                jobs.append((p, root, old_job,
+                             executor.submit(hashed, 'new', p, root,
+                                             get_fileinfo_set, NEW_ZIP_PATH, NEW_ZIP_PATH + root, statfile,
+                                             progress, 'hash new %s' % p, stats[p])))
+            # 去除相同的文件
+            diff_set = set()
+            for p, root, old_job, new_job in jobs:
+                diff_set |= old_job.result().symmetric_difference(new_job.result())
+                if old_entry and p in old_entry.partitions:
+                    old_entry.store_manifest(p, root, old_job.result())
+        if old_entry:
+            cached_size = old_entry.commit(old_available)
+            if cached_size:
+                log('Cached artifacts of %s (%s)' % (OLD_ZIP, human_size(cached_size)))
+
+        log('Reading the difference file list...')
+        patch_set = set(); rem_set = set(); sym_set = set(); new_set = set()
+        old_sha1_dict = {}
+        old_size_dict = {}
+        # 新文件按内容分组: sha1 -> [FileInfo, ...]
+        new_files = {}
+        # 旧ROM中不存在的目录 只有这些目录的全部内容都在新文件中
+        new_dirs = set()
+        for tmp_item in diff_set:
+            if OLD_ZIP_PATH in tmp_item.path:
+                if not os.path.exists(NEW_ZIP_PATH + tmp_item.rela_path):
+                    rem_set.add(tmp_item)
+                else:
+                    old_sha1_dict[tmp_item.rela_path] = tmp_item.sha1
+                    old_size_dict[tmp_item.rela_path] = len(tmp_item)
+            else:
+                if tmp_item.slink:
+                    sym_set.add(tmp_item)
+                    rem_set.add(tmp_item)
+                elif not os.path.exists(OLD_ZIP_PATH + tmp_item.rela_path) or tmp_item.filename in do_not_patch_set \
+                     or UNSAFE_MANIFEST_PATH.search(tmp_item.rela_path):
+                    if not os.path.isdir(NEW_ZIP_PATH + tmp_item.rela_path):
+                        new_files.setdefault(tmp_item.sha1, []).append(tmp_item)
+                    elif not os.path.exists(OLD_ZIP_PATH + tmp_item.rela_path):
+                        new_dirs.add(tmp_item.rela_path)
+                    new_set.add(tmp_item)
+                else:
+                    patch_set.add(tmp_item)
+        if estimate:
+            report = estimate_ota(OLD_ZIP_PATH, NEW_ZIP_PATH, new_rom, roots, patch_set, new_files,
+                                  rem_set - sym_set, sym_set, old_size_dict, APPLYPATCH_BIN, scratch, log,
+                                  tp_executor, estimate, segment_size, patch_strategy, patch_jobs, start_time)
+            return report
+
+        # OTA 打包目录中是新文件和补丁 补丁不会比目标文件大
+        staging_size = sum(len(i) for i in diff_set
+                           if NEW_ZIP_PATH in i.path and not i.slink)
+        OTA_ZIP_PATH = scratch.mkdtemp(hot=True, size=staging_size, name='ota')
+        scratch.check_space(staging_size, OTA_ZIP_PATH)
+
+        log('Copying files and generating patches...')
+        diff_results = []
+        segment_results = {}
+        diff_stage = progress.stage('diff')
+        # 中断前已生成的补丁数
+        resumed_patches = 0
+
+        def diff_done(tmp_item, nbytes, segment=None):
+            # 进程池的回调 累计补丁所属分区的 diff 时间
+            # 有工作目录时记录完成的补丁, segment 为分段补丁的段号
+            part_stats = stats[partition_of(roots, tmp_item.rela_path)]
+            def _done(r):
+                part_stats.add_time('diff', r[0])
+                diff_stage.advance(1, nbytes)
+                if journal and segment is None:
+                    journal.record('diff', tmp_item.rela_path, tmp_item.sha1)
+                elif journal:
+                    journal.record('segment', '%s:%d' % (tmp_item.rela_path, segment), list(r[1]))
+            return _done
+
+        for tmp_item in patch_set:
+            if segment_size and len(tmp_item) > segment_size * SEGMENT_THRESHOLD:
+                # 大文件分段生成补丁
+                segment_dir = OTA_ZIP_PATH + '/patch' + tmp_item.rela_path + '.seg'
+                mkdir(segment_dir)
+                segments = split_segments(os.path.getsize(OLD_ZIP_PATH + tmp_item.rela_path),
+                                          len(tmp_item), segment_size, SEGMENT_MARGIN)
+                segment_results[tmp_item.rela_path] = []
+                for i, (old_offset, old_length, new_offset, new_length) in enumerate(segments):
+                    done = journal and journal.get('segment', '%s:%d' % (tmp_item.rela_path, i))
+                    if done:
+                        segment_results[tmp_item.rela_path].append((old_offset, old_length,
+                                                                    JournaledResult(tuple(done))))
+                        resumed_patches += 1
+                        continue
+                    diff_stage.total_items += 1
+                    diff_stage.total_bytes += new_length
+                    segment_results[tmp_item.rela_path].append((old_offset, old_length,
+                        tp_executor.apply_async(timed_call,
+                            (diff_segment,
+                             OLD_ZIP_PATH + tmp_item.rela_path,
+                             NEW_ZIP_PATH + tmp_item.rela_path,
+                             '%s/%d.p' % (segment_dir, i),
+                             old_offset, old_length, new_offset, new_length),
+                            callback=diff_done(tmp_item, new_length, i))))
+                continue
+            ota_patch_path = OTA_ZIP_PATH + '/patch' + tmp_item.rela_path + '.p'
+            if journal and journal.get('diff', tmp_item.rela_path) == tmp_item.sha1:
+                resumed_patches += 1
+                continue
+            mkdir(os.path.split(ota_patch_path)[0])
+            diff_stage.total_items += 1
+            diff_stage.total_bytes += len(tmp_item)
+            diff_results.append(tp_executor.apply_async(timed_call,
+                                (bsdiff4.file_diff,
+                                 OLD_ZIP_PATH + tmp_item.rela_path,
+                                 NEW_ZIP_PATH + tmp_item.rela_path,
+                                 ota_patch_path),
+                                callback=diff_done(tmp_item, len(tmp_item))))
+        # 内容相同的新文件只打包路径最小的一份, 刷机时解压后复制到其他位置
+        # 不使用硬链接: 各个路径的 SELinux 属性可能不同
+        copy_dict = OrderedDict()
+        dedup_size = 0
+        for sha1, items in sorted(new_files.items()):
+            items.sort(key=lambda x: x.rela_path)
+            file2file(NEW_ZIP_PATH + items[0].rela_path, OTA_ZIP_PATH + items[0].rela_path)
+            if len(items) > 1:
+                copy_dict[items[0].rela_path] = [i.rela_path for i in items[1:]]
+                dedup_size += len(items[0]) * (len(items) - 1)
+        if copy_dict:
+            log('Identical new files: %d copied on device, %s saved'
+                % (sum(len(c) for c in copy_dict.values()), human_size(dedup_size)))
+        if resumed_patches:
+            log('Patches generated before the interruption: %d' % resumed_patches)
+        for result in diff_results:
+            result.get()
+        # 分段补丁: 文件路径 -> [(旧窗口偏移, 旧窗口大小, 旧窗口sha1, 新段sha1, 新段大小), ...]
+        segmented = {}
+        for rela_path, results in segment_results.items():
+            segmented[rela_path] = [(old_offset, old_length) + result.get()[1]
+                                    for old_offset, old_length, result in results]
+        diff_stage.finish()
+        for counter, items in (('new', new_set), ('patched', patch_set),
+                               ('removed', rem_set - sym_set), ('symlinks', sym_set)):
+            for tmp_item in items:
+                stats[partition_of(roots, tmp_item.rela_path)].count(counter)
+        if pool is None:
+            tp_executor.close()
+            tp_executor.join()
+        scratch.account('staging', OTA_ZIP_PATH)
+        for tree in old_trees:
+            scratch.unref(tree)
+
+        log('Reading SELinux context...')
+        if not is_win() and HAS_IMG:
+            label_partitions(new_set, lambda i: get_selabel_linux(i.path), roots, stats, journal)
         else:
-            boot_out = extract_bootimg(NEW_ZIP_PATH + '/boot.img')
-            if os.path.exists(boot_out + '/file_contexts'):
-                tmp_file_context = get_file_contexts(boot_out + '/file_contexts')
-            elif os.path.exists(boot_out + '/file_contexts.bin'):
-                tmp_file_context = get_file_contexts(boot_out + '/file_contexts.bin')
+            if IS_SYS_AS_ROOT: 
+                tmp_root = SYSTEM_ROOT
             else:
-                tmp_file_context = {}
-        if os.path.exists(NEW_ZIP_PATH + '/vendor/etc/selinux/vendor_file_contexts'):
-            tmp_file_context.update(get_file_contexts(NEW_ZIP_PATH + '/vendor/etc/selinux/vendor_file_contexts'))
-        if os.path.exists(NEW_ZIP_PATH + '/vendor/etc/selinux/nonplat_file_contexts'):
-            tmp_file_context.update(get_file_contexts(NEW_ZIP_PATH + '/vendor/etc/selinux/nonplat_file_contexts'))
-        tmp_keys = tmp_file_context.keys()
-        for tmp_item in new_set | patch_set:
-            tmp_item.selabel = get_selabel_windows(tmp_file_context, tmp_keys, tmp_item.rela_path)
-
-    print('Generating updater...')
-    tmp_updater = Updater()
-    mkdir(OTA_ZIP_PATH + '/install')
-    if '64' in build_prop_dict.get('ro.product.cpu.abi'):
-        tmp_updater.add("SYS_LD_LIBRARY_PATH=/system/lib64")
-        file2file(get_bin('applypatch_64'), OTA_ZIP_PATH + '/install/applypatch')
-    else:
-        tmp_updater.add("SYS_LD_LIBRARY_PATH=/system/lib")
-        file2file(get_bin('applypatch'), OTA_ZIP_PATH + '/install/applypatch')
-    tmp_updater.check_device(info_product_device, info_build_product)
-    tmp_updater.blank_line()
-
-    tmp_updater.ui_print('This OTA package is made by OTA-maker V.' + __version__)
-    tmp_updater.ui_print('Mounting ' + SYSTEM_ROOT)
-    tmp_updater.mount(SYSTEM_ROOT)
-    if IS_TREBLE:
-        tmp_updater.ui_print('Mounting /vendor')
-        tmp_updater.mount('/vendor')
-
-    # patch文件
-    tmp_updater.ui_print('Checking files...')
-    patch_list = list(patch_set)
-    patch_list.sort(key=lambda x: x.rela_path)
-    for tmp_item in patch_list:
-        tmp_updater.apply_patch_check(tmp_item.rela_path, old_sha1_dict[tmp_item.rela_path], tmp_item.sha1)
-    tmp_updater.blank_line()
-    tmp_updater.ui_print('Extracting patch files...')
-    tmp_updater.package_extract_dir('patch', '/tmp/patch')
-    tmp_updater.ui_print('Patching files...')
-    for tmp_item in patch_list:
-        ota_patch_path = OTA_ZIP_PATH + '/patch' + tmp_item.rela_path + '.p'
-        tmp_updater.apply_patch(tmp_item.rela_path, tmp_item.sha1, len(tmp_item), 
-            old_sha1_dict[tmp_item.rela_path], '/tmp/patch' + tmp_item.rela_path + '.p')
-    tmp_updater.blank_line()
-
-    # 解包文件
-    tmp_updater.ui_print('Extracting files...')
-    tmp_updater.package_extract_dir(SYSTEM_ROOT[1:], SYSTEM_ROOT)
-    if IS_TREBLE:
-        tmp_updater.package_extract_dir('vendor', '/vendor')
-    tmp_updater.blank_line()
-
-    # 设置metadata
-    tmp_updater.ui_print('Setting metadata...')
-    new_list = list(new_set | patch_set)
-    new_list.sort(key=lambda x: x.rela_path)
-    for tmp_item in new_list:
-        tmp_updater.set_metadata(tmp_item.rela_path, tmp_item.uid, tmp_item.gid, tmp_item.perm, selabel=tmp_item.selabel)
-    tmp_updater.blank_line()
-
-    # 移除文件
-    tmp_updater.ui_print('Deleting files...')
-    rem_list = list(rem_set)
-    rem_list.sort(key=lambda x: x.rela_path)
-    for tmp_item in rem_list:
-        tmp_updater.delete(tmp_item.rela_path)
-    tmp_updater.blank_line()
-
-    # 生成symlink
-    tmp_updater.ui_print('Making symlinks...')
-    sym_list = list(sym_set)
-    sym_list.sort(key=lambda x: x.rela_path)
-    for tmp_item in sym_list:
-        tmp_updater.symlink(tmp_item.rela_path, tmp_item.slink)
-    tmp_updater.blank_line()
-
-    # 从原版的updater-script取得操作
-    tmp_updater.ui_print('Running updater-script from source zip...')
-    list_lines = []
-    flag_EOC = True # EOC: End of command
-    with open(NEW_ZIP_PATH + '/META-INF/com/google/android/updater-script', "r", encoding="UTF-8") as f:
-        for line in f.readlines():
-            t_line = line.strip()
-            if not t_line: continue
-            if flag_EOC:
-                list_lines.append(t_line)
+                tmp_root = ''
+            if os.path.exists(NEW_ZIP_PATH + SYSTEM_ROOT + '/etc/selinux/plat_file_contexts'):
+                tmp_file_context = get_file_contexts(NEW_ZIP_PATH + SYSTEM_ROOT + '/etc/selinux/plat_file_contexts', tmp_root)
+            elif os.path.exists(NEW_ZIP_PATH + SYSTEM_ROOT + '/system/etc/selinux/plat_file_contexts'):
+                tmp_file_context = get_file_contexts(NEW_ZIP_PATH + SYSTEM_ROOT + '/system/etc/selinux/plat_file_contexts', tmp_root)
             else:
-                list_lines[-1] = list_lines[-1] + ' ' + t_line
-            if t_line[-1] == ";" or t_line[0] == "#" :
-                flag_EOC = True
+                # 直接从zip中的boot.img读取ramdisk里的file_contexts, 不解包到磁盘
+                tmp_file_context = {}
+                ramdisk_files = {}
+                if new_rom.exists('boot.img'):
+                    with new_rom.open('boot.img') as f:
+                        ramdisk_files = read_ramdisk_files(f, ('file_contexts', 'file_contexts.bin'))
+                if 'file_contexts' in ramdisk_files:
+                    tmp_file_context = load_file_contexts(ramdisk_files['file_contexts'])
+                elif 'file_contexts.bin' in ramdisk_files:
+                    tmp_file_context = load_file_contexts(ramdisk_files['file_contexts.bin'])
+            # 其余分区各自的 file_contexts
+            for p in sort_partitions(partitions + list(PARTITION_ORDER)):
+                if p == 'system':
+                    continue
+                for part_contexts in [p + '_file_contexts'] + (['nonplat_file_contexts'] if p == 'vendor' else []):
+                    part_contexts = new_rom.path(p + '/etc/selinux/' + part_contexts)
+                    if part_contexts:
+                        tmp_file_context.update(get_file_contexts(part_contexts))
+            tmp_keys = tmp_file_context.keys()
+            label_partitions(new_set | patch_set,
+                             lambda i: get_selabel_windows(tmp_file_context, tmp_keys, i.rela_path, log),
+                             roots, stats, journal)
+        for tree in new_trees:
+            scratch.unref(tree)
+
+        log('Generating updater...')
+        tmp_updater = Updater(instrument)
+        mkdir(OTA_ZIP_PATH + '/install')
+        if IS_64BIT:
+            tmp_updater.add("SYS_LD_LIBRARY_PATH=/system/lib64")
+        else:
+            tmp_updater.add("SYS_LD_LIBRARY_PATH=/system/lib")
+        file2file(APPLYPATCH_BIN, OTA_ZIP_PATH + '/install/applypatch')
+        tmp_updater.check_device(info_product_device, info_build_product)
+        tmp_updater.blank_line()
+
+        tmp_updater.ui_print('This OTA package is made by OTA-maker V.' + __version__)
+        for root in roots.values():
+            tmp_updater.ui_print('Mounting ' + root)
+            tmp_updater.mount(root)
+
+        # patch文件
+        # 所有补丁写入 install/patches, 设备端一次 sha1sum 校验全部文件, 再由同一个循环依次打补丁
+        # stream 方式下补丁路径为卡刷包中的路径
+        # stream 方式或并行打补丁时按补丁大小从大到小排列
+        tmp_updater.phase('check')
+        tmp_updater.ui_print('Checking files...')
+        patch_list = list(patch_set)
+        patch_list.sort(key=lambda x: x.rela_path)
+        patch_size = {}
+        for tmp_item in patch_list:
+            if tmp_item.rela_path in segmented:
+                patch_size[tmp_item.rela_path] = get_size(OTA_ZIP_PATH + '/patch' + tmp_item.rela_path + '.seg')
             else:
-                flag_EOC = False
-    for line in list_lines:
-        try:
-            tmp_line = parameter_split(line)
-            us_action = tmp_line[0]
-            if us_action == "package_extract_dir":
-                if tmp_line[1] == "system" or tmp_line[1] == "vendor": continue
-                mkdir(os.path.dirname(OTA_ZIP_PATH + '/' + tmp_line[1]))
-                dir2dir(NEW_ZIP_PATH + '/' + tmp_line[1], OTA_ZIP_PATH + '/' + tmp_line[1])
-                tmp_updater.package_extract_dir(tmp_line[1], tmp_line[2])
-            elif us_action == "package_extract_file":
-                mkdir(os.path.dirname(OTA_ZIP_PATH + '/' + tmp_line[1]))
-                file2file(NEW_ZIP_PATH  + '/' + tmp_line[1], OTA_ZIP_PATH  + '/' + tmp_line[1])
-                tmp_updater.package_extract_file(tmp_line[1], tmp_line[2])
-            elif us_action == "ui_print":
-                tmp_updater.ui_print(" ".join(tmp_line[1:]))
-            elif us_action == "set_perm":
-                tmp_updater.set_perm(tmp_line[1], tmp_line[2], tmp_line[3], tmp_line[4:])
-            elif us_action == "set_perm_recursive":
-                tmp_updater.set_perm_recursive(tmp_line[1], tmp_line[2], tmp_line[3], tmp_line[4], tutle(tmp_line[5:]))
-            elif us_action == "set_metadata":
-                tmp_updater.set_metadata(tmp_line[1], tmp_line[3], tmp_line[5], tmp_line[7])
-            elif us_action == "set_metadata_recursive":
-                tmp_updater.set_metadata_recursive(tmp_line[1], tmp_line[3], tmp_line[5], tmp_line[7], tmp_line[9])
-            elif us_action == "mount":
-                if tmp_line[-1] == "/system" or tmp_line[-1] == "/vendor": continue
-                tmp_updater.mount(tmp_line[-1])
-            elif us_action == "umount":
-                if tmp_line[-1] == "/system" or tmp_line[-1] == "/vendor": continue
-                tmp_updater.umount(tmp_line[1])
-            elif us_action == "apply_patch_check":
-                tmp_updater.apply_patch_check(tmp_line[1], tutle(tmp_line[2:]))
-            elif us_action == "apply_patch":
-                tmp_updater.add("apply_patch %s:%s" 
-                                %(" ".join(tmp_line[1:5]), tmp_line[6]))
-            elif us_action == "show_progress":
-                tmp_updater.add('show_progress "%s" "%s"' %(tmp_line[1], tmp_line[6]))
-            elif us_action == "set_progress":
-                tmp_updater.add('set_progress "%s"' %tmp_line[1])
-            elif us_action == "run_program":
-                tmp_updater.add(" ".join(tmp_line[1:]))
-            elif us_action == "symlink":
-                tmp_updater.add('symlink ' + " ".join(tmp_line[1:]))
+                patch_size[tmp_item.rela_path] = get_size(OTA_ZIP_PATH + '/patch' + tmp_item.rela_path + '.p')
+            stats[partition_of(roots, tmp_item.rela_path)].count('patch_bytes', patch_size[tmp_item.rela_path])
+        if patch_strategy == 'stream' or patch_jobs > 1:
+            patch_list.sort(key=lambda x: patch_size[x.rela_path], reverse=True)
+        manifest = OrderedDict()
+        for tmp_item in patch_list:
+            if UNSAFE_MANIFEST_PATH.search(tmp_item.rela_path):
+                raise ValueError('%s: path cannot be written to install/patches' % tmp_item.rela_path)
+            if tmp_item.rela_path in segmented:
+                p_path = '-'
+            elif patch_strategy == 'stream':
+                p_path = 'patch' + tmp_item.rela_path + '.p'
             else:
-                print("WARNING: failed to analyze " + line.strip())
-        except:
+                p_path = '/tmp/patch' + tmp_item.rela_path + '.p'
+            manifest[tmp_item.rela_path] = '%s %s %s %s %s\n' % (tmp_item.rela_path,
+                old_sha1_dict[tmp_item.rela_path], tmp_item.sha1, len(tmp_item), p_path)
+        with open(OTA_ZIP_PATH + '/install/patches', 'w', encoding='UTF-8', newline='\n') as f:
+            f.writelines(manifest.values())
+        # 并行打补丁: 补丁从大到小依次分给当前总量最小的队列, 每个队列在设备端是一个后台任务
+        plain_list = [i for i in patch_list if i.rela_path not in segmented]
+        lanes = [[] for i in range(min(patch_jobs, len(plain_list)))]
+        lane_size = [0] * len(lanes)
+        for tmp_item in plain_list if len(lanes) > 1 else []:
+            i = lane_size.index(min(lane_size))
+            lanes[i].append(manifest[tmp_item.rela_path])
+            lane_size[i] += patch_size[tmp_item.rela_path]
+        lane_manifests = []
+        if len(lanes) > 1:
+            for i, lane in enumerate(lanes):
+                lane_manifests.append('/tmp/install/patches.%d' % i)
+                with open(OTA_ZIP_PATH + '/install/patches.%d' % i, 'w', encoding='UTF-8', newline='\n') as f:
+                    f.writelines(lane)
+        # 每个任务打补丁时原文件, 新文件和补丁同时在内存中
+        job_memory = max([old_size_dict[i.rela_path] + len(i) + patch_size[i.rela_path]
+                          for i in plain_list] or [0])
+        segment_buffer = max([max(seg[1] + seg[4] for seg in segments)
+                              for segments in segmented.values()] or [0])
+        tmp_peak = tmp_requirement(patch_strategy, [patch_size[i.rela_path] for i in plain_list],
+                                   [patch_size[i] for i in segmented], segment_buffer, len(lane_manifests))
+        log('On-device /tmp requirement (%s): %s' % (patch_strategy, human_size(tmp_peak)))
+        if lane_manifests:
+            log('On-device patch jobs: %d, %s of memory each' % (len(lane_manifests), human_size(job_memory)))
+        if patch_list:
+            tmp_updater.apply_patch_check_list('/tmp/install/patches')
+            tmp_updater.check_space('/tmp', tmp_peak)
+        tmp_updater.blank_line()
+        tmp_updater.phase('patch')
+        if patch_strategy == 'stream':
+            tmp_updater.ui_print('Patching files...')
+            if lane_manifests:
+                tmp_updater.apply_patch_parallel('stream', job_memory, *lane_manifests)
+            elif patch_list:
+                tmp_updater.apply_patch_stream('/tmp/install/patches')
+            for tmp_item in patch_list:
+                if tmp_item.rela_path in segmented:
+                    segment_dir = 'patch' + tmp_item.rela_path + '.seg'
+                    tmp_updater.package_extract_dir(segment_dir, '/tmp/' + segment_dir)
+                    tmp_updater.apply_patch_segmented(tmp_item.rela_path, tmp_item.sha1,
+                        '/tmp/' + segment_dir, segmented[tmp_item.rela_path])
+                    tmp_updater.delete_recursive('/tmp/' + segment_dir)
+        else:
+            tmp_updater.ui_print('Extracting patch files...')
+            tmp_updater.package_extract_dir('patch', '/tmp/patch')
+            tmp_updater.ui_print('Patching files...')
+            if lane_manifests:
+                tmp_updater.apply_patch_parallel('list', job_memory, *lane_manifests)
+            elif patch_list:
+                tmp_updater.apply_patch_list('/tmp/install/patches')
+            for tmp_item in patch_list:
+                if tmp_item.rela_path in segmented:
+                    tmp_updater.apply_patch_segmented(tmp_item.rela_path, tmp_item.sha1,
+                        '/tmp/patch' + tmp_item.rela_path + '.seg', segmented[tmp_item.rela_path])
+        dalvik_cache = []
+        for tmp_item in patch_list:
+            cache = tmp_item.rela_path.replace('/', '@')
+            dalvik_cache += ['/data/dalvik/arm/' + cache, '/data/dalvik/arm64/' + cache]
+        for files in batched(dalvik_cache):
+            tmp_updater.delete(*files)
+        tmp_updater.blank_line()
+
+        # 解包文件
+        tmp_updater.phase('extract')
+        tmp_updater.ui_print('Extracting files...')
+        for root in roots.values():
+            tmp_updater.package_extract_dir(root[1:], root)
+        for src, dsts in copy_dict.items():
+            for chunk in batched(dsts):
+                tmp_updater.copy_files(src, *chunk)
+        tmp_updater.blank_line()
+
+        # 设置metadata
+        # 整个新增目录属性一致时递归设置, 其余文件按相同的属性分组批量设置
+        tmp_updater.phase('metadata')
+        tmp_updater.ui_print('Setting metadata...')
+        recursive_list, metadata_groups = group_metadata(new_set | patch_set, sym_set, new_dirs)
+        for tmp_item, fmode in recursive_list:
+            tmp_updater.set_metadata_recursive(tmp_item.rela_path, tmp_item.uid, tmp_item.gid,
+                                               tmp_item.perm, fmode, selabel=tmp_item.selabel)
+        for (uid, gid, perm, selabel), files in metadata_groups.items():
+            for chunk in batched(files):
+                tmp_updater.set_metadata_files(uid, gid, perm, selabel, *chunk)
+        tmp_updater.blank_line()
+
+        # 移除文件
+        tmp_updater.phase('delete')
+        tmp_updater.ui_print('Deleting files...')
+        rem_list = sorted(tmp_item.rela_path for tmp_item in rem_set)
+        for files in batched(rem_list):
+            tmp_updater.delete(*files)
+        tmp_updater.blank_line()
+
+        # 生成symlink
+        # 指向同一目标的 symlink 合并为一条命令
+        tmp_updater.phase('symlink')
+        tmp_updater.ui_print('Making symlinks...')
+        sym_dict = OrderedDict()
+        for tmp_item in sorted(sym_set, key=lambda x: x.rela_path):
+            sym_dict.setdefault(tmp_item.slink, []).append(tmp_item.rela_path)
+        for target, links in sym_dict.items():
+            for chunk in batched(links):
+                tmp_updater.symlink(target, *chunk)
+        tmp_updater.blank_line()
+
+        # 从原版的updater-script取得操作, A/B 的 payload.bin 包中没有这个脚本
+        # 原版脚本中解包的文件直接从源zip复制到OTA包中
+        passthrough = OrderedDict()
+        if new_rom.exists(SOURCE_SCRIPT):
+            tmp_updater.phase('source-script')
+            tmp_updater.ui_print('Running updater-script from source zip...')
+            list_lines = []
+            flag_EOC = True # EOC: End of command
+            # 各分区由上面的步骤挂载和写入, 跳过原版脚本中对应的操作
+            skip_dirs = {'system', 'vendor'} | {root[1:] for root in roots.values()}
+            skip_mounts = {'/' + d for d in skip_dirs}
+            updater_script = new_rom.read(SOURCE_SCRIPT)
+            for line in updater_script.decode("UTF-8").splitlines():
+                t_line = line.strip()
+                if not t_line: continue
+                if flag_EOC:
+                    list_lines.append(t_line)
+                else:
+                    list_lines[-1] = list_lines[-1] + ' ' + t_line
+                if t_line[-1] == ";" or t_line[0] == "#" :
+                    flag_EOC = True
+                else:
+                    flag_EOC = False
+            for line in list_lines:
+                try:
+                    tmp_line = parameter_split(line)
+                    us_action = tmp_line[0]
+                    if us_action == "package_extract_dir":
+                        if tmp_line[1] in skip_dirs: continue
+                        if not new_rom.exists(tmp_line[1]):
+                            raise PathNotFoundError(tmp_line[1])
+                        for name in new_rom.members(tmp_line[1]):
+                            passthrough[name] = new_rom
+                        tmp_updater.package_extract_dir(tmp_line[1], tmp_line[2])
+                    elif us_action == "package_extract_file":
+                        new_rom.getinfo(tmp_line[1])
+                        passthrough[tmp_line[1]] = new_rom
+                        tmp_updater.package_extract_file(tmp_line[1], tmp_line[2])
+                    elif us_action == "ui_print":
+                        tmp_updater.ui_print(" ".join(tmp_line[1:]))
+                    elif us_action == "set_perm":
+                        tmp_updater.set_perm(tmp_line[1], tmp_line[2], tmp_line[3], tmp_line[4:])
+                    elif us_action == "set_perm_recursive":
+                        tmp_updater.set_perm_recursive(tmp_line[1], tmp_line[2], tmp_line[3], tmp_line[4], tutle(tmp_line[5:]))
+                    elif us_action == "set_metadata":
+                        tmp_updater.set_metadata(tmp_line[1], tmp_line[3], tmp_line[5], tmp_line[7])
+                    elif us_action == "set_metadata_recursive":
+                        tmp_updater.set_metadata_recursive(tmp_line[1], tmp_line[3], tmp_line[5], tmp_line[7], tmp_line[9])
+                    elif us_action == "mount":
+                        if tmp_line[-1] in skip_mounts: continue
+                        tmp_updater.mount(tmp_line[-1])
+                    elif us_action == "umount":
+                        if tmp_line[-1] in skip_mounts: continue
+                        tmp_updater.umount(tmp_line[1])
+                    elif us_action == "apply_patch_check":
+                        tmp_updater.apply_patch_check(tmp_line[1], tutle(tmp_line[2:]))
+                    elif us_action == "apply_patch":
+                        tmp_updater.add("apply_patch %s:%s" 
+                                        %(" ".join(tmp_line[1:5]), tmp_line[6]))
+                    elif us_action == "show_progress":
+                        tmp_updater.add('show_progress "%s" "%s"' %(tmp_line[1], tmp_line[6]))
+                    elif us_action == "set_progress":
+                        tmp_updater.add('set_progress "%s"' %tmp_line[1])
+                    elif us_action == "run_program":
+                        tmp_updater.add(" ".join(tmp_line[1:]))
+                    elif us_action == "symlink":
+                        tmp_updater.add('symlink ' + " ".join(tmp_line[1:]))
+                    else:
+                        log("WARNING: failed to analyze " + line.strip())
+                except:
+                    continue
+
+        tmp_updater.blank_line()
+        tmp_updater.add("sync")
+        tmp_updater.phase_report()
+        tmp_updater.blank_line()
+        for root in roots.values():
+            tmp_updater.ui_print('Unmounting ' + root)
+            tmp_updater.unmount(root)
+        tmp_updater.blank_line()
+        tmp_updater.ui_print("Done!")
+
+        update_script_path = os.path.join(OTA_ZIP_PATH, "META-INF", "com", "google", "android")
+        mkdir(update_script_path)
+        new_ub = os.path.join(update_script_path, "update-binary")
+        with open(new_ub, "w", encoding="UTF-8", newline="\n") as f:
+            for line in tmp_updater.script:
+                f.write(line)
+        new_uc = os.path.join(update_script_path, "updater-script")
+        with open(new_uc, "w", encoding="UTF-8", newline="\n") as f:
+            f.write("# Dummy file; update-binary is a shell script.\n")
+
+        log('Making OTA package...')
+        make_zip(OTA_ZIP_PATH, OUT_PATH,
+                 [(rom, name) for name, rom in passthrough.items()], progress)
+
+        log('Cleaning temp files...')
+        scratch.cleanup(finished=True)
+        if journal:
+            journal.clear()
+
+        log('Partition stats (diff: CPU time in the worker pool):')
+        for line in format_stats(stats.values()):
+            log('  ' + line)
+        log('Scratch space usage:')
+        for line in scratch.report():
+            log('  ' + line)
+        log("\nDone!")
+        log("Output OTA package: %s" %OUT_PATH)
+        return OUT_PATH
+    finally:
+        if pool is None and tp_executor is not None:
+            tp_executor.terminate()
+            tp_executor.join()
+        if new_rom is not None:
+            new_rom.close()
+        old_rom.close()
+
+def estimate_ota(OLD_ZIP_PATH, NEW_ZIP_PATH, new_rom, roots, patch_set, new_files, rem_set, sym_set,
+                 old_size_dict, applypatch_bin, scratch, log, pool, samples, segment_size, patch_strategy,
+                 patch_jobs, start_time):
+    # 在 samples 个补丁候选上实际运行 bsdiff(分段的大文件只取第一段), 推算全部补丁的大小和耗时
+    # 新文件的压缩率同样抽样, 返回估算结果
+    workers = getattr(pool, '_processes', None) or os.cpu_count() or 1
+    sample_dir = scratch.mkdtemp(hot=True)
+    # 补丁候选: 路径 -> 分段 diff 的各段, 不分段时为 None
+    segments = {}
+    for tmp_item in patch_set:
+        if segment_size and len(tmp_item) > segment_size * SEGMENT_THRESHOLD:
+            segments[tmp_item.rela_path] = split_segments(old_size_dict[tmp_item.rela_path],
+                                                          len(tmp_item), segment_size, SEGMENT_MARGIN)
+        else:
+            segments[tmp_item.rela_path] = None
+    patch_samples = pick_samples(patch_set, samples)
+    new_items = [items[0] for items in new_files.values()]
+    new_samples = pick_samples(new_items, samples)
+    log('Sampling %d patches and %d new files...' % (len(patch_samples), len(new_samples)))
+    patch_results = [pool.apply_async(timed_call,
+                                      (sample_patch,
+                                       OLD_ZIP_PATH + tmp_item.rela_path,
+                                       NEW_ZIP_PATH + tmp_item.rela_path,
+                                       '%s/%d.p' % (sample_dir, n),
+                                       segments[tmp_item.rela_path] and segments[tmp_item.rela_path][0]))
+                     for n, tmp_item in enumerate(patch_samples)]
+    new_results = [pool.apply_async(timed_call, (deflated_size, NEW_ZIP_PATH + tmp_item.rela_path))
+                   for tmp_item in new_samples]
+    # (耗时, (原大小, 结果大小))
+    patch_results = [r.get() for r in patch_results]
+    new_results = [r.get() for r in new_results]
+    sampled_bytes = sum(r[1][0] for r in patch_results)
+    patch_ratio = ratio(sum(r[1][1] for r in patch_results), sampled_bytes)
+    diff_speed = ratio(sampled_bytes, sum(r[0] for r in patch_results))
+    deflate_ratio = ratio(sum(r[1][1] for r in new_results), sum(r[1][0] for r in new_results))
+    deflate_speed = ratio(sum(r[1][0] for r in new_results), sum(r[0] for r in new_results))
+
+    # 补丁大小按新文件的大小等比例推算
+    patched_bytes = sum(len(i) for i in patch_set)
+    patch_size = dict((i.rela_path, int(len(i) * patch_ratio)) for i in patch_set)
+    plain = [p for p in patch_size if segments[p] is None]
+    segment_buffer = max([max(seg[1] + seg[3] for seg in segments[p])
+                          for p in patch_size if segments[p]] or [0])
+    lanes = min(patch_jobs, len(plain))
+    tmp_peak = tmp_requirement(patch_strategy, [patch_size[p] for p in plain],
+                               [patch_size[p] for p in patch_size if segments[p]],
+                               segment_buffer, lanes if lanes > 1 else 0)
+    # 每个进程池任务为一个文件或一段, 最大的任务决定 diff 阶段的最短耗时
+    tasks = [len(i) if segments[i.rela_path] is None else segments[i.rela_path][0][3]
+             for i in patch_set]
+    diff_time = max(ratio(patched_bytes, diff_speed) / workers,
+                    ratio(max(tasks or [0]), diff_speed))
+
+    # OTA 包: 压缩后的新文件(相同内容只打包一份), 补丁, 原版脚本中解包的条目, applypatch 和 update-binary
+    new_bytes = sum(len(i) for i in new_items)
+    new_packed = int(new_bytes * deflate_ratio)
+    skip_dirs = {'system', 'vendor'} | {root[1:] for root in roots.values()}
+    script = ''
+    if new_rom.exists(SOURCE_SCRIPT):
+        script = new_rom.read(SOURCE_SCRIPT).decode('UTF-8', 'replace')
+    passthrough = set()
+    for name in script_members(script):
+        if name in skip_dirs or not new_rom.exists(name):
             continue
+        passthrough.update(new_rom.members(name) or [name])
+    passthrough_size = sum(new_rom.getinfo(n).compress_size for n in passthrough)
+    package_size = new_packed + sum(patch_size.values()) + passthrough_size + \
+        deflated_size(applypatch_bin)[1] + deflated_size(get_bin('update-binary'))[1]
+    full_size = os.path.getsize(new_rom.file_path)
+    zip_time = ratio(new_bytes, deflate_speed)
+    elapsed = time.perf_counter() - start_time
 
-    tmp_updater.blank_line()
-    tmp_updater.add("sync")
-    tmp_updater.blank_line()
-    tmp_updater.ui_print('Unmounting ' + SYSTEM_ROOT)
-    tmp_updater.unmount(SYSTEM_ROOT)
-    if IS_TREBLE:
-        tmp_updater.ui_print('Unmounting /vendor...')
-        tmp_updater.unmount("/vendor")
-    tmp_updater.blank_line()
-    tmp_updater.ui_print("Done!")
-
-    update_script_path = os.path.join(OTA_ZIP_PATH, "META-INF", "com", "google", "android")
-    mkdir(update_script_path)
-    new_ub = os.path.join(update_script_path, "update-binary")
-    with open(new_ub, "w", encoding="UTF-8", newline="\n") as f:
-        for line in tmp_updater.script:
-            f.write(line)
-    new_uc = os.path.join(update_script_path, "updater-script")
-    with open(new_uc, "w", encoding="UTF-8", newline="\n") as f:
-        f.write("# Dummy file; update-binary is a shell script.\n")
-
-    print('Making OTA package...')
-    make_zip(OTA_ZIP_PATH, OUT_PATH)
-
-    print('Cleaning temp files...')
-    if not is_win():
-        os.system(" ".join(('sudo', 'umount', OLD_ZIP_PATH + SYSTEM_ROOT)))
-        os.system(" ".join(('sudo', 'umount', NEW_ZIP_PATH + SYSTEM_ROOT)))
-        if IS_TREBLE:
-            os.system(" ".join(('sudo', 'umount', OLD_ZIP_PATH + '/vendor')))
-            os.system(" ".join(('sudo', 'umount', NEW_ZIP_PATH + '/vendor')))
-    remove_path(OLD_ZIP_PATH)
-    remove_path(NEW_ZIP_PATH)
-    remove_path(OTA_ZIP_PATH)
-
-    print("\nDone!")
-    print("Output OTA package: %s" %OUT_PATH)
-
-def unpack_to_img(path):
-    dir_list = os.listdir(path)
-    for br_file in dir_list:
-        if br_file[-3:] == '.br': 
-            extract_brotli(os.path.join(path, br_file))
-    dir_list = os.listdir(path)
-    for sdat_file in dir_list:
-        if sdat_file[-8:] == '.new.dat': 
-            extract_sdat(os.path.join(path, sdat_file))
-
-def get_fileinfo_set(root, path, dict):
-    tmp_set = set()
+    log('------ Estimate -------')
+    log('Changed files: %d new (%s, %d unique), %d patched (%s), %d removed, %d symlinks'
+        % (sum(len(items) for items in new_files.values()), human_size(new_bytes), len(new_items),
+           len(patch_set), human_size(patched_bytes), len(rem_set), len(sym_set)))
+    if patch_samples:
+        log('Sampled %d of %d patches (%s): patches are %.1f%% of the new data, bsdiff %s/s per worker'
+            % (len(patch_samples), len(patch_set), human_size(sampled_bytes), patch_ratio * 100,
+               human_size(diff_speed)))
+    log('Projected patches: %s' % human_size(sum(patch_size.values())))
+    log('Projected package: %s (new files %s, patches %s, files from updater-script %s)'
+        % (human_size(package_size), human_size(new_packed), human_size(sum(patch_size.values())),
+           human_size(passthrough_size)))
+    if package_size < full_size:
+        log('Full OTA: %s, the incremental package is %.0f%% of it' % (human_size(full_size),
+                                                                     100 * ratio(package_size, full_size)))
+    else:
+        log('WARNING: a full OTA (%s) would be smaller' % human_size(full_size))
+    log('Projected build time: %.0fs (%.0fs so far, diff %.0fs on %d workers, packaging %.0fs)'
+        % (elapsed + diff_time + zip_time, elapsed, diff_time, workers, zip_time))
+    log('On-device /tmp requirement (%s): %s' % (patch_strategy, human_size(tmp_peak)))
+    return OrderedDict((
+        ('new_files', sum(len(items) for items in new_files.values())), ('new_bytes', new_bytes),
+        ('patched_files', len(patch_set)), ('patched_bytes', patched_bytes),
+        ('removed_files', len(rem_set)), ('symlinks', len(sym_set)),
+        ('sampled_patches', len(patch_samples)), ('patch_ratio', patch_ratio),
+        ('patch_size', sum(patch_size.values())), ('package_size', package_size),
+        ('full_size', full_size), ('build_time', elapsed + diff_time + zip_time),
+        ('tmp_requirement', tmp_peak)))
+
+def tmp_requirement(patch_strategy, plain_sizes, segmented_sizes, segment_buffer, lanes):
+    # 设备端 /tmp 峰值占用: 补丁文件, 加上分段补丁时 dd 出的旧窗口和生成的新段(segment_buffer)
+    # lanes 为并行打补丁的队列数, 不并行时为 0
+    if patch_strategy == 'stream':
+        # 同时解压的补丁最多为每个队列一个
+        plain_sizes = sorted(plain_sizes, reverse=True)
+        return max([sum(plain_sizes[:max(lanes, 1)])] + list(segmented_sizes)) + segment_buffer
+    return sum(plain_sizes) + sum(segmented_sizes) + segment_buffer
+
+def parse_base_images(values, option='--base-image'):
+    # ['system=/path/system.img', ...] -> {'system': '/path/system.img'}
+    # option 为错误信息中的选项名
+    base_images = {}
+    for value in values:
+        name, sep, path = value.partition('=')
+        if not sep or not name or not path:
+            raise ValueError('%s expects PART=PATH, got %s' % (option, value))
+        check_file(path)
+        base_images[name] = os.path.abspath(path)
+    return base_images
+
+def unpack_rom(rom, progress, stage_name, pool, log=print, journal=None):
+    # 按需解压ROM 只取出后续步骤需要的条目, 多个条目多线程解压
+    # 返回值表示该ROM是否以镜像形式提供各分区
+    # journal 为 Journal 对象(可选), 中断前已解压完成的ROM不再解压
+    if journal:
+        if journal.done('unpack', stage_name):
+            log('Already unpacked in the work directory')
+            return journal.get('unpack', stage_name)
+        # 中断的解压可能留下不完整的文件
+        remove_path(rom.extract_path)
+        mkdir(rom.extract_path)
+        has_img = unpack_rom(rom, progress, stage_name, pool, log)
+        journal.record('unpack', stage_name, has_img)
+        return has_img
+    if rom.exists('system/app'):
+        names = [n for n in rom.infos if n.startswith('system/')]
+        has_img = False
+    elif rom.exists('payload.bin'):
+        # A/B 完整包: 在进程池中把各分区直接解码为镜像
+        # 未压缩存储的 payload 直接从 zip 中按偏移读取
+        offset = rom.data_offset('payload.bin')
+        if offset is None:
+            src_path = rom.extract('payload.bin')
+            extract_partitions(src_path, 0, rom.extract_path, pool, PARTITION_ORDER, progress)
+            remove_path(src_path)
+        else:
+            extract_partitions(rom.file_path, offset, rom.extract_path, pool, PARTITION_ORDER, progress)
+        return True
+    else:
+        names = [n for n in rom.listdir()
+                 if n.endswith(('.new.dat', '.new.dat.br', '.patch.dat', '.transfer.list'))
+                 or (n.endswith('.img') and n[:-4] in PARTITION_ORDER)]
+        has_img = True
+    stage = progress.stage(stage_name, len(names),
+                           sum(rom.getinfo(n).file_size for n in names))
+    log('Extracted ' + throughput(*rom.extract_many(names, stage)))
+    stage.finish()
+    return has_img
+
+def prepare_partition(path, name, scratch, progress, stats, base_image=None, cache_entry=None,
+                      journal=None):
+    # 单个分区的 解码 -> 镜像: *.new.dat.br -> *.new.dat -> *.img, 然后挂载(Windows下解出)
+    # cache_entry 为 CacheEntry 对象(可选), 解码结果同时保存到缓存
+    # journal 为 Journal 对象(可选), 中断前已解码的分区只需重新挂载
+    # 以 sparse 镜像提供的 *.img 先原地展开
+    # 增量的块 OTA 在 base_image 的副本上执行传输列表得到 *.img
+    # 每个中间文件只有一个使用者, 解码完成后立即释放
+    base = os.path.join(path, name)
+    transfer_list = base + '.transfer.list'
+    # 例如 old/system
+    unit = os.path.basename(path) + '/' + name
+    if journal and journal.done('decode', unit):
+        # Windows 下记录时已经解出
+        if journal.get('decode', unit) and not is_win():
+            with stats.timed('image'):
+                extract_img(base + '.img')
+        return journal.get('decode', unit)
+    if journal:
+        reset_partition(base)
+    with stats.timed('decode'):
+        if os.path.exists(base + '.new.dat.br'):
+            br_size = os.path.getsize(base + '.new.dat.br')
+            with progress.stage('brotli %s.new.dat.br' % name, 1, br_size) as stage:
+                scratch.retain(base + '.new.dat.br')
+                extract_brotli(base + '.new.dat.br')
+                scratch.unref(base + '.new.dat.br')
+                stage.advance(1, br_size)
+        if os.path.exists(transfer_list) and is_incremental(transfer_list):
+            if base_image is None:
+                raise BlockImageError('%s: incremental block OTA in %s, use --old-base-image or '
+                                      '--new-base-image %s=PATH' % (name, path, name))
+            intermediates = [p for p in (transfer_list, base + '.new.dat', base + '.patch.dat')
+                             if os.path.exists(p)]
+            for p in intermediates:
+                scratch.retain(p)
+            with progress.stage('blockimg %s' % name,
+                                total_bytes=read_transfer_list(transfer_list)[1] * BLOCK_SIZE) as stage:
+                apply_block_image(transfer_list, base + '.img', base_image,
+                                  base + '.new.dat' if os.path.exists(base + '.new.dat') else None,
+                                  base + '.patch.dat' if os.path.exists(base + '.patch.dat') else None,
+                                  stash_dir=scratch.mkdtemp(),
+                                  progress=lambda n: stage.advance(1, n))
+            for p in intermediates:
+                scratch.unref(p)
+        elif os.path.exists(base + '.new.dat'):
+            scratch.retain(base + '.new.dat')
+            scratch.retain(transfer_list)
+            with progress.stage('sdat2img %s.new.dat' % name,
+                                total_bytes=os.path.getsize(base + '.new.dat')) as stage:
+                extract_sdat(base + '.new.dat', lambda n: stage.advance(1, n))
+            scratch.unref(base + '.new.dat')
+            scratch.unref(transfer_list)
+    if not os.path.exists(base + '.img'):
+        if journal:
+            journal.record('decode', unit, False)
+        return False
+    if is_sparse_file(base + '.img'):
+        with stats.timed('decode'):
+            with open(base + '.img', 'rb') as f:
+                raw_size = expanded_size(f)
+            with progress.stage('simg2img %s.img' % name, total_bytes=raw_size) as stage:
+                unsparse_file(base + '.img', progress=lambda n: stage.advance(1, n))
+    if cache_entry and not is_win():
+        # 挂载会修改镜像, 在挂载前保存
+        cache_entry.store_partition(name, base)
+    if journal and not is_win():
+        journal.record('decode', unit, True)
+    with stats.timed('image'):
+        extract_img(base + '.img')
+    if cache_entry and is_win():
+        cache_entry.store_partition(name, base)
+    if journal and is_win():
+        journal.record('decode', unit, True)
+    return True
+
+def reset_partition(base):
+    # 中断的解码可能留下不完整的文件, 重新解码之前删除
+    # 由 *.new.dat 或传输列表得到的镜像重新生成, sparse 镜像的展开是原子的
+    if os.path.exists(base + '.new.dat.br'):
+        remove_path(base + '.new.dat')
+    if os.path.exists(base + '.transfer.list'):
+        remove_path(base + '.img')
+    remove_path(base + '.img.unsparse')
+    if is_win():
+        remove_path(base)
+        remove_path(base + '_statfile.txt')
+
+def mount_cached_partition(path, name, cached):
+    # 缓存中的分区: Linux 下链接镜像并只读挂载, Windows 下复制解出的目录
+    base = os.path.join(path, name)
+    # 中断后恢复时先删除上次复制或链接的结果
+    if is_win():
+        remove_path(base)
+        dir2dir(cached, base)
+        if os.path.exists(cached + '_statfile.txt'):
+            file2file(cached + '_statfile.txt', base + '_statfile.txt')
+    else:
+        if os.path.lexists(base + '.img'):
+            os.remove(base + '.img')
+        os.symlink(cached + '.img', base + '.img')
+        extract_img(base + '.img', readonly=True)
+
+def label_partitions(items, get_label, roots, stats, journal=None):
+    # 各分区的文件在各自的线程中读取 SELinux 属性
+    # journal 为 Journal 对象(可选), 记录各分区的结果, 中断后恢复时不再读取
+    by_partition = OrderedDict((p, []) for p in roots)
+    for tmp_item in items:
+        by_partition[partition_of(roots, tmp_item.rela_path)].append(tmp_item)
+    def _label(p):
+        labels = journal.get('label', p) if journal else None
+        if labels is not None:
+            for tmp_item in by_partition[p]:
+                tmp_item.selabel = labels[tmp_item.rela_path]
+            return
+        with stats[p].timed('label'):
+            for tmp_item in by_partition[p]:
+                tmp_item.selabel = get_label(tmp_item)
+        if journal:
+            journal.record('label', p, dict((i.rela_path, i.selabel) for i in by_partition[p]))
+    with ThreadPoolExecutor(len(by_partition)) as executor:
+        list(executor.map(_label, by_partition))
+
+class JournaledResult:
+    # 中断前已完成的进程池任务, 与 AsyncResult 一样用 get() 取得 (耗时, 结果)
+
+    def __init__(self, value):
+        self.value = value
+
+    def get(self):
+        return 0, self.value
+
+def retain_tree(scratch, tree, image):
+    # 挂载的分区目录释放时先卸载, 再释放背后的镜像
+    # 未挂载的目录(Windows下由imgextractor解出)不再需要镜像, 立即释放
+    def _release(path):
+        if os.path.ismount(path):
+            umount_img(path)
+        scratch.unref(image)
+    if os.path.ismount(tree):
+        scratch.retain(image)
+    else:
+        scratch.release(image)
+    scratch.retain(tree, on_release=_release)
+
+def group_metadata(items, sym_items, new_dirs):
+    # 新增目录下所有条目的 uid gid selabel 相同, 且目录权限, 文件权限各自一致,
+    # 并且不含 symlink 时, 整个目录用一条 set_metadata_recursive 设置
+    # new_dirs 为旧ROM中不存在的目录: 已有的目录中还有未改动的文件, 不能递归设置
+    # 返回 ([(目录条目, 文件权限), ...], {(uid, gid, 权限, selabel): [文件路径, ...]})
+    items = sorted(items, key=lambda x: x.rela_path)
+    paths = [i.rela_path for i in items]
+    sym_paths = sorted(i.rela_path for i in sym_items)
+    recursive_list = []
+    covered = set()
+    groups = OrderedDict()
+    for index, item in enumerate(items):
+        if item.rela_path in covered:
+            continue
+        if item.sha1 == 'isdirorsym' and item.rela_path in new_dirs:
+            prefix = item.rela_path + '/'
+            # '0' 是 '/' 之后的字符, 子条目在排序后的列表中连续
+            children = items[bisect.bisect_left(paths, prefix, index + 1):
+                             bisect.bisect_left(paths, item.rela_path + '0', index + 1)]
+            s = bisect.bisect_left(sym_paths, prefix)
+            has_sym = s < len(sym_paths) and sym_paths[s].startswith(prefix)
+            fmodes = {c.perm for c in children if c.sha1 != 'isdirorsym'}
+            if children and not has_sym and len(fmodes) <= 1 and \
+               all((c.uid, c.gid, c.selabel) == (item.uid, item.gid, item.selabel) and
+                   (c.sha1 != 'isdirorsym' or c.perm == item.perm) for c in children):
+                recursive_list.append((item, fmodes.pop() if fmodes else item.perm))
+                covered.update(c.rela_path for c in children)
+                continue
+        groups.setdefault((item.uid, item.gid, item.perm, item.selabel), []).append(item.rela_path)
+    return recursive_list, groups
+
+def get_fileinfo_set(root, path, dict, progress, stage_name, stats=None):
+    # 先遍历取得文件列表 以便报告哈希进度
+    # stats 为 PartitionStats 对象(可选) 分别记录扫描和哈希的耗时
+    scan_start = time.perf_counter()
+    path_list = []
     for t_root, dirs, files in os.walk(path):
         for info_file in files + dirs:
-            tmp_FI = FileInfo(t_root + '/' + info_file, root)
-            if is_win():
-                tmp_FI.set_info(dict.get(tmp_FI.rela_path, [0, 0, 644, '']))
-            tmp_FI.calc_sha1()
-            tmp_set.add(tmp_FI)
+            path_list.append(t_root + '/' + info_file)
+    if stats:
+        stats.add_time('scan', time.perf_counter() - scan_start)
+    hash_start = time.perf_counter()
+    stage = progress.stage(stage_name, len(path_list))
+    tmp_set = set()
+    for info_path in path_list:
+        tmp_FI = FileInfo(info_path, root)
+        if is_win():
+            tmp_FI.set_info(dict.get(tmp_FI.rela_path, [0, 0, 644, '']))
+        tmp_FI.calc_sha1()
+        tmp_set.add(tmp_FI)
+        stage.advance(1, tmp_FI.size or 0)
+    stage.finish()
+    if stats:
+        stats.add_time('hash', time.perf_counter() - hash_start)
+    return tmp_set
+
+def cached_fileinfo_set(cache, key, name, root, path, dict, progress, stage_name, stats=None):
+    # 缓存的扫描和哈希结果, 分区目录不同时重新扫描
+    tmp_set = cache.load_manifest(key, name, root, path)
+    if tmp_set is None:
+        return get_fileinfo_set(path, path + root, dict, progress, stage_name, stats)
+    if is_win():
+        for tmp_FI in tmp_set:
+            tmp_FI.set_info(dict.get(tmp_FI.rela_path, [0, 0, 644, '']))
     return tmp_set
 
 if __name__ == '__main__':
-    try:
-        OLD_ZIP = str(sys.argv[1])
-        NEW_ZIP = str(sys.argv[2])
-    except IndexError:
+    parser = argparse.ArgumentParser(prog='makeota.py')
+    parser.add_argument('OLD_ZIP')
+    parser.add_argument('NEW_ZIP')
+    parser.add_argument('OUT_PATH', nargs='?', default='OTA.zip')
+    parser.add_argument('--tmpdir',
+                        help='directory for bulk intermediates (images, extracted trees)')
+    parser.add_argument('--fast-tmpdir',
+                        help='tmpfs/RAM disk for small hot intermediates (patches, package tree)')
+    parser.add_argument('--segment-size', type=int, default=SEGMENT_SIZE // 1024 // 1024,
+                        metavar='MB',
+                        help='diff files larger than %d segments in parallel windows '
+                             'of this size, 0 to disable (default: %%(default)s)' % SEGMENT_THRESHOLD)
+    parser.add_argument('--patch-strategy', choices=PATCH_STRATEGIES, default='extract',
+                        help='extract all patches to /tmp first, or stream them one at a time on device')
+    parser.add_argument('--patch-jobs', type=int, default=1,
+                        help='number of patches applied concurrently on device (default 1)')
+    parser.add_argument('--instrument', action='store_true',
+                        help='log per-phase install time and bytes written on device')
+    parser.add_argument('--old-base-image', action='append', default=[], metavar='PART=PATH',
+                        help='base image for a partition of OLD_ZIP shipped as an incremental block OTA '
+                             '(transfer list with move/bsdiff/imgdiff), may be repeated')
+    parser.add_argument('--new-base-image', action='append', default=[], metavar='PART=PATH',
+                        help='the same for NEW_ZIP, may be repeated')
+    parser.add_argument('--artifact-cache', type=float, default=0, metavar='GB',
+                        help='cache the decoded images and file hashes of OLD_ZIP between builds, '
+                             'using at most this much disk space (default 0: disabled)')
+    parser.add_argument('--workdir', metavar='DIR',
+                        help='keep intermediates in DIR and record finished steps; '
+                             'rerun the same command to resume an interrupted build')
+    parser.add_argument('--estimate', type=int, nargs='?', const=DEFAULT_SAMPLES, default=0,
+                        metavar='SAMPLES',
+                        help='only compare the file lists and sample bsdiff on SAMPLES patches '
+                             '(default %d) to project package size, build time and /tmp needs; '
+                             'no package is written' % DEFAULT_SAMPLES)
+    parser.add_argument('--progress', choices=('auto', 'tty', 'json', 'none'), default='auto',
+                        help='progress output on stderr: progress bars or JSON lines')
+    if len(sys.argv) < 3:
         print('OTA-maker ver: %s' %__version__)
-        print('by cjybyjk')
-        print('\nUsage:  makeota.py <OLD_ZIP> <NEW_ZIP> [OUT_PATH] \n')
+        print('by cjybyjk\n')
+        parser.print_usage()
         sys.exit()
+    args = parser.parse_args()
+    try:
+        old_base_images = parse_base_images(args.old_base_image, '--old-base-image')
+        new_base_images = parse_base_images(args.new_base_image, '--new-base-image')
+    except (ValueError, PathNotFoundError) as e:
+        parser.error(str(e))
 
+    if args.progress == 'auto':
+        args.progress = 'tty' if sys.stderr.isatty() else 'none'
+    sink = {'tty': tty_sink, 'json': json_sink}.get(args.progress)
     try:
-        OUT_PATH = str(sys.argv[3])
-    except IndexError:
-        OUT_PATH = "OTA.zip"
-            
-    main(OLD_ZIP, NEW_ZIP, OUT_PATH)
+        main(args.OLD_ZIP, args.NEW_ZIP, args.OUT_PATH,
+             tmpdir=args.tmpdir, fast_tmpdir=args.fast_tmpdir,
+             progress=Progress(sink() if sink else None),
+             segment_size=args.segment_size * 1024 * 1024,
+             patch_strategy=args.patch_strategy, instrument=args.instrument,
+             patch_jobs=args.patch_jobs,
+             old_base_images=old_base_images, new_base_images=new_base_images,
+             artifact_cache=ArtifactCache(args.artifact_cache * 1024 ** 3) if args.artifact_cache > 0 else None,
+             workdir=args.workdir, estimate=args.estimate)
+    except JournalError as e:
+        print("ERROR: %s" % e)
+        sys.exit(1)
     sys.exit(0)
@@ -0,0 +1,197 @@
+#!/usr/bin/env python3
+# encoding: utf-8
+
+import argparse
+import json
+import os
+import queue
+import socket
+import socketserver
+import sys
+import threading
+import traceback
+
+import makeota
+from artifacts import ArtifactCache
+from multiprocessing import Pool
+from progress import Progress
+
+# 常驻服务模式
+# 进程池, bsdiff4 和 update-binary 模板在多次构建之间保持常驻,
+# 构建任务排队依次执行, 进度以 JSON 行的形式推送给提交任务的客户端
+#
+# 请求(一行JSON):
+#   {"old_zip": ..., "new_zip": ..., "out_path": ..., "tmpdir": ..., "fast_tmpdir": ...,
+#    "patch_strategy": ..., "patch_jobs": ..., "instrument": ...,
+#    "old_base_images": {分区名: 路径}, "new_base_images": {分区名: 路径}}
+# 响应(多行JSON, 任务结束后关闭连接):
+#   {"event": "queued", "job": 1, "position": 0}
+#   {"event": "log", "job": 1, "message": "..."}
+#   {"event": "progress", "job": 1, "type": "progress", "stage": "diff", "eta": ..., ...}
+#   {"event": "done", "job": 1, "output": "..."} / {"event": "error", "job": 1, "message": "..."}
+
+JOB_OPTIONS = ("tmpdir", "fast_tmpdir", "patch_strategy", "patch_jobs", "instrument",
+               "old_base_images", "new_base_images")
+
+class BuildServer:
+
+    def __init__(self, processes=None, artifact_cache=None):
+        # artifact_cache 为 ArtifactCache 对象(可选), 在所有任务之间共用
+        self.pool = Pool(processes)
+        self.artifact_cache = artifact_cache
+        self.jobs = queue.Queue()
+        self.lock = threading.Lock()
+        self.last_job = 0
+        self.worker = threading.Thread(target=self._run, daemon=True)
+        self.worker.start()
+
+    def submit(self, request, send):
+        # 加入队列 返回任务结束时被设置的 Event
+        with self.lock:
+            self.last_job += 1
+            job_id = self.last_job
+        finished = threading.Event()
+        send({"event": "queued", "job": job_id, "position": self.jobs.qsize()})
+        self.jobs.put((job_id, request, send, finished))
+        return finished
+
+    def _run(self):
+        while True:
+            job_id, request, send, finished = self.jobs.get()
+            def log(message, job_id=job_id, send=send):
+                send({"event": "log", "job": job_id, "message": str(message)})
+            def on_progress(event, job_id=job_id, send=send):
+                event.update({"event": "progress", "job": job_id})
+                send(event)
+            try:
+                options = {k: request[k] for k in JOB_OPTIONS if request.get(k)}
+                output = makeota.main(request["old_zip"], request["new_zip"],
+                                      request.get("out_path") or "OTA.zip",
+                                      log=log, pool=self.pool,
+                                      artifact_cache=self.artifact_cache,
+                                      progress=Progress(on_progress), **options)
+                send({"event": "done", "job": job_id, "output": output})
+            except Exception as e:
+                traceback.print_exc()
+                send({"event": "error", "job": job_id, "message": repr(e)})
+            finally:
+                finished.set()
+
+    def close(self):
+        self.pool.close()
+        self.pool.join()
+
+class _Handler(socketserver.StreamRequestHandler):
+
+    def handle(self):
+        # 日志和进度也来自各分区的线程, 每个事件一次写完整行
+        lock = threading.Lock()
+        def send(event):
+            # 客户端断开后任务继续执行, 只是不再推送进度
+            try:
+                with lock:
+                    self.wfile.write((json.dumps(event) + "\n").encode("UTF-8"))
+                    self.wfile.flush()
+            except OSError:
+                pass
+        try:
+            request = json.loads(self.rfile.readline().decode("UTF-8"))
+            for k in ("old_zip", "new_zip"):
+                request[k] = os.path.abspath(request[k])
+            if request.get("out_path"):
+                request["out_path"] = os.path.abspath(request["out_path"])
+        except (ValueError, KeyError, TypeError) as e:
+            send({"event": "error", "message": "bad request: %r" % e})
+            return
+        self.server.build_server.submit(request, send).wait()
+
+def make_socket_server(address, handler):
+    # address 为端口号时监听 127.0.0.1, 否则视为 Unix socket 路径
+    if str(address).isdigit():
+        server = socketserver.ThreadingTCPServer(("127.0.0.1", int(address)), handler)
+    else:
+        if os.path.exists(address):
+            os.remove(address)
+        server = socketserver.ThreadingUnixStreamServer(address, handler)
+    server.daemon_threads = True
+    return server
+
+def connect(address):
+    if str(address).isdigit():
+        return socket.create_connection(("127.0.0.1", int(address)))
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    sock.connect(address)
+    return sock
+
+def serve(address, processes=None, artifact_cache=None):
+    build_server = BuildServer(processes, artifact_cache)
+    server = make_socket_server(address, _Handler)
+    server.build_server = build_server
+    print("OTA-maker server listening on %s" % address)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        build_server.close()
+
+def submit(address, old_zip, new_zip, out_path=None, **options):
+    # 提交任务并逐个返回服务端推送的事件
+    request = {"old_zip": os.path.abspath(old_zip),
+               "new_zip": os.path.abspath(new_zip),
+               "out_path": os.path.abspath(out_path) if out_path else None}
+    request.update(options)
+    with connect(address) as sock, sock.makefile("rwb") as f:
+        f.write((json.dumps(request) + "\n").encode("UTF-8"))
+        f.flush()
+        for line in f:
+            yield json.loads(line.decode("UTF-8"))
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(prog='otaserver.py')
+    sub = parser.add_subparsers(dest='command')
+    p_serve = sub.add_parser('serve', help='run the build server')
+    p_serve.add_argument('ADDRESS', help='Unix socket path, or a port on 127.0.0.1')
+    p_serve.add_argument('-j', '--jobs', type=int, default=None,
+                         help='number of diff worker processes')
+    p_serve.add_argument('--artifact-cache', type=float, default=0, metavar='GB',
+                         help='cache decoded base ROMs between builds, using at most this much disk space')
+    p_submit = sub.add_parser('submit', help='submit a build and stream its progress')
+    p_submit.add_argument('ADDRESS')
+    p_submit.add_argument('OLD_ZIP')
+    p_submit.add_argument('NEW_ZIP')
+    p_submit.add_argument('OUT_PATH', nargs='?')
+    p_submit.add_argument('--tmpdir')
+    p_submit.add_argument('--fast-tmpdir')
+    p_submit.add_argument('--patch-strategy', choices=makeota.PATCH_STRATEGIES)
+    p_submit.add_argument('--patch-jobs', type=int)
+    p_submit.add_argument('--instrument', action='store_true')
+    p_submit.add_argument('--old-base-image', action='append', default=[], metavar='PART=PATH')
+    p_submit.add_argument('--new-base-image', action='append', default=[], metavar='PART=PATH')
+    args = parser.parse_args()
+
+    if args.command == 'serve':
+        serve(args.ADDRESS, args.jobs,
+              ArtifactCache(args.artifact_cache * 1024 ** 3) if args.artifact_cache > 0 else None)
+    elif args.command == 'submit':
+        status = 1
+        for event in submit(args.ADDRESS, args.OLD_ZIP, args.NEW_ZIP, args.OUT_PATH,
+                            tmpdir=args.tmpdir, fast_tmpdir=args.fast_tmpdir,
+                            patch_strategy=args.patch_strategy,
+                            patch_jobs=args.patch_jobs,
+                            instrument=args.instrument,
+                            old_base_images=makeota.parse_base_images(args.old_base_image,
+                                                                      '--old-base-image'),
+                            new_base_images=makeota.parse_base_images(args.new_base_image,
+                                                                      '--new-base-image')):
+            if event["event"] == "log":
+                print(event["message"])
+            else:
+                print(json.dumps(event))
+            if event["event"] == "done":
+                status = 0
+        sys.exit(status)
+    else:
+        parser.print_usage()
+        sys.exit(1)
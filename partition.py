@@ -0,0 +1,87 @@
+#!/usr/bin/env python3
+# encoding: utf-8
+
+import threading
+import time
+
+from collections import OrderedDict
+from contextlib import contextmanager
+
+# 分区
+# 以镜像形式提供的分区由ROM中的 *.transfer.list (或 *.img) 找出,
+# 每个分区独立地 解码 -> 镜像 -> 扫描/哈希, 各分区在线程中并行,
+# diff 在共用的进程池中进行, 最后按分区汇总统计
+
+# 已知的分区按此顺序排列, 其余分区按名称排在后面
+PARTITION_ORDER = ('system', 'vendor', 'product', 'system_ext', 'odm')
+
+def sort_partitions(names):
+    return sorted(set(names), key=lambda n: (PARTITION_ORDER.index(n)
+                                              if n in PARTITION_ORDER else len(PARTITION_ORDER), n))
+
+def discover_partitions(names):
+    # names 为ROM根目录下的条目名
+    # 任何带 transfer list 的分区都会被处理, 直接提供的镜像只接受已知的分区名
+    found = set()
+    for name in names:
+        if name.endswith('.transfer.list'):
+            found.add(name[:-len('.transfer.list')])
+        elif name.endswith('.img') and name[:-4] in PARTITION_ORDER:
+            found.add(name[:-4])
+    return sort_partitions(found)
+
+def partition_of(roots, rela_path):
+    # roots 为 分区名 -> 挂载点, 返回路径所属的分区
+    for name, root in roots.items():
+        if rela_path == root or rela_path.startswith(root + '/'):
+            return name
+    return None
+
+def timed_call(func, *args):
+    # 在进程池中执行 返回 (耗时, 结果)
+    start = time.perf_counter()
+    result = func(*args)
+    return time.perf_counter() - start, result
+
+class PartitionStats:
+    # 单个分区各阶段的耗时, 文件数和补丁大小
+
+    COUNTERS = ('new', 'patched', 'removed', 'symlinks', 'patch_bytes')
+
+    def __init__(self, name):
+        self.name = name
+        self.times = OrderedDict()
+        self.counts = OrderedDict((k, 0) for k in self.COUNTERS)
+        # 新旧两侧的线程和进程池的回调线程同时更新
+        self.lock = threading.Lock()
+
+    def add_time(self, stage, seconds):
+        with self.lock:
+            self.times[stage] = self.times.get(stage, 0.0) + seconds
+
+    @contextmanager
+    def timed(self, stage):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add_time(stage, time.perf_counter() - start)
+
+    def count(self, key, n=1):
+        with self.lock:
+            self.counts[key] += n
+
+def format_stats(stats):
+    # 每个分区一行 diff 时间为进程池中累计的 CPU 时间
+    stages = []
+    for s in stats:
+        for stage in s.times:
+            if stage not in stages:
+                stages.append(stage)
+    header = ['partition'] + list(PartitionStats.COUNTERS) + stages
+    rows = [header]
+    for s in stats:
+        rows.append([s.name] + [str(v) for v in s.counts.values()] +
+                    ['%.1fs' % s.times[stage] if stage in s.times else '-' for stage in stages])
+    widths = [max(len(row[i]) for row in rows) for i in range(len(header))]
+    return ['  '.join(cell.ljust(w) for cell, w in zip(row, widths)).rstrip() for row in rows]
@@ -0,0 +1,209 @@
+#!/usr/bin/env python3
+# encoding: utf-8
+
+import bz2
+import lzma
+import os
+import struct
+import sys
+
+# A/B OTA 的 payload.bin 解析
+# 格式见 AOSP system/update_engine/update_metadata.proto:
+#   'CrAU', u64 版本, u64 manifest 大小, u32 manifest 签名大小,
+#   manifest(protobuf DeltaArchiveManifest), manifest 签名, 之后是各操作的数据
+# 只支持版本 2, 版本 1 的 manifest 没有按分区组织的操作列表
+# 只支持完整包: REPLACE, REPLACE_BZ, REPLACE_XZ 写入数据, ZERO 和 DISCARD
+# 对应新建镜像中的空洞. 各操作写入的块互不重叠, 可以在进程池中并行解码
+
+PAYLOAD_MAGIC = b'CrAU'
+PAYLOAD_HEADER = struct.Struct('>4sQQ')
+
+OP_REPLACE = 0
+OP_REPLACE_BZ = 1
+OP_ZERO = 6
+OP_DISCARD = 7
+OP_REPLACE_XZ = 8
+
+# 每个任务处理的压缩数据量
+TASK_BYTES = 16 * 1024 * 1024
+
+class PayloadError(ValueError):
+    pass
+
+def read_varint(data, offset):
+    value = shift = 0
+    while True:
+        if offset >= len(data):
+            raise PayloadError('truncated protobuf varint')
+        b = data[offset]
+        offset += 1
+        value |= (b & 0x7f) << shift
+        if not b & 0x80:
+            return value, offset
+        shift += 7
+
+def decode_message(data):
+    # 最简单的 protobuf 解码: 返回 字段号 -> [值, ...]
+    # varint 和定长字段为整数, length-delimited 字段为 bytes(嵌套消息需再次解码)
+    fields = {}
+    offset = 0
+    while offset < len(data):
+        key, offset = read_varint(data, offset)
+        number, wire_type = key >> 3, key & 7
+        if wire_type == 0:
+            value, offset = read_varint(data, offset)
+        elif wire_type == 1:
+            value, = struct.unpack_from('<Q', data, offset)
+            offset += 8
+        elif wire_type == 2:
+            size, offset = read_varint(data, offset)
+            value = data[offset:offset + size]
+            if len(value) != size:
+                raise PayloadError('truncated protobuf field')
+            offset += size
+        elif wire_type == 5:
+            value, = struct.unpack_from('<I', data, offset)
+            offset += 4
+        else:
+            raise PayloadError('unsupported protobuf wire type %d' % wire_type)
+        fields.setdefault(number, []).append(value)
+    return fields
+
+def _first(fields, number, default=None):
+    return fields[number][0] if number in fields else default
+
+def parse_manifest(data):
+    # 返回 (块大小, [(分区名, 分区大小, [操作, ...]), ...])
+    # 操作为 (类型, 数据偏移, 数据长度, [(起始块, 块数), ...])
+    manifest = decode_message(data)
+    block_size = _first(manifest, 3, 4096)
+    partitions = []
+    # 13: partitions
+    for part in manifest.get(13, []):
+        part = decode_message(part)
+        name = _first(part, 1, b'').decode('UTF-8')
+        # 7: new_partition_info { 1: size }
+        size = _first(decode_message(_first(part, 7, b'')), 1, 0)
+        ops = []
+        # 8: operations
+        for op in part.get(8, []):
+            op = decode_message(op)
+            # 6: dst_extents { 1: start_block, 2: num_blocks }
+            extents = [(_first(e, 1, 0), _first(e, 2, 0))
+                       for e in map(decode_message, op.get(6, []))]
+            ops.append((_first(op, 1, OP_REPLACE), _first(op, 2, 0), _first(op, 3, 0), extents))
+        # 旧版本的 payload 可能没有分区大小, 按写入的最后一块计算
+        size = max([size] + [(start + num) * block_size for op in ops for start, num in op[3]])
+        partitions.append((name, size, ops))
+    return block_size, partitions
+
+def read_payload(f):
+    # f 定位在 payload 开头, 返回 (数据区相对 payload 开头的偏移, 块大小, 分区列表)
+    header = f.read(PAYLOAD_HEADER.size)
+    if len(header) != PAYLOAD_HEADER.size:
+        raise PayloadError('truncated payload header')
+    magic, version, manifest_size = PAYLOAD_HEADER.unpack(header)
+    if magic != PAYLOAD_MAGIC:
+        raise PayloadError('not a payload.bin')
+    if version != 2:
+        raise PayloadError('unsupported payload version %d' % version)
+    signature_size, = struct.unpack('>I', f.read(4))
+    header_size = PAYLOAD_HEADER.size + 4
+    manifest = f.read(manifest_size)
+    if len(manifest) != manifest_size:
+        raise PayloadError('truncated payload manifest')
+    block_size, partitions = parse_manifest(manifest)
+    return header_size + manifest_size + signature_size, block_size, partitions
+
+def check_full(name, ops):
+    # 增量包的操作需要源分区, 不支持
+    for op in ops:
+        if op[0] not in (OP_REPLACE, OP_REPLACE_BZ, OP_REPLACE_XZ, OP_ZERO, OP_DISCARD):
+            raise PayloadError('%s: operation type %d is not supported, only full payloads are'
+                               % (name, op[0]))
+
+def split_tasks(ops, task_bytes=TASK_BYTES):
+    # 按压缩数据量把操作分组, 每组为一个进程池任务
+    tasks = []
+    current = []
+    size = 0
+    for op in ops:
+        if op[0] in (OP_ZERO, OP_DISCARD):
+            # 新建的镜像中本来就是空洞
+            continue
+        current.append(op)
+        size += op[2]
+        if size >= task_bytes:
+            tasks.append(current)
+            current = []
+            size = 0
+    if current:
+        tasks.append(current)
+    return tasks
+
+def apply_operations(src_path, data_offset, image_path, block_size, ops):
+    # 在进程池中执行: 从 src_path 的 data_offset 处读取数据区, 解码后写入镜像
+    # 返回写入的字节数
+    written = 0
+    with open(src_path, 'rb') as src, open(image_path, 'r+b') as dst:
+        for op_type, offset, length, extents in ops:
+            src.seek(data_offset + offset)
+            data = src.read(length)
+            if len(data) != length:
+                raise PayloadError('truncated payload data')
+            if op_type == OP_REPLACE_BZ:
+                data = bz2.decompress(data)
+            elif op_type == OP_REPLACE_XZ:
+                data = lzma.decompress(data)
+            pos = 0
+            for start, num in extents:
+                size = num * block_size
+                dst.seek(start * block_size)
+                dst.write(data[pos:pos + size])
+                pos += size
+            if pos < len(data):
+                raise PayloadError('operation data exceeds its extents')
+            written += pos
+    return written
+
+def extract_partitions(src_path, payload_offset, out_dir, pool, names=None, progress=None):
+    # 解出 payload 中的分区镜像到 out_dir/<分区名>.img
+    # src_path 为包含 payload 的文件(未压缩存储在 zip 中时为 zip 本身),
+    # payload_offset 为 payload 在该文件中的偏移
+    # names 为需要的分区名(None 表示全部), progress 为 Progress 对象(可选)
+    # 返回 [镜像路径, ...]
+    with open(src_path, 'rb') as f:
+        f.seek(payload_offset)
+        data_offset, block_size, partitions = read_payload(f)
+    data_offset += payload_offset
+    partitions = [p for p in partitions if names is None or p[0] in names]
+    results = []
+    images = []
+    for name, size, ops in partitions:
+        check_full(name, ops)
+        image_path = os.path.join(out_dir, name + '.img')
+        with open(image_path, 'wb') as f:
+            f.truncate(size)
+        images.append(image_path)
+        stage = progress.stage('payload ' + name, total_bytes=size) if progress else None
+        tasks = split_tasks(ops)
+        results += [(stage, pool.apply_async(apply_operations,
+                                             (src_path, data_offset, image_path, block_size, task),
+                                             callback=stage and (lambda n, s=stage: s.advance(1, n))))
+                    for task in tasks]
+        results.append((stage, None))
+    for stage, result in results:
+        if result is not None:
+            result.get()
+        elif stage:
+            stage.finish()
+    return images
+
+if __name__ == '__main__':
+    from multiprocessing import Pool
+    if len(sys.argv) < 3:
+        print('Usage: payload.py <payload.bin> <output_dir> [partition ...]')
+        sys.exit(1)
+    with Pool() as pool:
+        for image in extract_partitions(sys.argv[1], 0, sys.argv[2], pool, sys.argv[3:] or None):
+            print(image)
@@ -0,0 +1,115 @@
+#!/usr/bin/env python3
+# encoding: utf-8
+
+import json
+import sys
+import threading
+import time
+
+from common import human_size
+
+class Progress:
+    # 进度事件
+    # 每个阶段统计已完成的条目数和字节数, 按吞吐量估算剩余时间,
+    # 事件(dict)交给 sink 处理, sink 为 None 时不输出
+
+    def __init__(self, sink=None, interval=0.5):
+        self.sink = sink
+        self.interval = interval
+
+    def stage(self, name, total_items=0, total_bytes=0):
+        return Stage(self, name, total_items, total_bytes)
+
+    def emit(self, event):
+        if self.sink:
+            self.sink(event)
+
+class Stage:
+
+    def __init__(self, progress, name, total_items=0, total_bytes=0):
+        self.progress = progress
+        self.name = name
+        self.total_items = total_items
+        self.total_bytes = total_bytes
+        self.items = 0
+        self.bytes = 0
+        self.lock = threading.Lock()
+        self.start = self.last_emit = time.monotonic()
+        self.finished = False
+        self._emit("start")
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.finish()
+
+    def advance(self, items=1, nbytes=0):
+        # 可以在进程池的回调线程中调用
+        with self.lock:
+            self.items += items
+            self.bytes += nbytes
+            now = time.monotonic()
+            if now - self.last_emit < self.progress.interval:
+                return
+            self.last_emit = now
+        self._emit("progress")
+
+    def finish(self):
+        if self.finished:
+            return
+        self.finished = True
+        self._emit("finish")
+
+    def eta(self, elapsed):
+        # 有总字节数时按字节吞吐量估算, 否则按条目数估算
+        if self.total_bytes and self.bytes:
+            done, total = self.bytes, self.total_bytes
+        elif self.total_items and self.items:
+            done, total = self.items, self.total_items
+        else:
+            return None
+        return max(elapsed * (total - done) / done, 0.0)
+
+    def _emit(self, kind):
+        elapsed = time.monotonic() - self.start
+        self.progress.emit({
+            "type": kind,
+            "stage": self.name,
+            "items": self.items,
+            "total_items": self.total_items,
+            "bytes": self.bytes,
+            "total_bytes": self.total_bytes,
+            "elapsed": round(elapsed, 3),
+            "rate": round(self.bytes / elapsed, 1) if elapsed > 0 else 0.0,
+            "eta": None if kind == "finish" else self.eta(elapsed),
+        })
+
+def json_sink(stream=sys.stderr):
+    # 每个事件输出一行 JSON
+    def sink(event):
+        stream.write(json.dumps(event) + "\n")
+        stream.flush()
+    return sink
+
+def tty_sink(stream=sys.stderr, width=30):
+    # 在终端中显示进度条, 阶段结束时输出一行汇总
+    def sink(event):
+        done = event["bytes"] if event["total_bytes"] else event["items"]
+        total = event["total_bytes"] or event["total_items"]
+        counts = "%d/%d" % (event["items"], event["total_items"]) \
+            if event["total_items"] else "%d" % event["items"]
+        rate = "%s/s" % human_size(event["rate"])
+        if event["type"] == "finish":
+            stream.write("\r\033[K%s: %s items, %s in %.1fs (%s)\n"
+                         % (event["stage"], counts, human_size(event["bytes"]),
+                            event["elapsed"], rate))
+        else:
+            frac = min(done / total, 1.0) if total else 0.0
+            bar = "#" * int(frac * width)
+            eta = "--:--" if event["eta"] is None else \
+                "%d:%02d" % divmod(int(event["eta"]), 60)
+            stream.write("\r\033[K%s [%-*s] %3d%% %s %s ETA %s"
+                         % (event["stage"], width, bar, frac * 100, counts, rate, eta))
+        stream.flush()
+    return sink
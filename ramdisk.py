@@ -0,0 +1,237 @@
+#!/usr/bin/env python3
+# encoding: utf-8
+
+import lzma
+import zlib
+
+from collections import OrderedDict
+
+try:
+    import lz4.block as lz4_block
+    import lz4.frame as lz4_frame
+except ImportError:
+    lz4_block = lz4_frame = None
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+# ramdisk 解压
+# 按文件头的 magic 选择解码器, 解码器与 zlib.decompressobj() 的接口相同:
+# decompress(data) 接收任意长度的输入, 返回目前能解出的数据,
+# RamdiskReader 按需逐块送入输入, 解出的 cpio 直接交给 bootimg.iter_cpio
+
+INPUT_CHUNK = 256 * 1024
+
+# 格式名 -> (magic, 解码器工厂)
+RAMDISK_DECODERS = OrderedDict()
+
+def register_decoder(name, magic, factory):
+    RAMDISK_DECODERS[name] = (magic, factory)
+
+def detect_format(data):
+    # 返回格式名 无法识别时返回 None
+    for name, (magic, factory) in RAMDISK_DECODERS.items():
+        if data.startswith(magic):
+            return name
+    return None
+
+class RamdiskReader:
+    # 解压后 cpio 的只读文件对象, 每次读取只解码所需的输入
+
+    def __init__(self, src, decoder):
+        self.src = src
+        self.decoder = decoder
+        self.buf = bytearray()
+
+    def read(self, size=-1):
+        while size < 0 or len(self.buf) < size:
+            data = self.src.read(INPUT_CHUNK)
+            if not data:
+                break
+            self.buf += self.decoder.decompress(data)
+        if size < 0:
+            size = len(self.buf)
+        data = bytes(self.buf[:size])
+        del self.buf[:size]
+        return data
+
+    def close(self):
+        self.src.close()
+
+def open_decoded(src):
+    # src 为定位在 ramdisk 开头的文件对象
+    pos = src.tell()
+    head = src.read(8)
+    src.seek(pos, 0)
+    name = detect_format(head)
+    if name is None:
+        raise IOError('invalid ramdisk')
+    return RamdiskReader(src, RAMDISK_DECODERS[name][1]())
+
+class RawDecoder:
+    # 未压缩的 cpio
+
+    def decompress(self, data):
+        return data
+
+class GzipDecoder:
+    # 与 bootimg.CPIOGZIP 相同, 不校验 crc 和长度
+
+    def __init__(self):
+        self.header = b''
+        self.inflate = None
+
+    def decompress(self, data):
+        if self.inflate is None:
+            self.header += data
+            offset = gzip_header_size(self.header)
+            if offset is None:
+                return b''
+            data = self.header[offset:]
+            self.header = b''
+            self.inflate = zlib.decompressobj(-zlib.MAX_WBITS)
+        if self.inflate.eof:
+            return b''
+        return self.inflate.decompress(data)
+
+def gzip_header_size(data):
+    # 返回 gzip 头的长度 数据不完整时返回 None
+    if len(data) < 10:
+        return None
+    flags = data[3]
+    offset = 10
+    if flags & 4:
+        # FEXTRA
+        if len(data) < offset + 2:
+            return None
+        offset += 2 + int.from_bytes(data[offset:offset + 2], 'little')
+    for flag in (8, 16):
+        # FNAME, FCOMMENT
+        if flags & flag:
+            end = data.find(b'\0', offset)
+            if end < 0:
+                return None
+            offset = end + 1
+    if flags & 2:
+        # FHCRC
+        offset += 2
+    return offset if len(data) >= offset else None
+
+class LzmaDecoder:
+    # xz 和旧的 lzma_alone 格式
+
+    def __init__(self):
+        self.lzma = lzma.LZMADecompressor()
+
+    def decompress(self, data):
+        if self.lzma.eof:
+            return b''
+        return self.lzma.decompress(data)
+
+LZ4_LEGACY_MAGIC = b'\x02\x21\x4c\x18'
+LZ4_LEGACY_BLOCK = 8 * 1024 * 1024
+
+class Lz4LegacyDecoder:
+    # lz4 -l 格式: magic 之后是若干个 <4字节小端长度><lz4 block>,
+    # 每个 block 解压后最多 8 MiB, 多个文件拼接时中间会再次出现 magic.
+    # 内核追加的 4 字节原始大小, 和超过 block 上限的长度都视为结束
+    # 安装了 lz4 模块时使用 lz4.block, 否则使用纯 Python 实现
+
+    def __init__(self, block_decompress=None):
+        self.block_decompress = block_decompress or lz4_block_decompress
+        self.buf = bytearray()
+        self.eof = False
+
+    def decompress(self, data):
+        self.buf += data
+        out = []
+        while not self.eof and len(self.buf) >= 4:
+            if self.buf[:4] == LZ4_LEGACY_MAGIC:
+                del self.buf[:4]
+                continue
+            size = int.from_bytes(self.buf[:4], 'little')
+            if size == 0 or size > LZ4_LEGACY_BLOCK + LZ4_LEGACY_BLOCK // 255 + 16:
+                self.eof = True
+                break
+            if len(self.buf) < 4 + size:
+                break
+            block = bytes(self.buf[4:4 + size])
+            del self.buf[:4 + size]
+            out.append(self.block_decompress(block, LZ4_LEGACY_BLOCK))
+        return b''.join(out)
+
+def lz4_block_decompress(block, max_size):
+    if lz4_block:
+        return lz4_block.decompress(block, uncompressed_size=max_size)
+    return lz4_block_decompress_py(block, max_size)
+
+def lz4_block_decompress_py(src, max_size):
+    # 纯 Python 的 lz4 block 解码
+    dst = bytearray()
+    i = 0
+    n = len(src)
+    while i < n:
+        token = src[i]
+        i += 1
+        length = token >> 4
+        if length == 15:
+            while True:
+                b = src[i]
+                i += 1
+                length += b
+                if b != 255:
+                    break
+        dst += src[i:i + length]
+        i += length
+        if i >= n:
+            break
+        offset = src[i] | (src[i + 1] << 8)
+        i += 2
+        if offset == 0 or offset > len(dst):
+            raise IOError('invalid lz4 block')
+        length = token & 15
+        if length == 15:
+            while True:
+                b = src[i]
+                i += 1
+                length += b
+                if b != 255:
+                    break
+        length += 4
+        start = len(dst) - offset
+        if offset >= length:
+            dst += dst[start:start + length]
+        else:
+            # 重叠复制等于把最后 offset 个字节循环展开
+            pattern = dst[start:]
+            dst += (pattern * (length // offset + 1))[:length]
+        if len(dst) > max_size:
+            raise IOError('lz4 block exceeds %d bytes' % max_size)
+    return bytes(dst)
+
+class MissingDecoder:
+    # 缺少可选模块时在使用时才报错
+
+    def __init__(self, name, module):
+        self.name = name
+        self.module = module
+
+    def __call__(self):
+        raise IOError('%s ramdisk needs the %s module' % (self.name, self.module))
+
+register_decoder('cpio', b'070701', RawDecoder)
+register_decoder('gzip', b'\x1f\x8b\x08', GzipDecoder)
+register_decoder('xz', b'\xfd7zXZ\x00', LzmaDecoder)
+register_decoder('lzma', b'\x5d\x00\x00', LzmaDecoder)
+register_decoder('lz4-legacy', LZ4_LEGACY_MAGIC, Lz4LegacyDecoder)
+if lz4_frame:
+    register_decoder('lz4', b'\x04\x22\x4d\x18', lz4_frame.LZ4FrameDecompressor)
+else:
+    register_decoder('lz4', b'\x04\x22\x4d\x18', MissingDecoder('lz4', 'lz4'))
+if zstandard:
+    register_decoder('zstd', b'\x28\xb5\x2f\xfd',
+                     lambda: zstandard.ZstdDecompressor().decompressobj())
+else:
+    register_decoder('zstd', b'\x28\xb5\x2f\xfd', MissingDecoder('zstd', 'zstandard'))
@@ -0,0 +1,155 @@
+#!/usr/bin/env python3
+# encoding: utf-8
+
+import numpy as np
+
+# 块区间集合
+# 与 AOSP 的 rangelib 相同, 区间为左闭右开的 [start, end),
+# 内部保存为排好序, 互不重叠也不相邻的边界数组 [s0, e0, s1, e1, ...] (numpy int64),
+# 集合运算不逐个比较区间, 而是在两个集合的全部边界上一次性判断归属
+
+class RangeSet:
+
+    __slots__ = ('data',)
+
+    def __init__(self, data=None):
+        # data 为 [(start, end), ...] 或 [s0, e0, s1, e1, ...], 可以无序或重叠
+        if data is None:
+            self.data = np.empty(0, dtype=np.int64)
+            return
+        data = np.asarray(data, dtype=np.int64).reshape(-1)
+        if len(data) % 2:
+            raise ValueError('odd number of range boundaries')
+        self.data = normalize(data[0::2], data[1::2])
+
+    @classmethod
+    def _from_normalized(cls, data):
+        rs = cls.__new__(cls)
+        rs.data = data
+        return rs
+
+    @classmethod
+    def parse(cls, text):
+        # 传输列表的格式: "<边界数>,<s0>,<e0>,<s1>,<e1>..."
+        # 以空格分隔的 "a-b c" 格式也可以接受(b 包含在内)
+        text = text.strip()
+        if '-' in text or ' ' in text:
+            pairs = []
+            for item in text.split():
+                start, _, end = item.partition('-')
+                pairs.append((int(start), int(end or start) + 1))
+            return cls(pairs)
+        nums = np.array(text.split(','), dtype=np.int64)
+        if len(nums) == 0 or nums[0] != len(nums) - 1 or nums[0] % 2:
+            raise ValueError('invalid range set: %s' % text)
+        # new 命令按区间的顺序读取数据, 合并后的顺序必须与原文相同
+        if np.any(np.diff(nums[1:]) < 0):
+            raise ValueError('range set is not sorted: %s' % text)
+        return cls(nums[1:])
+
+    def to_string_raw(self):
+        # 输出为传输列表的格式
+        return ','.join(map(str, [len(self.data)] + self.data.tolist()))
+
+    def __repr__(self):
+        return '<RangeSet %s>' % ' '.join('%d-%d' % (s, e - 1) for s, e in self)
+
+    def __iter__(self):
+        # 依次返回 (start, end)
+        it = iter(self.data.tolist())
+        return zip(it, it)
+
+    def __len__(self):
+        # 区间的个数
+        return len(self.data) // 2
+
+    def __bool__(self):
+        return len(self.data) > 0
+
+    def __eq__(self, other):
+        return isinstance(other, RangeSet) and np.array_equal(self.data, other.data)
+
+    def __hash__(self):
+        return hash(self.data.tobytes())
+
+    @property
+    def size(self):
+        # 包含的块数
+        return int((self.data[1::2] - self.data[0::2]).sum())
+
+    @property
+    def end(self):
+        # 最后一个块之后的位置, 空集合为 0
+        return int(self.data[-1]) if len(self.data) else 0
+
+    def union(self, other):
+        return self._combine(other, np.logical_or)
+
+    def intersect(self, other):
+        return self._combine(other, np.logical_and)
+
+    def subtract(self, other):
+        return self._combine(other, lambda a, b: a & ~b)
+
+    __or__ = union
+    __and__ = intersect
+    __sub__ = subtract
+
+    def overlaps(self, other):
+        return bool(self._combine(other, np.logical_and))
+
+    def _combine(self, other, op):
+        # 两个集合的全部边界把数轴分为若干段, 每段对两个集合的归属是确定的:
+        # 边界数组中位于该段起点右侧的边界数为奇数时, 该段属于这个集合
+        bounds = np.union1d(self.data, other.data)
+        if len(bounds) < 2:
+            return RangeSet()
+        starts = bounds[:-1]
+        mask = op(contains(self.data, starts), contains(other.data, starts))
+        return RangeSet._from_normalized(mask_to_ranges(bounds, mask))
+
+    @classmethod
+    def union_all(cls, sets):
+        # 多个集合一次性合并
+        sets = [s.data for s in sets if len(s.data)]
+        if not sets:
+            return cls()
+        data = np.concatenate(sets)
+        return cls._from_normalized(normalize(data[0::2], data[1::2]))
+
+def contains(data, points):
+    # points 中的每个位置是否落在边界数组 data 表示的集合中
+    return np.searchsorted(data, points, side='right') % 2 == 1
+
+def mask_to_ranges(bounds, mask):
+    # mask[i] 表示 [bounds[i], bounds[i + 1]) 是否在集合中, 合并相邻的段
+    edges = np.diff(np.concatenate(([False], mask, [False])).astype(np.int8))
+    starts = bounds[:-1][edges[:-1] == 1]
+    ends = bounds[1:][edges[1:] == -1]
+    out = np.empty(len(starts) * 2, dtype=np.int64)
+    out[0::2] = starts
+    out[1::2] = ends
+    return out
+
+def normalize(starts, ends):
+    # 任意区间的并集: 起点 +1, 终点 -1, 按位置排序后累加,
+    # 计数从 0 变为正数处为合并后区间的起点, 回到 0 处为终点
+    # 同一位置先处理起点, 相邻的区间因此合并
+    keep = ends > starts
+    starts = starts[keep]
+    ends = ends[keep]
+    if len(starts) == 0:
+        return np.empty(0, dtype=np.int64)
+    pos = np.concatenate((starts, ends))
+    delta = np.concatenate((np.ones(len(starts), dtype=np.int64),
+                            -np.ones(len(ends), dtype=np.int64)))
+    order = np.lexsort((-delta, pos))
+    pos = pos[order]
+    count = np.cumsum(delta[order])
+    prev = np.concatenate(([0], count[:-1]))
+    out_starts = pos[(prev == 0) & (count > 0)]
+    out_ends = pos[(prev > 0) & (count == 0)]
+    out = np.empty(len(out_starts) * 2, dtype=np.int64)
+    out[0::2] = out_starts
+    out[1::2] = out_ends
+    return out
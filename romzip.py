@@ -0,0 +1,165 @@
+#!/usr/bin/env python3
+# encoding: utf-8
+
+import os
+import shutil
+import struct
+import tempfile
+import zipfile
+
+from common import check_file, extract_members, mkdir
+from partition import PARTITION_ORDER
+from payload import read_payload
+from simg2img import expanded_size, is_sparse
+
+class RomZip:
+    # 对 ROM zip 的惰性访问
+    # zip 只打开一次, 各个阶段按需解压自己用到的条目,
+    # 不需要修改的条目可以直接从源 zip 复制到输出 zip
+
+    def __init__(self, file_path, extract_path=None):
+        check_file(file_path)
+        self.file_path = file_path
+        self.zip = zipfile.ZipFile(file_path, "r")
+        self.infos = {}
+        for info in self.zip.infolist():
+            self.infos[info.filename.rstrip("/")] = info
+        if extract_path is None:
+            extract_path = tempfile.mkdtemp("", "OTA-maker_")
+        self.extract_path = extract_path
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def close(self):
+        self.zip.close()
+
+    def exists(self, name):
+        # 判断 zip 中是否存在该文件或目录
+        name = name.strip("/")
+        if name in self.infos:
+            return True
+        prefix = name + "/"
+        return any(n.startswith(prefix) for n in self.infos)
+
+    def listdir(self):
+        # 返回 zip 根目录下的条目名
+        return sorted({n.split("/", 1)[0] for n in self.infos})
+
+    def members(self, name):
+        # 返回目录下所有文件条目的名称
+        prefix = name.strip("/") + "/"
+        return [n for n, i in self.infos.items()
+                if n.startswith(prefix) and not i.is_dir()]
+
+    def getinfo(self, name):
+        return self.infos[name.strip("/")]
+
+    def open(self, name):
+        return self.zip.open(self.getinfo(name))
+
+    def read(self, name):
+        return self.zip.read(self.getinfo(name))
+
+    def data_offset(self, name):
+        # 未压缩存储的条目返回其数据在 zip 文件中的偏移, 可以直接按偏移读取
+        # 压缩存储时返回 None
+        info = self.getinfo(name)
+        if info.compress_type != zipfile.ZIP_STORED:
+            return None
+        with open(self.file_path, "rb") as f:
+            f.seek(info.header_offset)
+            header = f.read(30)
+        if header[:4] != b"PK\x03\x04":
+            raise zipfile.BadZipFile("bad local file header: %s" % name)
+        name_len, extra_len = struct.unpack("<HH", header[26:30])
+        return info.header_offset + 30 + name_len + extra_len
+
+    def extract(self, name):
+        # 解压单个条目 返回解压后的路径
+        info = self.getinfo(name)
+        dst = os.path.join(self.extract_path, *info.filename.rstrip("/").split("/"))
+        if info.is_dir():
+            mkdir(dst)
+        elif not os.path.exists(dst):
+            mkdir(os.path.dirname(dst))
+            with self.zip.open(info) as src, open(dst, "wb") as f:
+                shutil.copyfileobj(src, f, 1024 * 1024)
+        return dst
+
+    def extract_many(self, names, stage=None, workers=None):
+        # 多线程解压多个条目, 已解压的跳过
+        # 返回 (文件数, 解压后的字节数, 耗时), 见 common.extract_members
+        infos = []
+        for name in names:
+            info = self.getinfo(name)
+            if os.path.exists(os.path.join(self.extract_path, *info.filename.rstrip("/").split("/"))) \
+               and not info.is_dir():
+                if stage:
+                    stage.advance(1, info.file_size)
+                continue
+            infos.append(info)
+        return extract_members(self.file_path, self.extract_path, infos, workers, stage)
+
+    def path(self, name):
+        # 返回条目在解压目录中的路径
+        # 尚未解压时从 zip 中取出, 两者都不存在时返回 None
+        dst = os.path.join(self.extract_path, *name.strip("/").split("/"))
+        if os.path.exists(dst):
+            return dst
+        if name.strip("/") in self.infos:
+            return self.extract(name)
+        return None
+
+    def projected_size(self):
+        # 估算解压和解包本ROM所需的空间
+        # 镜像大小按传输列表中需要写入的块数估算,
+        # 各分区同时解码, 需要额外容纳所有分区的 *.br 和 *.new.dat
+        if self.exists('system/app'):
+            return sum(i.file_size for n, i in self.infos.items()
+                       if n.startswith('system/'))
+        if 'payload.bin' in self.infos:
+            # payload 中分区的大小, 压缩存储的 payload 需要先解压
+            with self.open('payload.bin') as f:
+                partitions = read_payload(f)[2]
+            total = sum(size for name, size, ops in partitions if name in PARTITION_ORDER)
+            if self.data_offset('payload.bin') is None:
+                total += self.infos['payload.bin'].file_size
+            return total
+        total = extra = 0
+        for name in self.listdir():
+            if name.endswith('.transfer.list'):
+                with self.open(name) as f:
+                    f.readline()
+                    new_bytes = int(f.readline()) * 4096
+                br = self.infos.get(name[:-14] + '.new.dat.br')
+                total += new_bytes
+                extra += new_bytes + (br.file_size if br else 0)
+            elif name.endswith('.img') and name[:-4] in PARTITION_ORDER:
+                file_size = self.infos[name].file_size
+                with self.open(name) as f:
+                    sparse = is_sparse(f.read(4))
+                if sparse:
+                    # sparse 镜像展开时原文件和展开后的文件同时存在
+                    with self.open(name) as f:
+                        total += expanded_size(f)
+                    extra += file_size
+                else:
+                    total += file_size
+        return total + extra
+
+    def copy_to(self, out_zip, name, arcname=None):
+        # 将条目直接写入另一个 zip, 不经过磁盘
+        info = self.getinfo(name)
+        if info.is_dir():
+            return
+        out_info = zipfile.ZipInfo(arcname or info.filename, info.date_time)
+        out_info.compress_type = info.compress_type
+        out_info.external_attr = info.external_attr
+        with self.zip.open(info) as src, \
+             out_zip.open(out_info, "w",
+                          force_zip64=info.file_size > zipfile.ZIP64_LIMIT) as dst:
+            shutil.copyfileobj(src, dst, 1024 * 1024)
@@ -0,0 +1,121 @@
+#!/usr/bin/env python3
+# encoding: utf-8
+
+import os
+import shutil
+import tempfile
+import threading
+
+from collections import OrderedDict
+from common import NoSpaceError, get_size, human_size, remove_path
+
+class Scratch:
+    # 临时空间管理
+    # 体积大的中间文件(镜像等)放在 root,
+    # 频繁读写的小文件(补丁, OTA 打包目录)优先放在 fast_root (例如 tmpfs)
+    # 同时统计各阶段占用的空间, 并按引用计数管理中间产物的生命周期
+    # 指定 workdir 时解包和打包目录放在其中, 其中的文件保留到构建成功, 供中断后恢复
+
+    def __init__(self, root=None, fast_root=None, workdir=None):
+        self.root = root or tempfile.gettempdir()
+        self.fast_root = fast_root
+        self.workdir = workdir and os.path.abspath(workdir)
+        self.finished = False
+        self.usage = OrderedDict()
+        self.freed = 0
+        self.peak = 0
+        self.dirs = []
+        self.artifacts = OrderedDict()
+        # 各分区在不同的线程中登记和释放产物
+        self.lock = threading.Lock()
+
+    def mkdtemp(self, hot=False, size=0, name=None):
+        # hot 为 True 时优先使用 fast_root, 剩余空间不足 size 时退回 root
+        # 指定 workdir 时, 有 name 的目录为 workdir 下的固定目录
+        if self.workdir and name:
+            path = os.path.join(self.workdir, name)
+            os.makedirs(path, exist_ok=True)
+            self.dirs.append(path)
+            return path
+        root = self.root
+        if hot and self.fast_root and free_space(self.fast_root) > size:
+            root = self.fast_root
+        path = tempfile.mkdtemp("", "OTA-maker_", dir=root)
+        self.dirs.append(path)
+        return path
+
+    def check_space(self, projected, path=None):
+        # 预计占用超过剩余空间时提前失败
+        path = path or self.root
+        free = free_space(path)
+        if projected > free:
+            raise NoSpaceError("%s: need %s but only %s free"
+                               % (path, human_size(projected), human_size(free)))
+
+    def account(self, phase, *paths):
+        # 记录某一阶段结束时 paths 占用的空间
+        used = sum(get_size(p) for p in paths)
+        self.usage[phase] = used
+        self.peak = max(self.peak, used)
+        return used
+
+    def release(self, *paths):
+        # 中间文件的最后一个使用者结束后立即删除
+        for p in paths:
+            if self.persistent(p):
+                continue
+            size = get_size(p)
+            remove_path(p)
+            with self.lock:
+                self.freed += size
+
+    def persistent(self, path):
+        # 构建成功之前不删除工作目录中的文件
+        return bool(self.workdir) and not self.finished and \
+            os.path.abspath(path).startswith(self.workdir + os.sep)
+
+    def retain(self, path, refs=1, on_release=None):
+        # 登记一个中间产物及其使用者的数量
+        # on_release 在删除之前调用, 例如卸载挂载点
+        with self.lock:
+            if path in self.artifacts:
+                self.artifacts[path][0] += refs
+            else:
+                self.artifacts[path] = [refs, on_release]
+
+    def unref(self, path):
+        # 一个使用者结束, 计数归零时立即释放该产物
+        with self.lock:
+            entry = self.artifacts.get(path)
+            if entry is None:
+                return
+            entry[0] -= 1
+            if entry[0] > 0:
+                return
+            del self.artifacts[path]
+        if entry[1]:
+            entry[1](path)
+        self.release(path)
+
+    def report(self):
+        lines = ["%-10s %s" % (phase, human_size(used))
+                 for phase, used in self.usage.items()]
+        lines.append("%-10s %s" % ("freed", human_size(self.freed)))
+        lines.append("%-10s %s" % ("peak", human_size(self.peak)))
+        return lines
+
+    def cleanup(self, finished=False):
+        # 先释放仍被持有的产物(卸载挂载点等) 再删除临时目录
+        # 构建失败时(finished 为 False)工作目录中只卸载, 不删除
+        self.finished = self.finished or finished
+        for path in reversed(list(self.artifacts)):
+            if path in self.artifacts:
+                self.artifacts[path][0] = 1
+                self.unref(path)
+        for p in self.dirs:
+            if not self.persistent(p):
+                remove_path(p)
+        self.dirs = []
+
+def free_space(path):
+    return shutil.disk_usage(path).free
@@ -7,9 +7,10 @@
 #====================================================
 
 import sys, os, errno
+from rangelib import RangeSet
 
 def main(TRANSFER_LIST_FILE, NEW_DATA_FILE, OUTPUT_IMAGE_FILE,
-         silent_mode=False):
+         silent_mode=False, progress=None):
     __version__ = '1.1'
 
     if silent_mode:
@@ -30,14 +31,12 @@ def main(TRANSFER_LIST_FILE, NEW_DATA_FILE, OUTPUT_IMAGE_FILE,
         print('sdat2img binary - version: %s\n' % __version__)
 
     def rangeset(src):
-        src_set = src.split(',')
-        num_set =  [int(item) for item in src_set]
-        if len(num_set) != num_set[0]+1:
+        try:
+            return RangeSet.parse(src)
+        except ValueError:
             print('Error on parsing following data to rangeset:\n%s' % src)
             sys.exit(1)
 
-        return tuple ([ (num_set[i], num_set[i+1]) for i in range(1, len(num_set), 2) ])
-
     def parse_transfer_list_file(path):
         trans_list = open(TRANSFER_LIST_FILE, 'r')
 
@@ -97,14 +96,11 @@ def main(TRANSFER_LIST_FILE, NEW_DATA_FILE, OUTPUT_IMAGE_FILE,
             raise
 
     new_data_file = open(NEW_DATA_FILE, 'rb')
-    all_block_sets = [i for command in commands for i in command[1]]
-    max_file_size = max(pair[1] for pair in all_block_sets)*BLOCK_SIZE
+    max_file_size = RangeSet.union_all(command[1] for command in commands).end*BLOCK_SIZE
 
     for command in commands:
         if command[0] == 'new':
-            for block in command[1]:
-                begin = block[0]
-                end = block[1]
+            for begin, end in command[1]:
                 block_count = end - begin
                 print('Copying {} blocks into position {}...'.format(block_count, begin))
 
@@ -115,6 +111,9 @@ def main(TRANSFER_LIST_FILE, NEW_DATA_FILE, OUTPUT_IMAGE_FILE,
                 while(block_count > 0):
                     output_img.write(new_data_file.read(BLOCK_SIZE))
                     block_count -= 1
+
+                if progress:
+                    progress((end - begin) * BLOCK_SIZE)
         else:
             print('Skipping command %s...' % command[0])
 
@@ -0,0 +1,88 @@
+#!/usr/bin/env python3
+# encoding: utf-8
+
+import struct
+
+# file_contexts.bin (sefcontext_compile 的输出) 解析
+# 格式见 libselinux src/label_file.c load_mmap():
+#   u32 magic, u32 version
+#   version >= 2: u32 len + pcre 版本字符串
+#   version >= 5: u32 len + regex 架构字符串
+#   u32 stem 数量, 每个 stem: u32 len + 字符串(含结尾 \0)
+#   u32 规则数量, 每条规则:
+#     u32 len + context(含结尾 \0)
+#     u32 len + 正则(含结尾 \0)
+#     u32 mode, s32 stem_id, u32 hasMetaChars
+#     version >= 4: u32 prefix_len
+#     version >= 2: 预编译的正则, pcre 为 正则 + study 数据两段, pcre2 只有一段
+# 只取出正则和 context, 预编译的数据直接跳过
+
+FC_MAGIC = 0xf97cff8a
+FC_VERSION_PCRE = 2
+FC_VERSION_PREFIX_LEN = 4
+FC_VERSION_REGEX_ARCH = 5
+FC_VERSION_MAX = 5
+
+class FileContextsError(ValueError):
+    pass
+
+def is_binary(data):
+    return len(data) >= 4 and struct.unpack_from('<I', data)[0] == FC_MAGIC
+
+def parse_bin(data):
+    # 返回 [(正则, context), ...], 顺序与文件中相同
+    offset = 0
+
+    def u32():
+        nonlocal offset
+        if offset + 4 > len(data):
+            raise FileContextsError('truncated file_contexts.bin')
+        value, = struct.unpack_from('<I', data, offset)
+        offset += 4
+        return value
+
+    def blob():
+        nonlocal offset
+        size = u32()
+        if offset + size > len(data):
+            raise FileContextsError('truncated file_contexts.bin')
+        value = data[offset:offset + size]
+        offset += size
+        return value
+
+    def string():
+        value = blob()
+        return value[:-1].decode('UTF-8') if value.endswith(b'\0') else value.decode('UTF-8')
+
+    if u32() != FC_MAGIC:
+        raise FileContextsError('not a file_contexts.bin')
+    version = u32()
+    if not 1 <= version <= FC_VERSION_MAX:
+        raise FileContextsError('unsupported file_contexts.bin version %d' % version)
+    pcre2 = False
+    if version >= FC_VERSION_PCRE:
+        # pcre 为 8.x, pcre2 为 10.x
+        pcre2 = blob().decode('latin').startswith('10.')
+    if version >= FC_VERSION_REGEX_ARCH:
+        blob()
+
+    for i in range(u32()):
+        # stem 的长度不含结尾的 \0
+        size = u32()
+        offset += size + 1
+
+    rules = []
+    for i in range(u32()):
+        context = string()
+        regex = string()
+        u32() # mode
+        u32() # stem_id
+        u32() # hasMetaChars
+        if version >= FC_VERSION_PREFIX_LEN:
+            u32() # prefix_len
+        if version >= FC_VERSION_PCRE:
+            blob()
+            if not pcre2:
+                blob() # study data
+        rules.append((regex, context))
+    return rules
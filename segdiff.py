@@ -0,0 +1,43 @@
+#!/usr/bin/env python3
+# encoding: utf-8
+
+import bsdiff4
+import hashlib
+
+# 分段 diff
+# 大文件按对齐的窗口切分, 每个窗口单独生成补丁, 可以在进程池中并行,
+# 每个任务的内存占用只与窗口大小有关.
+# 第 i 段的新数据为 [i * seg_size, (i + 1) * seg_size),
+# 对应的旧数据为同一位置前后各扩展 margin 的窗口(截断到旧文件末尾)
+
+BLOCK_SIZE = 4096
+
+def split_segments(old_size, new_size, seg_size, margin):
+    # 返回 [(old_offset, old_length, new_offset, new_length), ...]
+    # 偏移均按 BLOCK_SIZE 对齐, 便于设备端用 dd 按块读取
+    # 旧窗口的结尾也按块对齐或者就是旧文件末尾, 与 dd 按块读出的数据一致
+    assert seg_size % BLOCK_SIZE == 0 and margin % BLOCK_SIZE == 0
+    segments = []
+    for new_offset in range(0, new_size, seg_size):
+        new_length = min(seg_size, new_size - new_offset)
+        old_offset = min(max(new_offset - margin, 0), old_size // BLOCK_SIZE * BLOCK_SIZE)
+        old_end = -(-(new_offset + new_length + margin) // BLOCK_SIZE) * BLOCK_SIZE
+        old_end = min(old_end, old_size)
+        segments.append((old_offset, max(old_end - old_offset, 0), new_offset, new_length))
+    return segments
+
+def read_window(path, offset, length):
+    with open(path, "rb") as f:
+        f.seek(offset)
+        return f.read(length)
+
+def diff_segment(old_path, new_path, patch_path, old_offset, old_length,
+                 new_offset, new_length):
+    # 生成一段的补丁 返回 (旧窗口sha1, 新窗口sha1, 新窗口大小)
+    old_data = read_window(old_path, old_offset, old_length)
+    new_data = read_window(new_path, new_offset, new_length)
+    with open(patch_path, "wb") as f:
+        f.write(bsdiff4.diff(old_data, new_data))
+    return (hashlib.sha1(old_data).hexdigest(),
+            hashlib.sha1(new_data).hexdigest(),
+            len(new_data))
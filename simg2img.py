@@ -0,0 +1,221 @@
+#!/usr/bin/env python3
+# encoding: utf-8
+
+import bisect
+import os
+import struct
+import sys
+
+# Android sparse image (simg) 解析
+# 格式见 AOSP system/core/libsparse/sparse_format.h:
+#   文件头: u32 magic, u16 major, u16 minor, u16 file_hdr_sz, u16 chunk_hdr_sz,
+#           u32 blk_sz, u32 total_blks, u32 total_chunks, u32 image_checksum
+#   chunk 头: u16 chunk_type, u16 reserved, u32 chunk_sz(块数), u32 total_sz(含头的字节数)
+#   RAW 后接 chunk_sz * blk_sz 字节数据, FILL 后接 4 字节的填充值,
+#   DONT_CARE 没有数据, CRC32 后接 4 字节校验值(只解析不校验)
+# unsparse() 顺序读取输入, DONT_CARE 和填充 0 的块在输出中留为空洞,
+# SparseImage 只读取 chunk 表, 按偏移直接读取对应 chunk 的数据, 不展开整个镜像
+
+SPARSE_HEADER_MAGIC = 0xed26ff3a
+SPARSE_HEADER = struct.Struct('<IHHHHIIII')
+CHUNK_HEADER = struct.Struct('<HHII')
+
+CHUNK_TYPE_RAW = 0xcac1
+CHUNK_TYPE_FILL = 0xcac2
+CHUNK_TYPE_DONT_CARE = 0xcac3
+CHUNK_TYPE_CRC32 = 0xcac4
+
+COPY_CHUNK = 1024 * 1024
+
+class SparseImageError(ValueError):
+    pass
+
+def is_sparse(data):
+    # data 为文件开头的若干字节
+    return len(data) >= 4 and struct.unpack_from('<I', data)[0] == SPARSE_HEADER_MAGIC
+
+def is_sparse_file(path):
+    with open(path, 'rb') as f:
+        return is_sparse(f.read(4))
+
+def _read_exact(f, size):
+    data = f.read(size)
+    if len(data) != size:
+        raise SparseImageError('truncated sparse image')
+    return data
+
+def read_header(f):
+    # 返回 (块大小, 总块数, chunk 数, chunk 头大小), 文件位置移到第一个 chunk
+    (magic, major, minor, file_hdr_sz, chunk_hdr_sz,
+     blk_sz, total_blks, total_chunks, checksum) = SPARSE_HEADER.unpack(_read_exact(f, SPARSE_HEADER.size))
+    if magic != SPARSE_HEADER_MAGIC:
+        raise SparseImageError('not a sparse image')
+    if major != 1:
+        raise SparseImageError('unsupported sparse image version %d.%d' % (major, minor))
+    if file_hdr_sz < SPARSE_HEADER.size or chunk_hdr_sz < CHUNK_HEADER.size or blk_sz % 4:
+        raise SparseImageError('invalid sparse image header')
+    # 头部可能比已知的结构长
+    _read_exact(f, file_hdr_sz - SPARSE_HEADER.size)
+    return blk_sz, total_blks, total_chunks, chunk_hdr_sz
+
+def expanded_size(f):
+    # 展开后的镜像大小 f 定位在文件开头
+    blk_sz, total_blks, total_chunks, chunk_hdr_sz = read_header(f)
+    return blk_sz * total_blks
+
+def iter_chunks(f, chunk_hdr_sz, total_chunks, blk_sz):
+    # 依次返回 (类型, 块数, 数据大小), 调用者负责读取或跳过 RAW 的数据
+    for i in range(total_chunks):
+        chunk_type, reserved, chunk_sz, total_sz = CHUNK_HEADER.unpack(_read_exact(f, CHUNK_HEADER.size))
+        _read_exact(f, chunk_hdr_sz - CHUNK_HEADER.size)
+        data_sz = total_sz - chunk_hdr_sz
+        if chunk_type == CHUNK_TYPE_RAW:
+            if data_sz != chunk_sz * blk_sz:
+                raise SparseImageError('invalid raw chunk size')
+        elif chunk_type in (CHUNK_TYPE_FILL, CHUNK_TYPE_CRC32):
+            if data_sz != 4:
+                raise SparseImageError('invalid chunk size')
+        elif chunk_type == CHUNK_TYPE_DONT_CARE:
+            if data_sz != 0:
+                raise SparseImageError('invalid dont care chunk size')
+        else:
+            raise SparseImageError('unknown chunk type 0x%x' % chunk_type)
+        yield chunk_type, chunk_sz, data_sz
+
+def unsparse(src, dst, progress=None):
+    # src 为可顺序读取的文件对象(例如 zip 中的条目), dst 为可 seek 的输出文件
+    # progress 为每处理一个 chunk 后调用的函数, 参数为输出的字节数
+    # 返回展开后的大小
+    blk_sz, total_blks, total_chunks, chunk_hdr_sz = read_header(src)
+    offset = 0
+    for chunk_type, chunk_sz, data_sz in iter_chunks(src, chunk_hdr_sz, total_chunks, blk_sz):
+        size = chunk_sz * blk_sz
+        if chunk_type == CHUNK_TYPE_RAW:
+            dst.seek(offset)
+            remaining = size
+            while remaining:
+                data = _read_exact(src, min(COPY_CHUNK, remaining))
+                dst.write(data)
+                remaining -= len(data)
+        elif chunk_type == CHUNK_TYPE_FILL:
+            fill = _read_exact(src, 4)
+            if fill != b'\0\0\0\0':
+                dst.seek(offset)
+                block = fill * (COPY_CHUNK // 4)
+                remaining = size
+                while remaining:
+                    dst.write(block[:min(COPY_CHUNK, remaining)])
+                    remaining -= min(COPY_CHUNK, remaining)
+        elif chunk_type == CHUNK_TYPE_CRC32:
+            _read_exact(src, 4)
+        offset += size
+        if progress and size:
+            progress(size)
+    if offset != total_blks * blk_sz:
+        raise SparseImageError('sparse image has %d blocks, expected %d' % (offset // blk_sz, total_blks))
+    # 末尾的空洞需要扩展文件大小
+    dst.truncate(offset)
+    return offset
+
+def unsparse_file(path, out_path=None, progress=None):
+    # 展开 sparse 镜像 out_path 为 None 时原地替换
+    tmp_path = (out_path or path) + '.unsparse'
+    with open(path, 'rb') as src, open(tmp_path, 'wb') as dst:
+        unsparse(src, dst, progress)
+    os.replace(tmp_path, out_path or path)
+    return out_path or path
+
+class SparseImage:
+    # 展开后镜像的只读随机访问文件对象
+    # 打开时只读取 chunk 头, 读取时定位到对应的 chunk
+
+    def __init__(self, f):
+        # f 为可 seek 的文件对象, 或文件路径
+        if isinstance(f, str):
+            f = open(f, 'rb')
+        self.f = f
+        self.blk_sz, self.total_blks, total_chunks, chunk_hdr_sz = read_header(f)
+        self.size = self.total_blks * self.blk_sz
+        # 每个 chunk: 起始偏移(展开后), 结束偏移, 类型, 数据在文件中的偏移或填充值
+        self.starts = []
+        self.chunks = []
+        offset = 0
+        for chunk_type, chunk_sz, data_sz in iter_chunks(f, chunk_hdr_sz, total_chunks, self.blk_sz):
+            size = chunk_sz * self.blk_sz
+            if chunk_type == CHUNK_TYPE_RAW:
+                data = f.tell()
+                f.seek(data_sz, 1)
+            elif chunk_type == CHUNK_TYPE_FILL:
+                data = _read_exact(f, 4)
+            else:
+                data = None
+                f.seek(data_sz, 1)
+            if size and chunk_type != CHUNK_TYPE_CRC32:
+                self.starts.append(offset)
+                self.chunks.append((offset, offset + size, chunk_type, data))
+            offset += size
+        if offset != self.size:
+            raise SparseImageError('sparse image has %d blocks, expected %d' % (offset // self.blk_sz, self.total_blks))
+        self.pos = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def close(self):
+        self.f.close()
+
+    def seekable(self):
+        return True
+
+    def readable(self):
+        return True
+
+    def tell(self):
+        return self.pos
+
+    def seek(self, offset, whence=0):
+        if whence == 1:
+            offset += self.pos
+        elif whence == 2:
+            offset += self.size
+        if offset < 0:
+            raise ValueError('negative seek position %d' % offset)
+        self.pos = offset
+        return self.pos
+
+    def read(self, size=-1):
+        end = self.size if size is None or size < 0 else min(self.pos + size, self.size)
+        out = []
+        i = bisect.bisect_right(self.starts, self.pos) - 1
+        while self.pos < end:
+            start, stop, chunk_type, data = self.chunks[i]
+            n = min(stop, end) - self.pos
+            if chunk_type == CHUNK_TYPE_RAW:
+                self.f.seek(data + self.pos - start)
+                out.append(_read_exact(self.f, n))
+            elif chunk_type == CHUNK_TYPE_FILL:
+                # 填充值按 4 字节对齐重复
+                shift = (self.pos - start) % 4
+                out.append((data * ((n + shift) // 4 + 1))[shift:shift + n])
+            else:
+                out.append(bytes(n))
+            self.pos += n
+            i += 1
+        return b''.join(out)
+
+    def readinto(self, b):
+        data = self.read(len(b))
+        b[:len(data)] = data
+        return len(data)
+
+if __name__ == '__main__':
+    if len(sys.argv) < 2:
+        print('Usage: simg2img.py <sparse_image> [raw_image]')
+        sys.exit(1)
+    if not is_sparse_file(sys.argv[1]):
+        print('%s: not a sparse image' % sys.argv[1])
+        sys.exit(1)
+    unsparse_file(sys.argv[1], sys.argv[2] if len(sys.argv) > 2 else None)
@@ -0,0 +1,407 @@
+#!/usr/bin/env python3
+# encoding: utf-8
+
+import argparse
+import bsdiff4
+import hashlib
+import os
+import sys
+
+from collections import OrderedDict, namedtuple
+from common import PathNotFoundError, check_file, human_size, make_zip, mkdir, remove_path
+from romzip import RomZip
+from scratch import Scratch
+from updater import Updater, batched
+
+# 合并连续的 OTA 包: A->B, B->C, ... 合并为一个 A->C 的包
+# 只读取 makeota 生成的 update-binary 和 install/patches, 不需要原来的 ROM:
+#   新文件取最后一次的内容, 删除和 symlink 依次叠加, 元数据按顺序重放(去掉之后被删除的文件)
+#   只在一个包中打补丁的文件直接使用原补丁
+#   前一个包中是新文件, 后一个包中打补丁的文件在本机打补丁后作为新文件
+#   多个包中都打补丁的文件没有 A 的内容, 在设备端按顺序逐轮打补丁
+
+SCRIPT_MARK = "# The following is the script to execute.\n"
+GENERATOR_MARK = "# Generate by OTA-maker"
+
+# update-binary 中各阶段开头的提示
+SECTIONS = {
+    "Checking files...": "check",
+    "Extracting patch files...": "patch",
+    "Patching files...": "patch",
+    "Extracting files...": "extract",
+    "Setting metadata...": "metadata",
+    "Deleting files...": "delete",
+    "Making symlinks...": "symlink",
+    "Running updater-script from source zip...": "source",
+}
+
+# 一次补丁: 原文件哈希, 打补丁后的文件哈希和大小, 补丁所在的包,
+# 补丁文件(分段补丁为补丁目录) 以及分段补丁的 (旧窗口偏移, 旧窗口大小, 旧窗口sha1, 新段sha1, 新段大小) 列表
+Step = namedtuple("Step", "src tgt size rom patch segments")
+
+class SquashError(ValueError):
+    pass
+
+def zip_member(path):
+    # 设备端的补丁路径 /tmp/patch/... 对应包中的 patch/...
+    return path[len("/tmp/"):] if path.startswith("/tmp/") else path
+
+def under(path, dirs):
+    # path 是否为集合 dirs 中的某一项或位于其下
+    while path:
+        if path in dirs:
+            return True
+        path = path.rpartition("/")[0]
+    return False
+
+class Package:
+    # 解析 makeota 生成的 OTA 包
+
+    def __init__(self, file_path, extract_path):
+        self.file_path = file_path
+        self.rom = RomZip(file_path, extract_path)
+        script = ""
+        if self.rom.exists("META-INF/com/google/android/update-binary"):
+            script = self.rom.read("META-INF/com/google/android/update-binary").decode("UTF-8", "replace")
+        if SCRIPT_MARK not in script or GENERATOR_MARK not in script:
+            raise SquashError("%s: not an OTA package made by OTA-maker" % file_path)
+        self.header = []
+        self.roots = []
+        self.patches = OrderedDict()
+        self.news = OrderedDict()
+        self.deletes = []
+        self.metadata = []
+        self.symlinks = OrderedDict()
+        self.source = []
+        self.passthrough = []
+        manifest = None
+        segmented = {}
+        copies = []
+        section = "header"
+        for line in script.split(SCRIPT_MARK, 1)[1].splitlines():
+            words = line.split()
+            if not words or line.startswith("#") or words[0] in ("phase_begin", "phase_end", "phase_report"):
+                continue
+            if section == "source":
+                # 原版脚本的操作到 sync 为止
+                if line == "sync":
+                    break
+                self.source.append(line)
+                if words[0] == "package_extract_file":
+                    self.passthrough.append(words[1])
+                elif words[0] == "package_extract_dir":
+                    self.passthrough += self.rom.members(words[1])
+                continue
+            if words[0] == "ui_print" and line[10:-2] in SECTIONS:
+                section = SECTIONS[line[10:-2]]
+            elif section == "header":
+                if line.startswith("SYS_LD_LIBRARY_PATH=") or line.startswith('[ "$(getprop ro.product.device)"'):
+                    self.header.append(line)
+                elif words[0] == "mount":
+                    self.roots.append(words[1])
+            elif words[0] == "apply_patch_check_list":
+                manifest = zip_member(words[1])
+            elif words[0] == "apply_patch_segmented":
+                segmented[words[1]] = (zip_member(words[3]), [tuple(s.split(":")) for s in words[4:]])
+            elif section == "extract" and words[0] == "copy_files":
+                copies.append((words[1], words[2:]))
+            elif section == "metadata" and words[0] == "set_metadata_recursive":
+                self.metadata.append(("recursive", words[1], line))
+            elif section == "metadata" and words[0] == "set_metadata_files":
+                self.metadata.append(("files", words[1:5], words[5:]))
+            elif section == "delete" and words[0] == "delete":
+                self.deletes += words[1:]
+            elif section == "symlink" and words[0] == "symlink":
+                for link in words[2:]:
+                    self.symlinks[link] = words[1]
+        if manifest:
+            for line in self.rom.read(manifest).decode("UTF-8").splitlines():
+                path, src, tgt, size, patch = line.split()
+                if patch == "-":
+                    patch, segments = segmented[path]
+                else:
+                    patch, segments = zip_member(patch), None
+                self.patches[path] = Step(src, tgt, int(size), self.rom, patch, segments)
+        # 各分区目录下的文件为新文件
+        for root in self.roots:
+            for name in self.rom.members(root[1:]):
+                self.news["/" + name] = name
+        # 内容相同的新文件只打包一份, 设备端复制到其他位置
+        for src, dsts in copies:
+            for path in dsts:
+                self.news[path] = self.news[src]
+
+    def close(self):
+        self.rom.close()
+
+def read_content(content):
+    # content 为 (RomZip, 条目名) 或 (None, 本地文件路径)
+    rom, name = content
+    if rom:
+        return rom.read(name)
+    with open(name, "rb") as f:
+        return f.read()
+
+def sha1(data):
+    return hashlib.sha1(data).hexdigest()
+
+def apply_step(path, old, step):
+    # 在本机对 old 打一次补丁, 返回新文件的内容
+    if step.segments is None:
+        if sha1(old) != step.src:
+            raise SquashError("%s: contents do not match the next package" % path)
+        new = bsdiff4.patch(old, step.rom.read(step.patch))
+    else:
+        parts = []
+        for i, (offset, length, src, tgt, size) in enumerate(step.segments):
+            window = old[int(offset):int(offset) + int(length)]
+            if sha1(window) != src:
+                raise SquashError("%s: segment %d does not match the next package" % (path, i))
+            parts.append(bsdiff4.patch(window, step.rom.read("%s/%d.p" % (step.patch, i))))
+        new = b"".join(parts)
+    if sha1(new) != step.tgt or len(new) != step.size:
+        raise SquashError("%s: unexpected contents after patching" % path)
+    return new
+
+def squash(OTA_ZIPS, OUT_PATH, tmpdir=None, log=print):
+    # 也可作为库函数调用, OTA_ZIPS 按升级顺序排列
+    if len(OTA_ZIPS) < 2:
+        raise SquashError("at least two OTA packages are needed")
+    check_file(*OTA_ZIPS)
+    scratch = Scratch(tmpdir)
+    packages = []
+    try:
+        for ota in OTA_ZIPS:
+            log("Reading %s ..." % ota)
+            packages.append(Package(ota, scratch.mkdtemp()))
+        return squash_packages(packages, OUT_PATH, scratch, log)
+    finally:
+        for package in packages:
+            package.close()
+        scratch.cleanup()
+
+def squash_packages(packages, OUT_PATH, scratch, log):
+    OTA_ZIP_PATH = scratch.mkdtemp(hot=True)
+    # 路径 -> ('new', 内容) 或 ('patch', [Step, ...])
+    files = OrderedDict()
+    deletes = OrderedDict()
+    metadata = []
+    symlinks = OrderedDict()
+    roots = []
+    # 打过补丁的文件, 需要清除 dalvik 缓存
+    patched = set()
+    # 在本机打补丁后写入打包目录的文件
+    local_files = set()
+    rebuilt = 0
+    for package in packages:
+        for path in package.deletes:
+            deletes[path] = True
+        removed = set(package.deletes)
+        for path in [p for p in files if under(p, removed)]:
+            del files[path]
+            patched.discard(path)
+        for path in [p for p in symlinks if under(p, removed)]:
+            del symlinks[path]
+        metadata = [(kind, key, value if kind == "recursive" else
+                     [f for f in value if not under(f, removed)])
+                    for kind, key, value in metadata
+                    if kind != "recursive" or not under(key, removed)]
+        for path, step in package.patches.items():
+            patched.add(path)
+            kind, value = files.get(path, (None, None))
+            if kind == "new":
+                # 上一步的新文件已知全部内容, 在本机打补丁
+                new = apply_step(path, read_content(value), step)
+                local = OTA_ZIP_PATH + path
+                mkdir(os.path.dirname(local))
+                with open(local, "wb") as f:
+                    f.write(new)
+                files[path] = ("new", (None, local))
+                local_files.add(path)
+                rebuilt += 1
+            elif kind == "patch":
+                if value[-1].tgt != step.src:
+                    raise SquashError("%s: %s does not follow the previous package"
+                                      % (path, package.file_path))
+                value.append(step)
+            else:
+                files[path] = ("patch", [step])
+        for path, name in package.news.items():
+            files[path] = ("new", (package.rom, name))
+            symlinks.pop(path, None)
+        for path, target in package.symlinks.items():
+            symlinks[path] = target
+            if path in files:
+                del files[path]
+        metadata += package.metadata
+        roots += [r for r in package.roots if r not in roots]
+    last = packages[-1]
+
+    # 本机重建的文件被之后的包替换或删除时 去掉留在打包目录中的旧内容
+    for path in local_files:
+        if files.get(path, (None, (None, None)))[1] != (None, OTA_ZIP_PATH + path):
+            remove_path(OTA_ZIP_PATH + path)
+    # 补丁链的结果与原文件相同时不需要任何操作
+    for path, (kind, steps) in list(files.items()):
+        if kind == "patch" and steps[-1].tgt == steps[0].src:
+            del files[path]
+            patched.discard(path)
+    patch_items = [(p, steps) for p, (kind, steps) in files.items() if kind == "patch"]
+    chained = sum(1 for p, steps in patch_items if len(steps) > 1)
+    log("Files patched in one step: %d, rebuilt from new files: %d, chained: %d"
+        % (len(patch_items) - chained, rebuilt, chained))
+
+    passthrough = []
+    log("Generating updater...")
+    tmp_updater = Updater()
+    mkdir(OTA_ZIP_PATH + "/install")
+    passthrough.append((last.rom, "install/applypatch"))
+    for line in last.header:
+        tmp_updater.add(line)
+    tmp_updater.blank_line()
+    tmp_updater.ui_print("This OTA package is squashed from %d packages by OTA-maker" % len(packages))
+    for root in roots:
+        tmp_updater.ui_print("Mounting " + root)
+        tmp_updater.mount(root)
+
+    # 补丁
+    # 校验时文件应为最初的内容或最终的内容, 之后第 N 轮依次打每个文件的第 N 个补丁
+    tmp_updater.ui_print("Checking files...")
+    with open(OTA_ZIP_PATH + "/install/patches", "w", encoding="UTF-8", newline="\n") as f:
+        for path, steps in patch_items:
+            f.write("%s %s %s %s -\n" % (path, steps[0].src, steps[-1].tgt, steps[-1].size))
+    rounds = max([len(steps) for p, steps in patch_items] or [0])
+    patch_size = 0
+    segment_buffer = 0
+    round_manifests = []
+    segment_cmds = []
+    for n in range(rounds):
+        lines = []
+        segments = []
+        for path, steps in patch_items:
+            if n >= len(steps):
+                continue
+            step = steps[n]
+            if step.segments is None:
+                arcname = "patch/%d%s.p" % (n + 1, path)
+                passthrough.append((step.rom, step.patch, arcname))
+                patch_size += step.rom.getinfo(step.patch).file_size
+                lines.append("%s %s %s %s /tmp/%s\n" % (path, step.src, step.tgt, step.size, arcname))
+            else:
+                segment_dir = "patch/%d%s.seg" % (n + 1, path)
+                for i, seg in enumerate(step.segments):
+                    name = "%s/%d.p" % (step.patch, i)
+                    passthrough.append((step.rom, name, "%s/%d.p" % (segment_dir, i)))
+                    patch_size += step.rom.getinfo(name).file_size
+                    segment_buffer = max(segment_buffer, int(seg[1]) + int(seg[4]))
+                segments.append((path, step.tgt, "/tmp/" + segment_dir, step.segments))
+        manifest = None
+        if lines:
+            manifest = "/install/patches.%d" % (n + 1)
+            with open(OTA_ZIP_PATH + manifest, "w", encoding="UTF-8", newline="\n") as f:
+                f.writelines(lines)
+        round_manifests.append(manifest)
+        segment_cmds.append(segments)
+    tmp_peak = patch_size + segment_buffer
+    log("On-device /tmp requirement: %s" % human_size(tmp_peak))
+    if patch_items:
+        tmp_updater.apply_patch_check_list("/tmp/install/patches")
+        tmp_updater.check_space("/tmp", tmp_peak)
+    tmp_updater.blank_line()
+    tmp_updater.ui_print("Extracting patch files...")
+    tmp_updater.package_extract_dir("patch", "/tmp/patch")
+    tmp_updater.ui_print("Patching files...")
+    for manifest, segments in zip(round_manifests, segment_cmds):
+        if manifest:
+            tmp_updater.apply_patch_list("/tmp" + manifest)
+        for path, tgt, segment_dir, specs in segments:
+            tmp_updater.apply_patch_segmented(path, tgt, segment_dir, specs)
+    dalvik_cache = []
+    for path in sorted(p for p in patched if p in files):
+        cache = path.replace("/", "@")
+        dalvik_cache += ["/data/dalvik/arm/" + cache, "/data/dalvik/arm64/" + cache]
+    for chunk in batched(dalvik_cache):
+        tmp_updater.delete(*chunk)
+    tmp_updater.blank_line()
+
+    # 新文件
+    tmp_updater.ui_print("Extracting files...")
+    for path, (kind, value) in files.items():
+        if kind == "new" and value[0]:
+            passthrough.append((value[0], value[1], path[1:]))
+    for root in roots:
+        tmp_updater.package_extract_dir(root[1:], root)
+    tmp_updater.blank_line()
+
+    # 按原来的顺序重放元数据, 后面的包设置的值覆盖前面的
+    tmp_updater.ui_print("Setting metadata...")
+    for kind, key, value in metadata:
+        if kind == "recursive":
+            tmp_updater.add(value)
+            continue
+        uid, gid, mode, selabel = key
+        for chunk in batched(value):
+            tmp_updater.set_metadata_files(uid, gid, mode, selabel if selabel != "-" else None, *chunk)
+    tmp_updater.blank_line()
+
+    # 删除的文件或目录之后又重新加入时不再删除
+    tmp_updater.ui_print("Deleting files...")
+    kept = set()
+    for path in files:
+        while path and path not in kept:
+            kept.add(path)
+            path = path.rpartition("/")[0]
+    rem_list = sorted(p for p in deletes if p not in kept)
+    for chunk in batched(rem_list):
+        tmp_updater.delete(*chunk)
+    tmp_updater.blank_line()
+
+    tmp_updater.ui_print("Making symlinks...")
+    sym_dict = OrderedDict()
+    for link in sorted(symlinks):
+        sym_dict.setdefault(symlinks[link], []).append(link)
+    for target, links in sym_dict.items():
+        for chunk in batched(links):
+            tmp_updater.symlink(target, *chunk)
+    tmp_updater.blank_line()
+
+    # 原版脚本刷入完整的 boot 和固件等, 只保留最后一个包的
+    tmp_updater.ui_print("Running updater-script from source zip...")
+    for line in last.source:
+        tmp_updater.add(line)
+    passthrough += [(last.rom, name) for name in last.passthrough]
+
+    tmp_updater.blank_line()
+    tmp_updater.add("sync")
+    tmp_updater.blank_line()
+    for root in roots:
+        tmp_updater.ui_print("Unmounting " + root)
+        tmp_updater.unmount(root)
+    tmp_updater.blank_line()
+    tmp_updater.ui_print("Done!")
+
+    update_script_path = os.path.join(OTA_ZIP_PATH, "META-INF", "com", "google", "android")
+    mkdir(update_script_path)
+    with open(os.path.join(update_script_path, "update-binary"), "w", encoding="UTF-8", newline="\n") as f:
+        f.writelines(tmp_updater.script)
+    with open(os.path.join(update_script_path, "updater-script"), "w", encoding="UTF-8", newline="\n") as f:
+        f.write("# Dummy file; update-binary is a shell script.\n")
+
+    log("Making OTA package...")
+    make_zip(OTA_ZIP_PATH, OUT_PATH, passthrough)
+    log("Output OTA package: %s" % OUT_PATH)
+    return OUT_PATH
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(prog="squash.py",
+                                     description="merge consecutive OTA packages made by OTA-maker")
+    parser.add_argument("OUT_PATH")
+    parser.add_argument("OTA_ZIP", nargs="+", help="OTA packages in upgrade order (A->B, B->C, ...)")
+    parser.add_argument("--tmpdir", help="directory for intermediates")
+    args = parser.parse_args()
+    try:
+        squash(args.OTA_ZIP, args.OUT_PATH, tmpdir=args.tmpdir)
+    except (SquashError, PathNotFoundError) as e:
+        print("ERROR: %s" % e)
+        sys.exit(1)
+    sys.exit(0)
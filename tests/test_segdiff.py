@@ -0,0 +1,39 @@
+#!/usr/bin/env python3
+# encoding: utf-8
+
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from segdiff import BLOCK_SIZE, split_segments
+
+MiB = 1024 * 1024
+
+def dd_length(old_size, offset, length):
+    # 设备端 dd bs=4096 skip=offset/4096 count=ceil(length/4096) 实际读出的字节数
+    count = (length + BLOCK_SIZE - 1) // BLOCK_SIZE
+    return max(min(count * BLOCK_SIZE, old_size - offset), 0)
+
+def check(old_size, new_size, seg_size=16 * MiB, margin=MiB):
+    segments = split_segments(old_size, new_size, seg_size, margin)
+    assert sum(s[3] for s in segments) == new_size
+    for old_offset, old_length, new_offset, new_length in segments:
+        assert old_offset % BLOCK_SIZE == 0
+        assert old_length == dd_length(old_size, old_offset, old_length)
+    return segments
+
+def test_unaligned_tail_old_longer():
+    segments = check(80 * MiB + 5000 * 1024, 70 * MiB + 123)
+    old_offset, old_length = segments[-1][:2]
+    assert (old_offset + old_length) % BLOCK_SIZE == 0
+
+def test_unaligned_tail_old_shorter():
+    old_size = 60 * MiB + 77
+    old_offset, old_length = check(old_size, 70 * MiB + 123)[-1][:2]
+    assert old_offset + old_length <= old_size
+
+def test_sizes():
+    for old_size in (0, 1, BLOCK_SIZE, 17 * MiB - 1, 33 * MiB + 4095):
+        for new_size in (1, BLOCK_SIZE + 1, 16 * MiB, 16 * MiB + 1, 40 * MiB + 5):
+            check(old_size, new_size)
@@ -3,15 +3,29 @@
 
 import time
 from common import get_bin
+from functools import lru_cache
+
+# 批量命令每行最多携带的文件数, 避免超出参数长度限制
+BATCH_SIZE = 64
+
+def batched(items, size=BATCH_SIZE):
+    items = list(items)
+    for i in range(0, len(items), size):
+        yield items[i:i + size]
+
+@lru_cache(maxsize=None)
+def read_base_script():
+    # update-binary 的函数定义部分 在同一进程中只读取一次
+    with open(get_bin("update-binary"), "r", encoding="UTF-8") as f:
+        return tuple(f.readlines())
 
 class Updater:
 
-    def __init__(self):
-        self.script = []
-        basefile = get_bin("update-binary")
-        with open(basefile, "r", encoding="UTF-8") as f:
-            for line in f.readlines():
-                self.script.append(line)
+    def __init__(self, instrument=False):
+        # instrument 为 True 时记录设备端各阶段的耗时和写入量
+        self.instrument = instrument
+        self.current_phase = None
+        self.script = list(read_base_script())
         self.blank_line()
         self.script.append("# The above is function definition section.\n")
         self.blank_line()
@@ -47,6 +61,24 @@ class Updater:
     def blank_line(self):
         self.script.append("\n")
 
+    def phase(self, name):
+        # 计时模式下结束上一阶段并开始新的阶段
+        if not self.instrument:
+            return
+        if self.current_phase:
+            self.script.append("phase_end\n")
+        self.script.append("phase_begin %s\n" % name)
+        self.current_phase = name
+
+    def phase_report(self):
+        # 结束最后一个阶段 输出总耗时并把记录复制到 /cache
+        if not self.instrument:
+            return
+        if self.current_phase:
+            self.script.append("phase_end\n")
+            self.current_phase = None
+        self.script.append("phase_report\n")
+
     def abort(self, string, space_no=0):
         self.script.append(" " * space_no + "abort \"%s\";\n" % string)
 
@@ -65,6 +97,10 @@ class Updater:
     def package_extract_dir(self, s_dir, d_dir):
         self.script.append("package_extract_dir %s %s\n" % (s_dir, d_dir))
 
+    def copy_files(self, src, *dsts):
+        # 把已解压的文件复制到其他位置, 内容相同的文件只打包一份
+        self.script.append("copy_files %s %s\n" % (src, " ".join(dsts)))
+
     def delete(self, *files):
         self.script.append("delete %s\n" % " ".join(files))
 
@@ -91,6 +127,11 @@ class Updater:
             s += " selabel %s" % selabel
         self.script.append(s + "\n")
 
+    def set_metadata_files(self, uid, gid, mode, selabel, *files):
+        # 元数据相同的一组文件, selabel 为空时不设置
+        self.script.append("set_metadata_files %s %s %s %s %s\n"
+                           % (uid, gid, mode, selabel or "-", " ".join(files)))
+
     def set_metadata_recursive(self, dir, uid, gid, dmode, fmode,
                                capabilities=None, selabel=None):
         s = ("set_metadata_recursive %s uid %s gid %s dmode %s fmode %s"
@@ -104,9 +145,38 @@ class Updater:
     def apply_patch_check(self, spath, *f_shas):
         self.script.append("apply_patch_check %s %s\n" % (spath, " ".join(f_shas)))
 
+    def apply_patch_check_list(self, manifest):
+        # manifest 每行: <文件路径> <原文件哈希> <打补丁后的文件哈希> <打补丁后的文件大小> <补丁文件路径|->
+        self.script.append("apply_patch_check_list %s\n" % manifest)
+
+    def apply_patch_list(self, manifest):
+        # 按 manifest 逐个打补丁, 补丁路径为 - 的行跳过
+        self.script.append("apply_patch_list %s\n" % manifest)
+
+    def apply_patch_stream(self, manifest):
+        # 同 apply_patch_list, 但补丁路径为卡刷包中的路径, 打补丁前解压到 /tmp, 完成后立即删除
+        self.script.append("apply_patch_stream %s\n" % manifest)
+
+    def apply_patch_parallel(self, mode, job_memory, *manifests):
+        # 每个 manifest 在后台执行 apply_patch_<mode>, 全部结束后检查结果
+        # 设备端可用内存不足以同时容纳所有任务(每个 job_memory 字节)时逐个执行
+        self.script.append("apply_patch_parallel %s %s %s\n"
+                           % (mode, job_memory, " ".join(manifests)))
+
+    def check_space(self, path, size):
+        # 设备端 path 所在分区剩余空间不足 size 字节时中止
+        self.script.append("check_space %s %s\n" % (path, size))
+
     def apply_patch(self, spath, f_sha1, tgtsize, p_sha1, p_path):
         # applypatch <目标文件路径> <-> <打补丁后的文件哈希> \
         #            <打补丁后的文件大小> <原文件哈希:补丁文件路径>
         # 其中 - 参数暗示覆盖原文件
         self.script.append("apply_patch %s - %s %s %s:%s\n"
                            % (spath, f_sha1, tgtsize, p_sha1, p_path))
+
+    def apply_patch_segmented(self, spath, f_sha1, p_dir, segments):
+        # 分段补丁: segments 为 (旧窗口偏移, 旧窗口大小, 旧窗口sha1, 新段sha1, 新段大小) 列表
+        # 第 N 段的补丁文件为 <p_dir>/N.p
+        self.script.append("apply_patch_segmented %s %s %s %s\n"
+                           % (spath, f_sha1, p_dir,
+                              " ".join(":".join(str(x) for x in seg) for seg in segments)))